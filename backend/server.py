@@ -1,40 +1,150 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Request, Response, BackgroundTasks, Header
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import Int64
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, PlainSerializer, TypeAdapter, ValidationError
+from typing import List, Optional, Tuple, Callable, Awaitable, Annotated, Literal
+from typing_extensions import TypedDict
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
 import base64
+import hashlib
+import json
+import re
+import orjson
+import msgpack
 import io
+import threading
+import zlib
 from reportlab.lib.pagesizes import A4
+import reportlab
 from reportlab.lib import colors
+from reportlab import rl_config
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as RLImage
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable, Image as RLImage
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_CENTER, TA_JUSTIFY
 from reportlab.pdfgen import canvas
-from PIL import Image
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from PIL import Image, ImageCms
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject, StreamObject, TextStringObject
+from jinja2 import Environment, DictLoader
+from markupsafe import Markup, escape
+import pypdfium2 as pdfium
+import numpy as np
+
+# Optional response codecs; gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Money
+# Amounts are stored as int64 minor units of the document currency and only
+# become decimals at the API and rendering edges, so Mongo sums are exact.
+CURRENCY_EXPONENTS = {"IDR": 0, "USD": 2, "EUR": 2}
+DEFAULT_CURRENCY_EXPONENT = 2
+MONEY_FIELDS = ('subtotal', 'discount_amount', 'tax_amount', 'total')
+LINE_MONEY_FIELDS = ('unit_price', 'total')
+
+Money = Annotated[Decimal, PlainSerializer(float, return_type=float, when_used='json')]
+
+def currency_exponent(currency: Optional[str]) -> int:
+    return CURRENCY_EXPONENTS.get(currency, DEFAULT_CURRENCY_EXPONENT)
+
+def round_minor(amount: Decimal) -> int:
+    return int(amount.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_minor_units(amount, exponent: int) -> int:
+    return round_minor(Decimal(str(amount)).scaleb(exponent))
+
+def from_minor_units(value, exponent: int) -> Decimal:
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        # Legacy document written before amounts were stored as minor units
+        return Decimal(str(value)).quantize(Decimal(1).scaleb(-exponent), rounding=ROUND_HALF_UP)
+    return Decimal(int(value)).scaleb(-exponent)
+
+def stored_amount_minor(value, exponent: int) -> int:
+    # Floats are legacy major-unit amounts
+    return to_minor_units(value, exponent) if isinstance(value, float) else int(value)
+
+def line_total_minor(quantity, unit_price: int) -> int:
+    return round_minor(Decimal(str(quantity)) * unit_price)
+
+def document_totals_minor(subtotal: int, discount_rate, tax_rate) -> Tuple[int, int, int]:
+    """Return (discount, tax, total); tax applies to the discounted subtotal."""
+    discount = round_minor(Decimal(subtotal) * Decimal(str(discount_rate or 0)) / 100)
+    tax = round_minor(Decimal(subtotal - discount) * Decimal(str(tax_rate or 0)) / 100)
+    return discount, tax, subtotal - discount + tax
+
+def money_to_storage(document: dict) -> dict:
+    """Recompute every total from quantities and unit prices, in minor units.
+
+    Client-supplied line totals, subtotal, discount, tax and total are
+    ignored.
+    """
+    exponent = currency_exponent(document.get('currency'))
+    subtotal = 0
+    for item in document['items']:
+        unit_price = to_minor_units(item['unit_price'], exponent)
+        item['unit_price'] = Int64(unit_price)
+        item['total'] = Int64(line_total_minor(item['quantity'], unit_price))
+        subtotal += item['total']
+    discount, tax, total = document_totals_minor(subtotal, document.get('discount_rate'), document.get('tax_rate'))
+    document['subtotal'] = Int64(subtotal)
+    document['discount_amount'] = Int64(discount)
+    document['tax_amount'] = Int64(tax)
+    document['total'] = Int64(total)
+    return document
+
+def money_from_storage(document: Optional[dict]) -> Optional[dict]:
+    if not document:
+        return document
+    exponent = currency_exponent(document.get('currency'))
+    for item in document.get('items') or []:
+        for field in LINE_MONEY_FIELDS:
+            if field in item:
+                item[field] = from_minor_units(item[field], exponent)
+    for field in MONEY_FIELDS:
+        if field in document:
+            document[field] = from_minor_units(document[field], exponent)
+    return document
+
 # Define Models
 class Company(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -46,11 +156,14 @@ class Company(BaseModel):
     website: str = ""
     motto: str = ""
     npwp: str = ""
+    code: str = ""
     bank_name: str = ""
     bank_account: str = ""
     bank_account_name: str = ""
     logo: Optional[str] = None
+    version: int = 1
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
 
 class CompanyCreate(BaseModel):
     name: str
@@ -60,6 +173,7 @@ class CompanyCreate(BaseModel):
     website: str = ""
     motto: str = ""
     npwp: str = ""
+    code: str = ""
     bank_name: str = ""
     bank_account: str = ""
     bank_account_name: str = ""
@@ -72,7 +186,9 @@ class Item(BaseModel):
     description: str = ""
     unit_price: float
     unit: str = "pcs"
+    version: int = 1
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
 
 class ItemCreate(BaseModel):
     name: str
@@ -85,14 +201,14 @@ class InvoiceItem(BaseModel):
     name: str
     description: str = ""
     quantity: float
-    unit_price: float
+    unit_price: Money
     unit: str = "pcs"
-    total: float
+    total: Money = Decimal(0)
 
 class Invoice(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    invoice_number: str
+    invoice_number: str = ""
     company_id: str
     client_name: str
     client_address: str = ""
@@ -101,22 +217,27 @@ class Invoice(BaseModel):
     date: str
     due_date: str = ""
     items: List[InvoiceItem]
-    subtotal: float
+    subtotal: Money = Decimal(0)
     tax_rate: float = 0
-    tax_amount: float = 0
+    tax_amount: Money = Decimal(0)
     discount_rate: float = 0
-    discount_amount: float = 0
-    total: float
+    discount_amount: Money = Decimal(0)
+    total: Money = Decimal(0)
     currency: str = "IDR"
     notes: str = ""
     template_id: str = "template1"
     status: str = "draft"
     signature_name: str = ""
     signature_position: str = ""
+    version: int = 1
+    finalized: bool = False
+    finalized_at: Optional[datetime] = None
+    content_hash: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
 
 class InvoiceCreate(BaseModel):
-    invoice_number: str
+    invoice_number: str = ""
     company_id: str
     client_name: str
     client_address: str = ""
@@ -125,12 +246,12 @@ class InvoiceCreate(BaseModel):
     date: str
     due_date: str = ""
     items: List[InvoiceItem]
-    subtotal: float
+    subtotal: Money = Decimal(0)
     tax_rate: float = 0
-    tax_amount: float = 0
+    tax_amount: Money = Decimal(0)
     discount_rate: float = 0
-    discount_amount: float = 0
-    total: float
+    discount_amount: Money = Decimal(0)
+    total: Money = Decimal(0)
     currency: str = "IDR"
     notes: str = ""
     template_id: str = "template1"
@@ -141,7 +262,7 @@ class InvoiceCreate(BaseModel):
 class Quotation(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    quotation_number: str
+    quotation_number: str = ""
     company_id: str
     client_name: str
     client_address: str = ""
@@ -150,22 +271,27 @@ class Quotation(BaseModel):
     date: str
     valid_until: str = ""
     items: List[InvoiceItem]
-    subtotal: float
+    subtotal: Money = Decimal(0)
     tax_rate: float = 0
-    tax_amount: float = 0
+    tax_amount: Money = Decimal(0)
     discount_rate: float = 0
-    discount_amount: float = 0
-    total: float
+    discount_amount: Money = Decimal(0)
+    total: Money = Decimal(0)
     currency: str = "IDR"
     notes: str = ""
     template_id: str = "template1"
     status: str = "draft"
     signature_name: str = ""
     signature_position: str = ""
+    version: int = 1
+    finalized: bool = False
+    finalized_at: Optional[datetime] = None
+    content_hash: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
 
 class QuotationCreate(BaseModel):
-    quotation_number: str
+    quotation_number: str = ""
     company_id: str
     client_name: str
     client_address: str = ""
@@ -174,12 +300,12 @@ class QuotationCreate(BaseModel):
     date: str
     valid_until: str = ""
     items: List[InvoiceItem]
-    subtotal: float
+    subtotal: Money = Decimal(0)
     tax_rate: float = 0
-    tax_amount: float = 0
+    tax_amount: Money = Decimal(0)
     discount_rate: float = 0
-    discount_amount: float = 0
-    total: float
+    discount_amount: Money = Decimal(0)
+    total: Money = Decimal(0)
     currency: str = "IDR"
     notes: str = ""
     template_id: str = "template1"
@@ -203,7 +329,7 @@ class ActivityRow(BaseModel):
 class Letter(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    letter_number: str
+    letter_number: str = ""
     company_id: str
     date: str
     subject: str
@@ -216,10 +342,15 @@ class Letter(BaseModel):
     attachments_count: int = 0
     cc_list: str = ""
     signatories: List[Signatory] = []
+    version: int = 1
+    finalized: bool = False
+    finalized_at: Optional[datetime] = None
+    content_hash: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: Optional[datetime] = None
 
 class LetterCreate(BaseModel):
-    letter_number: str
+    letter_number: str = ""
     company_id: str
     date: str
     subject: str
@@ -233,6 +364,964 @@ class LetterCreate(BaseModel):
     cc_list: str = ""
     signatories: List[Signatory] = []
 
+# Partial updates: every field is optional and list fields take operations
+class InvoiceItemChanges(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    item_id: Optional[str] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+    quantity: Optional[float] = None
+    unit_price: Optional[Money] = None
+    unit: Optional[str] = None
+
+class LineItemOperation(BaseModel):
+    op: Literal["insert", "update", "remove"]
+    index: Optional[int] = None
+    item_id: Optional[str] = None
+    item: Optional[InvoiceItem] = None
+    changes: Optional[InvoiceItemChanges] = None
+
+class InvoicePatch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    invoice_number: Optional[str] = None
+    company_id: Optional[str] = None
+    client_name: Optional[str] = None
+    client_address: Optional[str] = None
+    client_phone: Optional[str] = None
+    client_email: Optional[str] = None
+    date: Optional[str] = None
+    due_date: Optional[str] = None
+    tax_rate: Optional[float] = None
+    discount_rate: Optional[float] = None
+    notes: Optional[str] = None
+    template_id: Optional[str] = None
+    status: Optional[str] = None
+    signature_name: Optional[str] = None
+    signature_position: Optional[str] = None
+    items: List[LineItemOperation] = []
+
+class QuotationPatch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    quotation_number: Optional[str] = None
+    company_id: Optional[str] = None
+    client_name: Optional[str] = None
+    client_address: Optional[str] = None
+    client_phone: Optional[str] = None
+    client_email: Optional[str] = None
+    date: Optional[str] = None
+    valid_until: Optional[str] = None
+    tax_rate: Optional[float] = None
+    discount_rate: Optional[float] = None
+    notes: Optional[str] = None
+    template_id: Optional[str] = None
+    status: Optional[str] = None
+    signature_name: Optional[str] = None
+    signature_position: Optional[str] = None
+    items: List[LineItemOperation] = []
+
+class ActivityRowChanges(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    no: Optional[int] = None
+    kegiatan: Optional[str] = None
+    jumlah: Optional[str] = None
+    satuan: Optional[str] = None
+    hasil: Optional[str] = None
+    keterangan: Optional[str] = None
+
+class ActivityOperation(BaseModel):
+    op: Literal["insert", "update", "remove"]
+    index: Optional[int] = None
+    row: Optional[ActivityRow] = None
+    changes: Optional[ActivityRowChanges] = None
+
+class LetterPatch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    letter_number: Optional[str] = None
+    company_id: Optional[str] = None
+    date: Optional[str] = None
+    subject: Optional[str] = None
+    letter_type: Optional[str] = None
+    recipient_name: Optional[str] = None
+    recipient_position: Optional[str] = None
+    recipient_address: Optional[str] = None
+    content: Optional[str] = None
+    attachments_count: Optional[int] = None
+    cc_list: Optional[str] = None
+    signatories: Optional[List[Signatory]] = None
+    activities: List[ActivityOperation] = []
+
+# Bulk operations select their documents by id list and/or filter
+class BulkSelection(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    ids: Optional[List[str]] = None
+    company_id: Optional[str] = None
+    status: Optional[str] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+class BulkDelete(BaseModel):
+    where: BulkSelection
+
+class BulkStatusUpdate(BaseModel):
+    where: BulkSelection
+    status: str
+
+class BulkCompanyReassign(BaseModel):
+    where: BulkSelection
+    company_id: str
+
+class BatchGet(BaseModel):
+    ids: List[str]
+
+# Finalization
+# A finalized document is frozen: its content hash never changes, so its JSON
+# and stored archive can be cached by any tier without revalidating against
+# Mongo. Its PDF and HTML still show the live company record, so those are
+# revalidated against an ETag that also carries the company version.
+FINALIZE_EXCLUDED_FIELDS = {'_id', 'created_at', 'updated_at', 'version', 'finalized', 'finalized_at', 'content_hash'}
+IMMUTABLE_MAX_AGE = 31536000
+IMMUTABLE_CACHE_CONTROL = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+RENDERING_CACHE_CONTROL = "public, no-cache"
+
+def document_content_hash(document: dict) -> str:
+    content = {k: v for k, v in document.items() if k not in FINALIZE_EXCLUDED_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def valid_until_date(document: dict) -> Optional[date]:
+    try:
+        return date.fromisoformat(document['valid_until'][:10])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def stamp_expiry(document: dict) -> Optional[datetime]:
+    """When renderings of a quotation gain the EXPIRED stamp, if that is still ahead."""
+    valid_until = valid_until_date(document)
+    if valid_until is None or document.get('status') == 'accepted':
+        return None
+    expires = datetime(valid_until.year, valid_until.month, valid_until.day, tzinfo=timezone.utc) + timedelta(days=1)
+    return expires if expires > datetime.now(timezone.utc) else None
+
+def rendered_cache_control(document: dict) -> str:
+    # A rendering pinned to its document and company versions still changes
+    # once a quotation expires, so until then it is only cached up to that moment
+    expires = stamp_expiry(document)
+    if expires is None:
+        return IMMUTABLE_CACHE_CONTROL
+    return "public, max-age=%d" % min((expires - datetime.now(timezone.utc)).total_seconds(), IMMUTABLE_MAX_AGE)
+
+def rendering_validators(request: Request, document: dict, company: dict) -> Tuple[Optional[Response], dict]:
+    """Validators for the PDF or HTML of a finalized document, and a 304 when the client's copy is current.
+
+    Renderings also show the live company record, so they are revalidated
+    instead of cached as immutable, and the ETag follows the company version.
+    """
+    if not (document.get('finalized') and document.get('content_hash')):
+        return None, {}
+    tag = f"{document['content_hash']}-c{company.get('version', 1)}"
+    if valid_until_date(document) is not None:
+        tag += "-expired" if quotation_watermark(document) == "EXPIRED" else "-valid"
+    headers = validator_headers('"%s"' % tag, None, RENDERING_CACHE_CONTROL)
+    if is_not_modified(request, headers["ETag"], None):
+        return Response(status_code=304, headers=headers), headers
+    return None, headers
+
+async def finalize_document(collection, document_id: str, label: str) -> dict:
+    document = await collection.find_one({"id": document_id}, {"_id": 0})
+    if not document:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    if document.get('finalized'):
+        raise HTTPException(status_code=409, detail=f"{label} is already finalized")
+    
+    # Only freeze the exact revision that was hashed
+    version = document.get('version')
+    version_filter = {"version": version} if version is not None else {"version": {"$exists": False}}
+    now = datetime.now(timezone.utc)
+    finalized = await collection.find_one_and_update(
+        {"id": document_id, "finalized": {"$ne": True}, **version_filter},
+        {"$set": {
+            "finalized": True,
+            "finalized_at": now,
+            "updated_at": now,
+            "content_hash": document_content_hash(document),
+            "version": (version or 1) + 1,
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not finalized:
+        raise HTTPException(status_code=409, detail=f"{label} was modified while finalizing, please retry")
+    await record_change(collection.name)
+    return finalized
+
+def if_match_versions(if_match: Optional[str]) -> Optional[List[int]]:
+    """Versions listed in an If-Match header; None when the update is unconditional."""
+    if not if_match or if_match.strip() == '*':
+        return None
+    versions = []
+    for tag in if_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        try:
+            versions.append(int(tag.strip('"')))
+        except ValueError:
+            # e.g. the content-hash ETag of a finalized document, which never matches
+            continue
+    return versions
+
+def version_headers(document: dict) -> dict:
+    return {"ETag": '"%d"' % document.get('version', 1)}
+
+def set_version_etag(response: Response, document: dict):
+    response.headers.update(version_headers(document))
+
+async def update_document(collection, document_id: str, update: dict, label: str, if_match: Optional[str] = None, number: Optional[str] = None) -> dict:
+    """Apply ``update`` in one round trip, unless the document is finalized or,
+    when If-Match is given, has moved past the listed versions.
+
+    The extra lookup to choose between 404 and 409 only happens when the
+    update did not match. ``number`` is the document number being written,
+    named in the 409 when the unique number index rejects it.
+    """
+    query = {"id": document_id, "finalized": {"$ne": True}}
+    versions = if_match_versions(if_match)
+    if versions is not None:
+        # Documents written before versioning count as version 1
+        query["version"] = {"$in": versions + [None] if 1 in versions else versions}
+    try:
+        updated = await collection.find_one_and_update(
+            query,
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        raise number_in_use(label, number)
+    if not updated:
+        await raise_update_failure(collection, document_id, label)
+    await record_change(collection.name)
+    return updated
+
+async def raise_update_failure(collection, document_id: str, label: str):
+    current = await collection.find_one({"id": document_id}, {"_id": 0, "finalized": 1, "version": 1})
+    if not current:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    if current.get('finalized'):
+        raise HTTPException(status_code=409, detail=f"{label} is finalized and can no longer be modified")
+    raise HTTPException(status_code=409, detail=f"{label} was modified by someone else (now version {current.get('version', 1)}), reload and try again")
+
+def created_range_filter(created_from: Optional[datetime], created_to: Optional[datetime]) -> dict:
+    created_range = {}
+    if created_from:
+        created_range["$gte"] = created_from
+    if created_to:
+        created_range["$lt"] = created_to
+    return {"created_at": created_range} if created_range else {}
+
+# Conditional Requests
+# Documents are tagged by version (by content hash once finalized) and lists
+# by a per-collection change counter that every write bumps once it has landed.
+# A matching If-None-Match, or If-Modified-Since when no tag is sent, gets a
+# 304 before the body is validated or serialized.
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+def as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+async def record_change(collection_name: str):
+    await db.counters.update_one(
+        {"_id": f"changes:{collection_name}"},
+        {"$inc": {"seq": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        opaque = etag[2:] if etag.startswith('W/') else etag
+        return any(tag.strip().removeprefix('W/') == opaque for tag in if_none_match.split(','))
+    
+    if_modified_since = request.headers.get('if-modified-since')
+    if not if_modified_since or not isinstance(last_modified, datetime):
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return as_utc(last_modified).replace(microsecond=0) <= as_utc(since)
+
+def validator_headers(etag: str, last_modified: Optional[datetime], cache_control: str) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if isinstance(last_modified, datetime):
+        headers["Last-Modified"] = format_datetime(as_utc(last_modified), usegmt=True)
+    return headers
+
+def document_validators(request: Request, document: dict, related: Tuple[Optional[dict], ...] = ()) -> Tuple[Optional[Response], dict]:
+    """Validators for a document (and any related documents embedded in the
+    response), and a 304 when the client's copy is current."""
+    if document.get('finalized') and document.get('content_hash') and not related:
+        etag, cache_control = '"%s"' % document['content_hash'], IMMUTABLE_CACHE_CONTROL
+    else:
+        tags = [str(doc.get('version', 1)) if doc else "0" for doc in (document, *related)]
+        etag, cache_control = '"%s"' % ".".join(tags), REVALIDATE_CACHE_CONTROL
+    modified = [doc.get('updated_at') or doc.get('created_at') for doc in (document, *related) if doc]
+    last_modified = max((as_utc(value) for value in modified if isinstance(value, datetime)), default=None)
+    headers = validator_headers(etag, last_modified, cache_control)
+    headers["Vary"] = "Accept"
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers), headers
+    return None, headers
+
+async def list_validators(request: Request, collection_name: str, related: Tuple[str, ...] = ()) -> Tuple[Optional[Response], dict]:
+    """Validators for a list of collection_name (plus any related collections
+    embedded in it), and a 304 when the client's copy is current."""
+    names = (collection_name, *related)
+    counters = {
+        counter['_id']: counter
+        async for counter in db.counters.find({"_id": {"$in": [f"changes:{name}" for name in names]}})
+    }
+    tags, last_modified = [], None
+    for name in names:
+        counter = counters.get(f"changes:{name}", {})
+        tags.append("%s-%d" % (name, counter.get('seq', 0)))
+        if isinstance(counter.get('updated_at'), datetime):
+            last_modified = max(filter(None, (last_modified, as_utc(counter['updated_at']))))
+    etag = '"%s"' % ".".join(tags)
+    headers = validator_headers(etag, last_modified, REVALIDATE_CACHE_CONTROL)
+    headers["Vary"] = "Accept"
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers), headers
+    return None, headers
+
+# Document Numbers
+# Numbers are drawn from per (company, kind, period) counters in db.counters.
+# Each worker reserves SEQUENCE_BLOCK_SIZE numbers with a single $inc and hands
+# them out locally, so the counter document is written once per block rather
+# than once per create. Numbers are unique, but across workers they may be
+# issued out of order and a block left unused at shutdown leaves a gap; set
+# SEQUENCE_BLOCK_SIZE=1 where strictly consecutive numbering is required.
+DOCUMENT_KINDS = {
+    # kind: (collection, label, number field)
+    "invoice": ("invoices", "Invoice", "invoice_number"),
+    "quotation": ("quotations", "Quotation", "quotation_number"),
+    "letter": ("letters", "Letter", "letter_number"),
+}
+DOCUMENT_NUMBER_FORMATS = {
+    "invoice": os.environ.get('INVOICE_NUMBER_FORMAT', 'INV/{year}/{month:02d}/{seq:04d}'),
+    "quotation": os.environ.get('QUOTATION_NUMBER_FORMAT', 'QUO/{year}/{month:02d}/{seq:04d}'),
+    "letter": os.environ.get('LETTER_NUMBER_FORMAT', '{seq:03d}/{code}/{roman_month}/{year}'),
+}
+SEQUENCE_BLOCK_SIZE = int(os.environ.get('SEQUENCE_BLOCK_SIZE', '10'))
+# How often an auto-assigned number that collides with a hand-picked one is
+# replaced by the next in its sequence before the create fails with 409
+NUMBER_ASSIGN_ATTEMPTS = int(os.environ.get('NUMBER_ASSIGN_ATTEMPTS', '25'))
+DUPLICATE_KEY_ERROR = 11000
+ROMAN_MONTHS = ('I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', 'XI', 'XII')
+LEGAL_ENTITY_PREFIXES = {'PT', 'CV', 'UD', 'FA', 'TBK'}
+
+# counter key -> [next, last] of the block reserved by this worker
+sequence_blocks = {}
+sequence_locks = {}
+
+def number_period(number_format: str, when: date) -> str:
+    # The period is the finest date unit the format shows
+    if '{month' in number_format or '{roman_month' in number_format:
+        return f"{when.year}-{when.month:02d}"
+    if '{year' in number_format:
+        return str(when.year)
+    return "all"
+
+def document_date(value: Optional[str]) -> date:
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return datetime.now(timezone.utc).date()
+
+def company_code(company: dict) -> str:
+    if company.get('code'):
+        return company['code']
+    words = [w for w in company.get('name', '').replace('.', ' ').split() if w.upper() not in LEGAL_ENTITY_PREFIXES]
+    return ''.join(w[0] for w in words if w[0].isalnum()).upper()[:3]
+
+async def reserve_sequence_block(key: str, size: int = SEQUENCE_BLOCK_SIZE) -> List[int]:
+    for attempt in range(2):
+        try:
+            counter = await db.counters.find_one_and_update(
+                {"_id": key},
+                {"$inc": {"seq": size}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            break
+        except DuplicateKeyError:
+            # Another worker created the counter first; the retry increments it
+            if attempt:
+                raise
+    return [counter['seq'] - size + 1, counter['seq']]
+
+async def next_sequences(key: str, count: int = 1) -> List[int]:
+    """Hand out count numbers, drawing on the local block before reserving more."""
+    lock = sequence_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        block = sequence_blocks.get(key) or [1, 0]
+        taken = list(range(block[0], min(block[1], block[0] + count - 1) + 1))
+        block[0] += len(taken)
+        if len(taken) < count:
+            needed = count - len(taken)
+            block = await reserve_sequence_block(key, max(needed, SEQUENCE_BLOCK_SIZE))
+            taken.extend(range(block[0], block[0] + needed))
+            block[0] += needed
+        sequence_blocks[key] = block
+        return taken
+
+async def check_document_number(kind: str, company_id: str, number: str, exclude_id: Optional[str] = None):
+    collection, label, number_field = DOCUMENT_KINDS[kind]
+    query = {"company_id": company_id, number_field: number}
+    if exclude_id:
+        query["id"] = {"$ne": exclude_id}
+    if await db[collection].find_one(query, {"_id": 1}):
+        raise number_in_use(label, number)
+
+def number_in_use(label: str, number: Optional[str] = None) -> HTTPException:
+    # The unique number index is what enforces this; callers that know the
+    # number they were writing name it in the message
+    if number:
+        return HTTPException(status_code=409, detail=f"{label} number {number} is already in use")
+    return HTTPException(status_code=409, detail=f"{label} number is already in use")
+
+def sequence_key(kind: str, company_id: str, when: date) -> str:
+    return f"{company_id}:{kind}:{number_period(DOCUMENT_NUMBER_FORMATS[kind], when)}"
+
+def format_document_number(kind: str, company: dict, when: date, seq: int) -> str:
+    return DOCUMENT_NUMBER_FORMATS[kind].format(
+        seq=seq,
+        year=when.year,
+        month=when.month,
+        roman_month=ROMAN_MONTHS[when.month - 1],
+        code=company_code(company),
+    )
+
+async def assign_document_number(kind: str, document: dict):
+    """Number a new document from its sequence, or check a supplied number is unused."""
+    _, _, number_field = DOCUMENT_KINDS[kind]
+    if document.get(number_field):
+        await check_document_number(kind, document['company_id'], document[number_field])
+        return
+    
+    company = await db.companies.find_one({"id": document['company_id']}, {"_id": 0, "name": 1, "code": 1})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    when = document_date(document.get('date'))
+    seq = (await next_sequences(sequence_key(kind, document['company_id'], when)))[0]
+    document[number_field] = format_document_number(kind, company, when, seq)
+
+async def insert_numbered_document(kind: str, document: dict, build: Callable[[dict], dict]) -> dict:
+    """Number, build and insert a new document.
+
+    A supplied number taken in the meantime fails with 409. An auto-assigned
+    number that someone already chose by hand is replaced by the next one in
+    its sequence.
+    """
+    collection, label, number_field = DOCUMENT_KINDS[kind]
+    supplied = bool(document.get(number_field))
+    for _ in range(NUMBER_ASSIGN_ATTEMPTS):
+        await assign_document_number(kind, document)
+        doc = build(dict(document))
+        try:
+            await db[collection].insert_one(doc)
+        except DuplicateKeyError:
+            if supplied:
+                raise number_in_use(label, doc[number_field])
+            document[number_field] = ""
+            continue
+        await record_change(collection)
+        return doc
+    raise HTTPException(status_code=409, detail=f"Could not assign a free {label.lower()} number, please retry")
+
+async def assign_document_numbers(kind: str, documents: List[dict]) -> dict:
+    """Bulk counterpart of assign_document_number.
+
+    Supplied numbers are checked with one query and every sequence hands out
+    its numbers with at most one counter write. Returns {position: error} for
+    the documents that could not be numbered.
+    """
+    collection, label, number_field = DOCUMENT_KINDS[kind]
+    errors = {}
+    
+    supplied = [(position, doc) for position, doc in enumerate(documents) if doc.get(number_field)]
+    used = set()
+    if supplied:
+        cursor = db[collection].find(
+            {
+                "company_id": {"$in": list({doc['company_id'] for _, doc in supplied})},
+                number_field: {"$in": list({doc[number_field] for _, doc in supplied})},
+            },
+            {"_id": 0, "company_id": 1, number_field: 1},
+        )
+        used = {(doc['company_id'], doc[number_field]) async for doc in cursor}
+        for position, doc in supplied:
+            key = (doc['company_id'], doc[number_field])
+            if key in used:
+                errors[position] = f"{label} number {doc[number_field]} is already in use"
+            used.add(key)
+    
+    pending = [(position, doc) for position, doc in enumerate(documents) if not doc.get(number_field)]
+    if pending:
+        cursor = db.companies.find(
+            {"id": {"$in": list({doc['company_id'] for _, doc in pending})}},
+            {"_id": 0, "id": 1, "name": 1, "code": 1},
+        )
+        companies = {company['id']: company async for company in cursor}
+        groups = {}
+        for position, doc in pending:
+            company = companies.get(doc['company_id'])
+            if not company:
+                errors[position] = "Company not found"
+                continue
+            when = document_date(doc.get('date'))
+            groups.setdefault(sequence_key(kind, doc['company_id'], when), []).append((doc, company, when))
+        for key, group in groups.items():
+            # Skip numbers the batch supplies itself; clashes with stored
+            # documents surface as duplicate key errors on insert
+            while group:
+                clashes = []
+                for (doc, company, when), seq in zip(group, await next_sequences(key, len(group))):
+                    doc[number_field] = format_document_number(kind, company, when, seq)
+                    if (doc['company_id'], doc[number_field]) in used:
+                        clashes.append((doc, company, when))
+                group = clashes
+    
+    return errors
+
+# Partial Updates
+# PATCH replays list operations on a narrow snapshot of the document and
+# writes only what changed: plain field and line edits become $set on dotted
+# paths, and inserts/removals become a single pipeline $set that references
+# the untouched stored elements instead of resending them. The write is
+# conditional on the snapshot's version, so concurrent edits are retried
+# (or rejected with 409 when the client sent If-Match).
+PATCH_RETRIES = 3
+
+def locate_entry(entries: List[dict], operation, key_field: Optional[str]) -> int:
+    """Index of the line an update/remove addresses.
+
+    An item_id alone only identifies a line while no other line holds the
+    same item; otherwise the client has to give the index as well.
+    """
+    item_id = getattr(operation, 'item_id', None)
+    if operation.index is None and item_id is None:
+        raise HTTPException(status_code=400, detail=f"{operation.op} needs an index or item_id")
+    if item_id is not None:
+        matches = [i for i, entry in enumerate(entries) if entry['values'].get(key_field) == item_id]
+        if not matches:
+            raise HTTPException(status_code=400, detail=f"No line with item_id {item_id}")
+        if operation.index is None:
+            if len(matches) > 1:
+                raise HTTPException(status_code=409, detail=f"Lines {', '.join(map(str, matches))} all hold item {item_id}, give the index of the one to {operation.op}")
+            return matches[0]
+        if operation.index not in matches:
+            raise HTTPException(status_code=409, detail=f"Line {operation.index} no longer holds item {item_id}")
+    elif not 0 <= operation.index < len(entries):
+        raise HTTPException(status_code=400, detail=f"Line index {operation.index} is out of range")
+    return operation.index
+
+def replay_list_operations(current: List[dict], operations: list, new_value: Callable, changed_values: Callable, key_field: Optional[str] = None) -> List[dict]:
+    """Apply insert/update/remove operations, in order, to a list snapshot.
+
+    Each resulting entry keeps the index it came from in the stored list
+    (``source``, None when inserted), its merged ``values`` and the
+    ``changes`` that have to be written for it.
+    """
+    entries = [{"source": i, "values": dict(value), "changes": {}} for i, value in enumerate(current)]
+    for operation in operations:
+        if operation.op == "insert":
+            position = len(entries) if operation.index is None else operation.index
+            if not 0 <= position <= len(entries):
+                raise HTTPException(status_code=400, detail=f"Insert position {position} is out of range")
+            value = new_value(operation)
+            entries.insert(position, {"source": None, "values": value, "changes": value})
+            continue
+        position = locate_entry(entries, operation, key_field)
+        if operation.op == "remove":
+            del entries[position]
+        else:
+            changes = changed_values(operation)
+            entries[position]['values'].update(changes)
+            entries[position]['changes'].update(changes)
+    return entries
+
+def list_is_restructured(entries: List[dict], stored_length: int) -> bool:
+    return len(entries) != stored_length or any(entry['source'] != i for i, entry in enumerate(entries))
+
+def list_path_updates(field: str, entries: List[dict]) -> dict:
+    return {
+        f"{field}.{entry['source']}.{key}": value
+        for entry in entries
+        for key, value in entry['changes'].items()
+    }
+
+def list_pipeline_expression(field: str, entries: List[dict]) -> dict:
+    """Aggregation expression rebuilding a restructured list.
+
+    The unchanged prefix is sliced from the stored array and every later
+    element either references its stored original or is a literal, so only
+    new and changed values travel to the server.
+    """
+    prefix = 0
+    while prefix < len(entries) and entries[prefix]['source'] == prefix and not entries[prefix]['changes']:
+        prefix += 1
+    elements = []
+    for entry in entries[prefix:]:
+        if entry['source'] is None:
+            elements.append({"$literal": entry['changes']})
+        elif entry['changes']:
+            elements.append({"$mergeObjects": [{"$arrayElemAt": [f"${field}", entry['source']]}, {"$literal": entry['changes']}]})
+        else:
+            elements.append({"$arrayElemAt": [f"${field}", entry['source']]})
+    if prefix == 0:
+        return {"$literal": []} if not elements else {"$concatArrays": [elements]}
+    return {"$concatArrays": [{"$slice": [f"${field}", prefix]}, elements]}
+
+def patch_update(field_changes: dict, list_field: str, entries: List[dict], stored_length: int, version: int):
+    """Build the update document (or pipeline) for a patch."""
+    field_changes = {**field_changes, "updated_at": datetime.now(timezone.utc), "version": version + 1}
+    if not list_is_restructured(entries, stored_length):
+        return {"$set": {**field_changes, **list_path_updates(list_field, entries)}}
+    stage = {key: {"$literal": value} for key, value in field_changes.items()}
+    stage[list_field] = list_pipeline_expression(list_field, entries)
+    return [{"$set": stage}]
+
+async def apply_patch(collection, document_id: str, label: str, projection: dict, if_match: Optional[str], build: Callable) -> dict:
+    """Apply the update ``build(snapshot, version)`` returns, guarded by the snapshot's version.
+
+    Without If-Match a concurrent write simply triggers a fresh snapshot;
+    with If-Match the client's version must still be current.
+    """
+    versions = if_match_versions(if_match)
+    for _ in range(PATCH_RETRIES):
+        snapshot = await collection.find_one({"id": document_id}, {**projection, "_id": 0, "version": 1, "finalized": 1})
+        if not snapshot:
+            raise HTTPException(status_code=404, detail=f"{label} not found")
+        if snapshot.get('finalized'):
+            raise HTTPException(status_code=409, detail=f"{label} is finalized and can no longer be modified")
+        version = snapshot.get('version')
+        if versions is not None and (version or 1) not in versions:
+            raise HTTPException(status_code=409, detail=f"{label} was modified by someone else (now version {version or 1}), reload and try again")
+        
+        update = await build(snapshot, version or 1)
+        version_filter = {"version": version} if version is not None else {"version": {"$exists": False}}
+        try:
+            updated = await collection.find_one_and_update(
+                {"id": document_id, "finalized": {"$ne": True}, **version_filter},
+                update,
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            raise number_in_use(label)
+        if updated:
+            await record_change(collection.name)
+            return updated
+        if versions is not None:
+            break
+    await raise_update_failure(collection, document_id, label)
+
+TRADE_TOTALS_PROJECTION = {
+    "currency": 1, "discount_rate": 1, "tax_rate": 1,
+    "items.item_id": 1, "items.quantity": 1, "items.unit_price": 1, "items.total": 1,
+}
+
+async def check_patched_number(kind: str, document_id: str, snapshot: dict, field_changes: dict):
+    _, _, number_field = DOCUMENT_KINDS[kind]
+    if field_changes.get(number_field) == "":
+        # Same as PUT: a blank number keeps the assigned one
+        del field_changes[number_field]
+    if number_field in field_changes or 'company_id' in field_changes:
+        await check_document_number(
+            kind,
+            field_changes.get('company_id', snapshot['company_id']),
+            field_changes.get(number_field, snapshot[number_field]),
+            exclude_id=document_id,
+        )
+
+def trade_patch_builder(kind: str, document_id: str, patch) -> Tuple[dict, Callable]:
+    """Return the projection and patch builder for an invoice or quotation.
+
+    Line totals are recomputed for every line (stale ones are corrected as a
+    side effect) so the document totals stay consistent with money_to_storage.
+    """
+    _, _, number_field = DOCUMENT_KINDS[kind]
+    field_changes = patch.model_dump(exclude_unset=True, exclude_none=True, exclude={'items'})
+    touches_totals = bool(patch.items) or 'discount_rate' in field_changes or 'tax_rate' in field_changes
+    projection = {"company_id": 1, number_field: 1, **(TRADE_TOTALS_PROJECTION if touches_totals else {})}
+    
+    async def build(snapshot: dict, version: int):
+        await check_patched_number(kind, document_id, snapshot, field_changes)
+        if not touches_totals:
+            return patch_update(field_changes, 'items', [], 0, version)
+        
+        exponent = currency_exponent(snapshot.get('currency'))
+        def new_line(operation):
+            if operation.item is None:
+                raise HTTPException(status_code=400, detail="insert needs an item")
+            line = operation.item.model_dump()
+            line['unit_price'] = Int64(to_minor_units(line['unit_price'], exponent))
+            return line
+        def line_changes(operation):
+            if operation.changes is None:
+                raise HTTPException(status_code=400, detail="update needs changes")
+            changes = operation.changes.model_dump(exclude_unset=True, exclude_none=True)
+            if 'unit_price' in changes:
+                changes['unit_price'] = Int64(to_minor_units(changes['unit_price'], exponent))
+            return changes
+        
+        stored = snapshot.get('items') or []
+        entries = replay_list_operations(stored, patch.items, new_line, line_changes, key_field='item_id')
+        subtotal = 0
+        for entry in entries:
+            values = entry['values']
+            line_total = line_total_minor(values['quantity'], stored_amount_minor(values['unit_price'], exponent))
+            if entry['source'] is None or stored_amount_minor(values.get('total') or 0, exponent) != line_total:
+                entry['changes']['total'] = Int64(line_total)
+            subtotal += line_total
+        discount, tax, total = document_totals_minor(
+            subtotal,
+            field_changes.get('discount_rate', snapshot.get('discount_rate')),
+            field_changes.get('tax_rate', snapshot.get('tax_rate')),
+        )
+        totals = {
+            "subtotal": Int64(subtotal),
+            "discount_amount": Int64(discount),
+            "tax_amount": Int64(tax),
+            "total": Int64(total),
+        }
+        return patch_update({**field_changes, **totals}, 'items', entries, len(stored), version)
+    
+    return projection, build
+
+def letter_patch_builder(letter_id: str, patch: LetterPatch) -> Tuple[dict, Callable]:
+    """Return the projection and patch builder for a letter."""
+    field_changes = patch.model_dump(exclude_unset=True, exclude_none=True, exclude={'activities'})
+    projection = {"company_id": 1, "letter_number": 1, **({"activities.no": 1} if patch.activities else {})}
+    
+    async def build(snapshot: dict, version: int):
+        await check_patched_number("letter", letter_id, snapshot, field_changes)
+        def new_row(operation):
+            if operation.row is None:
+                raise HTTPException(status_code=400, detail="insert needs a row")
+            return operation.row.model_dump()
+        def row_changes(operation):
+            if operation.changes is None:
+                raise HTTPException(status_code=400, detail="update needs changes")
+            return operation.changes.model_dump(exclude_unset=True, exclude_none=True)
+        
+        stored = snapshot.get('activities') or []
+        entries = replay_list_operations(stored, patch.activities, new_row, row_changes)
+        return patch_update(field_changes, 'activities', entries, len(stored), version)
+    
+    return projection, build
+
+# Document Creation
+# Shared by the single and bulk create routes so both store identical documents.
+TRADE_MODELS = {"invoice": Invoice, "quotation": Quotation}
+
+def new_item_document(item_dict: dict) -> dict:
+    item = Item(**item_dict)
+    item.updated_at = item.created_at
+    return item.model_dump()
+
+def new_trade_document(kind: str, document: dict) -> dict:
+    model = TRADE_MODELS[kind](**document)
+    model.updated_at = model.created_at
+    return money_to_storage(model.model_dump())
+
+def new_letter_document(letter_dict: dict) -> dict:
+    letter_dict["id"] = str(uuid.uuid4())
+    letter_dict["created_at"] = datetime.now(timezone.utc)
+    letter_dict["updated_at"] = letter_dict["created_at"]
+    letter_dict["version"] = 1
+    return letter_dict
+
+# Response Serialization
+# List routes validate their documents once against a TypeAdapter compiled at
+# import and return the JSON bytes pydantic-core dumps from it. Returning a
+# Response keeps FastAPI from validating and encoding the same list again; the
+# response_model on the route still documents the schema.
+COMPANY_LIST = TypeAdapter(List[Company])
+ITEM_LIST = TypeAdapter(List[Item])
+INVOICE_LIST = TypeAdapter(List[Invoice])
+QUOTATION_LIST = TypeAdapter(List[Quotation])
+LETTER_LIST = TypeAdapter(List[Letter])
+COMPANY_DOCUMENT = TypeAdapter(Company)
+ITEM_DOCUMENT = TypeAdapter(Item)
+INVOICE_DOCUMENT = TypeAdapter(Invoice)
+QUOTATION_DOCUMENT = TypeAdapter(Quotation)
+LETTER_DOCUMENT = TypeAdapter(Letter)
+
+def list_response(adapter: TypeAdapter, documents: list, headers: Optional[dict] = None) -> Response:
+    return Response(content=adapter.dump_json(adapter.validate_python(documents)), media_type="application/json", headers=headers)
+
+def msgpack_response(adapter: TypeAdapter, data, headers: Optional[dict] = None, status_code: int = 200) -> Response:
+    """MessagePack twin of a JSON response: the same model-shaped data, packed."""
+    content = msgpack.packb(adapter.dump_python(adapter.validate_python(data), mode="json"))
+    return Response(content=content, status_code=status_code, media_type=MSGPACK_MEDIA_TYPE, headers=headers)
+
+# Streaming Lists
+# List routes stream straight from the cursor when the client asks for NDJSON
+# or MessagePack. Documents are fetched and written NDJSON_BATCH_SIZE at a
+# time, so memory stays flat for any result size and the first batch goes out
+# immediately. A MessagePack list is a sequence of maps, one per document
+# (read it with msgpack.Unpacker); single documents are sent as one map.
+NDJSON_BATCH_SIZE = int(os.environ.get('NDJSON_BATCH_SIZE', '200'))
+NDJSON_MEDIA_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "msgpack": MSGPACK_MEDIA_TYPE}
+
+async def money_batch_from_storage(documents: List[dict]) -> List[dict]:
+    return [money_from_storage(document) for document in documents]
+
+def preferred_format(request: Request) -> Optional[str]:
+    """"ndjson" or "msgpack" when Accept lists one of them before plain JSON."""
+    for media_type in request.headers.get('accept', '').split(','):
+        media_type = media_type.split(';')[0].strip().lower()
+        if media_type in NDJSON_MEDIA_TYPES:
+            return "ndjson"
+        if media_type in MSGPACK_MEDIA_TYPES:
+            return "msgpack"
+        if media_type == "application/json":
+            return None
+    return None
+
+def stream_documents(
+    collection,
+    query: dict,
+    adapter: TypeAdapter,
+    output_format: str,
+    prepare: Optional[Callable[[List[dict]], Awaitable[List[dict]]]] = None,
+    headers: Optional[dict] = None,
+    projection: Optional[dict] = None,
+) -> StreamingResponse:
+    """Stream query results as NDJSON or MessagePack; prepare converts each batch before it is serialized."""
+    async def encode(batch: List[dict]) -> bytes:
+        if prepare:
+            batch = await prepare(batch)
+        if output_format == "msgpack":
+            return b"".join(msgpack.packb(adapter.dump_python(adapter.validate_python(doc), mode="json")) for doc in batch)
+        return b"".join(adapter.dump_json(adapter.validate_python(doc)) + b"\n" for doc in batch)
+    
+    async def lines():
+        cursor = collection.find(query, projection or {"_id": 0}).batch_size(NDJSON_BATCH_SIZE)
+        batch = []
+        try:
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) == NDJSON_BATCH_SIZE:
+                    yield await encode(batch)
+                    batch = []
+        finally:
+            await cursor.close()
+        if batch:
+            yield await encode(batch)
+    
+    return StreamingResponse(lines(), media_type=STREAM_MEDIA_TYPES[output_format], headers=headers)
+
+# Sparse Fieldsets & Expansion
+# Invoice, quotation and letter routes take fields=a,b, projected in Mongo so
+# only those fields leave the database, and expand=company, which embeds each
+# document's company from one $in query per page or NDJSON batch. Such
+# responses are shaped by total=False TypedDict views of the models: present
+# fields serialize exactly as in full documents and absent ones are left out.
+SPARSE_MODELS = {"invoice": Invoice, "quotation": Quotation, "letter": Letter}
+EXPANSIONS = ('company',)
+# Always read so responses can be tagged and money converted, then dropped
+SPARSE_SUPPORT_FIELDS = ('version', 'created_at', 'updated_at', 'finalized', 'content_hash')
+
+def document_views(model) -> Tuple[TypeAdapter, TypeAdapter]:
+    annotations = {
+        name: Annotated[(field.annotation, *field.metadata)] if field.metadata else field.annotation
+        for name, field in model.model_fields.items()
+    }
+    annotations['company'] = Optional[Company]
+    view = TypedDict(f"{model.__name__}View", annotations, total=False)
+    return TypeAdapter(view), TypeAdapter(List[view])
+
+# kind -> (adapter for one view, adapter for a list of views)
+DOCUMENT_VIEWS = {kind: document_views(model) for kind, model in SPARSE_MODELS.items()}
+
+def sparse_options(kind: str, fields: Optional[str], expand: Optional[str]) -> Tuple[Optional[List[str]], bool]:
+    """Parse fields= and expand= into (field names or None, whether to embed the company)."""
+    names = None
+    if fields:
+        names = list(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+        unknown = [name for name in names if name not in SPARSE_MODELS[kind].model_fields]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    expansions = [name.strip() for name in (expand or '').split(',') if name.strip()]
+    unknown = [name for name in expansions if name not in EXPANSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot expand: {', '.join(unknown)}")
+    return names, 'company' in expansions
+
+def sparse_projection(kind: str, fields: Optional[List[str]], expand_company: bool) -> dict:
+    if fields is None:
+        return {"_id": 0}
+    projection = {"_id": 0, "id": 1, **dict.fromkeys(fields, 1), **dict.fromkeys(SPARSE_SUPPORT_FIELDS, 1)}
+    if kind in TRADE_MODELS:
+        # Stored amounts need the currency exponent to be converted
+        projection["currency"] = 1
+    if expand_company:
+        projection["company_id"] = 1
+    return projection
+
+async def shape_documents(kind: str, documents: List[dict], fields: Optional[List[str]], expand_company: bool) -> List[dict]:
+    """Convert stored documents for output, embed their companies and drop fields that were not asked for."""
+    if kind in TRADE_MODELS:
+        documents = [money_from_storage(document) for document in documents]
+    if expand_company:
+        company_ids = list({document['company_id'] for document in documents if document.get('company_id')})
+        cursor = db.companies.find({"id": {"$in": company_ids}}, {"_id": 0})
+        companies = {company['id']: company async for company in cursor} if company_ids else {}
+        for document in documents:
+            document['company'] = companies.get(document.get('company_id'))
+    if fields is not None:
+        keep = {'id', 'company', *fields}
+        documents = [{name: value for name, value in document.items() if name in keep} for document in documents]
+    return documents
+
+async def sparse_list_response(kind: str, request: Request, query: dict, fields: Optional[List[str]], expand_company: bool) -> Response:
+    collection = DOCUMENT_KINDS[kind][0]
+    cached, headers = await list_validators(request, collection, ("companies",) if expand_company else ())
+    if cached:
+        return cached
+    
+    document_adapter, list_adapter = DOCUMENT_VIEWS[kind]
+    projection = sparse_projection(kind, fields, expand_company)
+    output_format = preferred_format(request)
+    if output_format:
+        prepare = lambda batch: shape_documents(kind, batch, fields, expand_company)
+        return stream_documents(db[collection], query, document_adapter, output_format, prepare, headers, projection)
+    documents = await db[collection].find(query, projection).to_list(1000)
+    return list_response(list_adapter, await shape_documents(kind, documents, fields, expand_company), headers)
+
+async def sparse_document_response(kind: str, request: Request, document_id: str, fields: Optional[List[str]], expand_company: bool) -> Response:
+    collection, label, _ = DOCUMENT_KINDS[kind]
+    document = await db[collection].find_one({"id": document_id}, sparse_projection(kind, fields, expand_company))
+    if not document:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    
+    [view] = await shape_documents(kind, [dict(document)], fields, expand_company)
+    cached, headers = document_validators(request, document, (view.get('company'),) if expand_company else ())
+    if cached:
+        return cached
+    document_adapter, _ = DOCUMENT_VIEWS[kind]
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(document_adapter, view, headers)
+    return Response(content=document_adapter.dump_json(document_adapter.validate_python(view)), media_type="application/json", headers=headers)
+
 # Routes
 @api_router.get("/")
 async def root():
@@ -240,43 +1329,49 @@ async def root():
 
 # Company Routes
 @api_router.post("/companies", response_model=Company, status_code=201)
-async def create_company(input: CompanyCreate):
+async def create_company(input: CompanyCreate, request: Request):
     company_dict = input.model_dump()
     company = Company(**company_dict)
+    company.updated_at = company.created_at
     doc = company.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.companies.insert_one(doc)
+    await record_change("companies")
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(COMPANY_DOCUMENT, company, status_code=201)
     return company
 
 @api_router.get("/companies", response_model=List[Company])
-async def get_companies():
-    companies = await db.companies.find({}, {"_id": 0}).to_list(1000)
-    for company in companies:
-        if isinstance(company['created_at'], str):
-            company['created_at'] = datetime.fromisoformat(company['created_at'])
-    return companies
+async def get_companies(request: Request, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None):
+    cached, headers = await list_validators(request, "companies")
+    if cached:
+        return cached
+    output_format = preferred_format(request)
+    if output_format:
+        return stream_documents(db.companies, created_range_filter(created_from, created_to), COMPANY_DOCUMENT, output_format, headers=headers)
+    companies = await db.companies.find(created_range_filter(created_from, created_to), {"_id": 0}).to_list(1000)
+    return list_response(COMPANY_LIST, companies, headers)
 
 @api_router.get("/companies/{company_id}", response_model=Company)
-async def get_company(company_id: str):
+async def get_company(company_id: str, request: Request, response: Response):
     company = await db.companies.find_one({"id": company_id}, {"_id": 0})
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
-    if isinstance(company['created_at'], str):
-        company['created_at'] = datetime.fromisoformat(company['created_at'])
+    cached, headers = document_validators(request, company)
+    if cached:
+        return cached
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(COMPANY_DOCUMENT, company, headers)
+    response.headers.update(headers)
     return company
 
 @api_router.put("/companies/{company_id}", response_model=Company)
-async def update_company(company_id: str, input: CompanyCreate):
-    company = await db.companies.find_one({"id": company_id}, {"_id": 0})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company not found")
-    
+async def update_company(company_id: str, input: CompanyCreate, request: Request, response: Response, if_match: Optional[str] = Header(None)):
     update_dict = input.model_dump()
-    await db.companies.update_one({"id": company_id}, {"$set": update_dict})
-    
-    updated_company = await db.companies.find_one({"id": company_id}, {"_id": 0})
-    if isinstance(updated_company['created_at'], str):
-        updated_company['created_at'] = datetime.fromisoformat(updated_company['created_at'])
+    update_dict['updated_at'] = datetime.now(timezone.utc)
+    updated_company = await update_document(db.companies, company_id, {"$set": update_dict, "$inc": {"version": 1}}, "Company", if_match)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(COMPANY_DOCUMENT, updated_company, version_headers(updated_company))
+    set_version_etag(response, updated_company)
     return updated_company
 
 @api_router.delete("/companies/{company_id}")
@@ -284,47 +1379,51 @@ async def delete_company(company_id: str):
     result = await db.companies.delete_one({"id": company_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Company not found")
+    await record_change("companies")
     return {"message": "Company deleted successfully"}
 
 # Item Routes
 @api_router.post("/items", response_model=Item, status_code=201)
-async def create_item(input: ItemCreate):
-    item_dict = input.model_dump()
-    item = Item(**item_dict)
-    doc = item.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+async def create_item(input: ItemCreate, request: Request):
+    doc = new_item_document(input.model_dump())
     await db.items.insert_one(doc)
-    return item
+    await record_change("items")
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(ITEM_DOCUMENT, doc, status_code=201)
+    return Item(**doc)
 
 @api_router.get("/items", response_model=List[Item])
-async def get_items():
-    items = await db.items.find({}, {"_id": 0}).to_list(1000)
-    for item in items:
-        if isinstance(item['created_at'], str):
-            item['created_at'] = datetime.fromisoformat(item['created_at'])
-    return items
+async def get_items(request: Request, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None):
+    cached, headers = await list_validators(request, "items")
+    if cached:
+        return cached
+    output_format = preferred_format(request)
+    if output_format:
+        return stream_documents(db.items, created_range_filter(created_from, created_to), ITEM_DOCUMENT, output_format, headers=headers)
+    items = await db.items.find(created_range_filter(created_from, created_to), {"_id": 0}).to_list(1000)
+    return list_response(ITEM_LIST, items, headers)
 
 @api_router.get("/items/{item_id}", response_model=Item)
-async def get_item(item_id: str):
+async def get_item(item_id: str, request: Request, response: Response):
     item = await db.items.find_one({"id": item_id}, {"_id": 0})
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
-    if isinstance(item['created_at'], str):
-        item['created_at'] = datetime.fromisoformat(item['created_at'])
+    cached, headers = document_validators(request, item)
+    if cached:
+        return cached
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(ITEM_DOCUMENT, item, headers)
+    response.headers.update(headers)
     return item
 
 @api_router.put("/items/{item_id}", response_model=Item)
-async def update_item(item_id: str, input: ItemCreate):
-    item = await db.items.find_one({"id": item_id}, {"_id": 0})
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    
+async def update_item(item_id: str, input: ItemCreate, request: Request, response: Response, if_match: Optional[str] = Header(None)):
     update_dict = input.model_dump()
-    await db.items.update_one({"id": item_id}, {"$set": update_dict})
-    
-    updated_item = await db.items.find_one({"id": item_id}, {"_id": 0})
-    if isinstance(updated_item['created_at'], str):
-        updated_item['created_at'] = datetime.fromisoformat(updated_item['created_at'])
+    update_dict['updated_at'] = datetime.now(timezone.utc)
+    updated_item = await update_document(db.items, item_id, {"$set": update_dict, "$inc": {"version": 1}}, "Item", if_match)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(ITEM_DOCUMENT, updated_item, version_headers(updated_item))
+    set_version_etag(response, updated_item)
     return updated_item
 
 @api_router.delete("/items/{item_id}")
@@ -332,173 +1431,701 @@ async def delete_item(item_id: str):
     result = await db.items.delete_one({"id": item_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Item not found")
+    await record_change("items")
     return {"message": "Item deleted successfully"}
 
 # Invoice Routes
 @api_router.post("/invoices", response_model=Invoice, status_code=201)
-async def create_invoice(input: InvoiceCreate):
-    invoice_dict = input.model_dump()
-    invoice = Invoice(**invoice_dict)
-    doc = invoice.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.invoices.insert_one(doc)
-    return invoice
+async def create_invoice(input: InvoiceCreate, request: Request):
+    doc = await insert_numbered_document("invoice", input.model_dump(), lambda document: new_trade_document("invoice", document))
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(INVOICE_DOCUMENT, money_from_storage(doc), status_code=201)
+    return money_from_storage(doc)
 
 @api_router.get("/invoices", response_model=List[Invoice])
-async def get_invoices():
-    invoices = await db.invoices.find({}, {"_id": 0}).to_list(1000)
-    for invoice in invoices:
-        if isinstance(invoice['created_at'], str):
-            invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-    return invoices
+async def get_invoices(
+    request: Request,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+):
+    field_names, expand_company = sparse_options("invoice", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_list_response("invoice", request, created_range_filter(created_from, created_to), field_names, expand_company)
+    cached, headers = await list_validators(request, "invoices")
+    if cached:
+        return cached
+    output_format = preferred_format(request)
+    if output_format:
+        return stream_documents(db.invoices, created_range_filter(created_from, created_to), INVOICE_DOCUMENT, output_format, money_batch_from_storage, headers)
+    invoices = await db.invoices.find(created_range_filter(created_from, created_to), {"_id": 0}).to_list(1000)
+    return list_response(INVOICE_LIST, [money_from_storage(invoice) for invoice in invoices], headers)
 
 @api_router.get("/invoices/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: str):
+async def get_invoice(invoice_id: str, request: Request, response: Response, fields: Optional[str] = None, expand: Optional[str] = None):
+    field_names, expand_company = sparse_options("invoice", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_document_response("invoice", request, invoice_id, field_names, expand_company)
     invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    if isinstance(invoice['created_at'], str):
-        invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-    return invoice
+    cached, headers = document_validators(request, invoice)
+    if cached:
+        return cached
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(INVOICE_DOCUMENT, money_from_storage(invoice), headers)
+    response.headers.update(headers)
+    return money_from_storage(invoice)
 
 @api_router.put("/invoices/{invoice_id}", response_model=Invoice)
-async def update_invoice(invoice_id: str, input: InvoiceCreate):
-    invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    update_dict = input.model_dump()
-    await db.invoices.update_one({"id": invoice_id}, {"$set": update_dict})
-    
-    updated_invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if isinstance(updated_invoice['created_at'], str):
-        updated_invoice['created_at'] = datetime.fromisoformat(updated_invoice['created_at'])
-    return updated_invoice
+async def update_invoice(invoice_id: str, input: InvoiceCreate, request: Request, response: Response, if_match: Optional[str] = Header(None)):
+    update_dict = money_to_storage(input.model_dump())
+    if not update_dict['invoice_number']:
+        del update_dict['invoice_number']
+    update_dict['updated_at'] = datetime.now(timezone.utc)
+    updated_invoice = await update_document(db.invoices, invoice_id, {"$set": update_dict, "$inc": {"version": 1}}, "Invoice", if_match, update_dict.get('invoice_number'))
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(INVOICE_DOCUMENT, money_from_storage(updated_invoice), version_headers(updated_invoice))
+    set_version_etag(response, updated_invoice)
+    return money_from_storage(updated_invoice)
+
+@api_router.patch("/invoices/{invoice_id}", response_model=Invoice)
+async def patch_invoice(invoice_id: str, patch: InvoicePatch, request: Request, response: Response, if_match: Optional[str] = Header(None)):
+    projection, build = trade_patch_builder("invoice", invoice_id, patch)
+    updated_invoice = await apply_patch(db.invoices, invoice_id, "Invoice", projection, if_match, build)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(INVOICE_DOCUMENT, money_from_storage(updated_invoice), version_headers(updated_invoice))
+    set_version_etag(response, updated_invoice)
+    return money_from_storage(updated_invoice)
+
+@api_router.post("/invoices/{invoice_id}/finalize", response_model=Invoice)
+async def finalize_invoice(invoice_id: str):
+    invoice = money_from_storage(await finalize_document(db.invoices, invoice_id, "Invoice"))
+    await archive_document("invoice", invoice)
+    return invoice
 
 @api_router.delete("/invoices/{invoice_id}")
 async def delete_invoice(invoice_id: str):
     result = await db.invoices.delete_one({"id": invoice_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    await record_change("invoices")
     return {"message": "Invoice deleted successfully"}
 
 # Quotation Routes
 @api_router.post("/quotations", response_model=Quotation, status_code=201)
-async def create_quotation(input: QuotationCreate):
-    quotation_dict = input.model_dump()
-    quotation = Quotation(**quotation_dict)
-    doc = quotation.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.quotations.insert_one(doc)
-    return quotation
+async def create_quotation(input: QuotationCreate, request: Request):
+    doc = await insert_numbered_document("quotation", input.model_dump(), lambda document: new_trade_document("quotation", document))
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(QUOTATION_DOCUMENT, money_from_storage(doc), status_code=201)
+    return money_from_storage(doc)
 
 @api_router.get("/quotations", response_model=List[Quotation])
-async def get_quotations():
-    quotations = await db.quotations.find({}, {"_id": 0}).to_list(1000)
-    for quotation in quotations:
-        if isinstance(quotation['created_at'], str):
-            quotation['created_at'] = datetime.fromisoformat(quotation['created_at'])
-    return quotations
+async def get_quotations(
+    request: Request,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+):
+    field_names, expand_company = sparse_options("quotation", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_list_response("quotation", request, created_range_filter(created_from, created_to), field_names, expand_company)
+    cached, headers = await list_validators(request, "quotations")
+    if cached:
+        return cached
+    output_format = preferred_format(request)
+    if output_format:
+        return stream_documents(db.quotations, created_range_filter(created_from, created_to), QUOTATION_DOCUMENT, output_format, money_batch_from_storage, headers)
+    quotations = await db.quotations.find(created_range_filter(created_from, created_to), {"_id": 0}).to_list(1000)
+    return list_response(QUOTATION_LIST, [money_from_storage(quotation) for quotation in quotations], headers)
 
 @api_router.get("/quotations/{quotation_id}", response_model=Quotation)
-async def get_quotation(quotation_id: str):
+async def get_quotation(quotation_id: str, request: Request, response: Response, fields: Optional[str] = None, expand: Optional[str] = None):
+    field_names, expand_company = sparse_options("quotation", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_document_response("quotation", request, quotation_id, field_names, expand_company)
     quotation = await db.quotations.find_one({"id": quotation_id}, {"_id": 0})
     if not quotation:
         raise HTTPException(status_code=404, detail="Quotation not found")
-    if isinstance(quotation['created_at'], str):
-        quotation['created_at'] = datetime.fromisoformat(quotation['created_at'])
-    return quotation
+    cached, headers = document_validators(request, quotation)
+    if cached:
+        return cached
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(QUOTATION_DOCUMENT, money_from_storage(quotation), headers)
+    response.headers.update(headers)
+    return money_from_storage(quotation)
 
 @api_router.put("/quotations/{quotation_id}", response_model=Quotation)
-async def update_quotation(quotation_id: str, input: QuotationCreate):
-    quotation = await db.quotations.find_one({"id": quotation_id}, {"_id": 0})
-    if not quotation:
-        raise HTTPException(status_code=404, detail="Quotation not found")
-    
-    update_dict = input.model_dump()
-    await db.quotations.update_one({"id": quotation_id}, {"$set": update_dict})
-    
-    updated_quotation = await db.quotations.find_one({"id": quotation_id}, {"_id": 0})
-    if isinstance(updated_quotation['created_at'], str):
-        updated_quotation['created_at'] = datetime.fromisoformat(updated_quotation['created_at'])
-    return updated_quotation
+async def update_quotation(quotation_id: str, input: QuotationCreate, request: Request, response: Response, if_match: Optional[str] = Header(None)):
+    update_dict = money_to_storage(input.model_dump())
+    if not update_dict['quotation_number']:
+        del update_dict['quotation_number']
+    update_dict['updated_at'] = datetime.now(timezone.utc)
+    updated_quotation = await update_document(db.quotations, quotation_id, {"$set": update_dict, "$inc": {"version": 1}}, "Quotation", if_match, update_dict.get('quotation_number'))
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(QUOTATION_DOCUMENT, money_from_storage(updated_quotation), version_headers(updated_quotation))
+    set_version_etag(response, updated_quotation)
+    return money_from_storage(updated_quotation)
+
+@api_router.patch("/quotations/{quotation_id}", response_model=Quotation)
+async def patch_quotation(quotation_id: str, patch: QuotationPatch, request: Request, response: Response, if_match: Optional[str] = Header(None)):
+    projection, build = trade_patch_builder("quotation", quotation_id, patch)
+    updated_quotation = await apply_patch(db.quotations, quotation_id, "Quotation", projection, if_match, build)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(QUOTATION_DOCUMENT, money_from_storage(updated_quotation), version_headers(updated_quotation))
+    set_version_etag(response, updated_quotation)
+    return money_from_storage(updated_quotation)
+
+@api_router.post("/quotations/{quotation_id}/finalize", response_model=Quotation)
+async def finalize_quotation(quotation_id: str):
+    quotation = money_from_storage(await finalize_document(db.quotations, quotation_id, "Quotation"))
+    await archive_document("quotation", quotation)
+    return quotation
 
 @api_router.delete("/quotations/{quotation_id}")
 async def delete_quotation(quotation_id: str):
     result = await db.quotations.delete_one({"id": quotation_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Quotation not found")
+    await record_change("quotations")
     return {"message": "Quotation deleted successfully"}
 
 # Letter Routes
-@api_router.get("/letters")
-async def get_letters():
-    letters = await db.letters.find().to_list(length=None)
-    return [Letter(**letter) for letter in letters]
+@api_router.get("/letters", response_model=List[Letter])
+async def get_letters(
+    request: Request,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+):
+    field_names, expand_company = sparse_options("letter", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_list_response("letter", request, created_range_filter(created_from, created_to), field_names, expand_company)
+    cached, headers = await list_validators(request, "letters")
+    if cached:
+        return cached
+    output_format = preferred_format(request)
+    if output_format:
+        return stream_documents(db.letters, created_range_filter(created_from, created_to), LETTER_DOCUMENT, output_format, headers=headers)
+    letters = await db.letters.find(created_range_filter(created_from, created_to), {"_id": 0}).to_list(length=None)
+    return list_response(LETTER_LIST, letters, headers)
 
 @api_router.post("/letters", status_code=201)
-async def create_letter(letter: LetterCreate):
-    letter_dict = letter.dict()
-    letter_dict["id"] = str(uuid.uuid4())
-    letter_dict["created_at"] = datetime.now(timezone.utc).isoformat()
-    letter_dict["signatories"] = [sig.dict() for sig in letter.signatories]
-    letter_dict["activities"] = [act.dict() for act in letter.activities]
-    await db.letters.insert_one(letter_dict)
+async def create_letter(letter: LetterCreate, request: Request):
+    letter_dict = await insert_numbered_document("letter", letter.dict(), new_letter_document)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(LETTER_DOCUMENT, letter_dict, status_code=201)
     return Letter(**letter_dict)
 
 @api_router.get("/letters/{letter_id}")
-async def get_letter(letter_id: str):
+async def get_letter(letter_id: str, request: Request, response: Response, fields: Optional[str] = None, expand: Optional[str] = None):
+    field_names, expand_company = sparse_options("letter", fields, expand)
+    if field_names is not None or expand_company:
+        return await sparse_document_response("letter", request, letter_id, field_names, expand_company)
     letter = await db.letters.find_one({"id": letter_id})
     if not letter:
         raise HTTPException(status_code=404, detail="Letter not found")
+    cached, headers = document_validators(request, letter)
+    if cached:
+        return cached
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(LETTER_DOCUMENT, letter, headers)
+    response.headers.update(headers)
     return Letter(**letter)
 
 @api_router.put("/letters/{letter_id}")
-async def update_letter(letter_id: str, letter: LetterCreate):
+async def update_letter(letter_id: str, letter: LetterCreate, request: Request, response: Response, if_match: Optional[str] = Header(None)):
     letter_dict = letter.dict()
     letter_dict["signatories"] = [sig.dict() for sig in letter.signatories]
     letter_dict["activities"] = [act.dict() for act in letter.activities]
-    result = await db.letters.update_one(
-        {"id": letter_id},
-        {"$set": letter_dict}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Letter not found")
-    
-    updated_letter = await db.letters.find_one({"id": letter_id})
+    if not letter_dict["letter_number"]:
+        del letter_dict["letter_number"]
+    letter_dict["updated_at"] = datetime.now(timezone.utc)
+    updated_letter = await update_document(db.letters, letter_id, {"$set": letter_dict, "$inc": {"version": 1}}, "Letter", if_match, letter_dict.get("letter_number"))
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(LETTER_DOCUMENT, updated_letter, version_headers(updated_letter))
+    set_version_etag(response, updated_letter)
+    return Letter(**updated_letter)
+
+@api_router.patch("/letters/{letter_id}")
+async def patch_letter(letter_id: str, patch: LetterPatch, request: Request, response: Response, if_match: Optional[str] = Header(None)):
+    projection, build = letter_patch_builder(letter_id, patch)
+    updated_letter = await apply_patch(db.letters, letter_id, "Letter", projection, if_match, build)
+    if preferred_format(request) == "msgpack":
+        return msgpack_response(LETTER_DOCUMENT, updated_letter, version_headers(updated_letter))
+    set_version_etag(response, updated_letter)
     return Letter(**updated_letter)
 
+@api_router.post("/letters/{letter_id}/finalize")
+async def finalize_letter(letter_id: str):
+    letter = await finalize_document(db.letters, letter_id, "Letter")
+    await archive_document("letter", letter)
+    return Letter(**letter)
+
 @api_router.delete("/letters/{letter_id}")
 async def delete_letter(letter_id: str):
     result = await db.letters.delete_one({"id": letter_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Letter not found")
+    await record_change("letters")
     return {"message": "Letter deleted successfully"}
 
-# Signature Upload Route
-@api_router.post("/upload-signature")
-async def upload_signature(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
+# Bulk Creation
+# Bulk routes take a JSON array, or NDJSON with one record per line. Records are
+# validated and numbered BULK_BATCH_SIZE at a time and each batch is written
+# with a single unordered insert_many, so a bad record only fails itself. The
+# response reports every record by its position in the request body.
+BULK_MAX_RECORDS = int(os.environ.get('BULK_MAX_RECORDS', '10000'))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '500'))
+
+# kind -> (collection, create model, document builder)
+BULK_KINDS = {
+    "item": ("items", ItemCreate, new_item_document),
+    "invoice": ("invoices", InvoiceCreate, lambda document: new_trade_document("invoice", document)),
+    "quotation": ("quotations", QuotationCreate, lambda document: new_trade_document("quotation", document)),
+    "letter": ("letters", LetterCreate, new_letter_document),
+}
+
+async def read_bulk_records(request: Request) -> list:
+    """Parse a JSON array or NDJSON body; unparsable NDJSON lines are kept as their error."""
+    body = await request.body()
+    media_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if media_type in NDJSON_MEDIA_TYPES:
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(orjson.loads(line))
+            except ValueError as exc:
+                records.append(exc)
+    else:
+        try:
+            records = orjson.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+        if not isinstance(records, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array or NDJSON records")
+    if len(records) > BULK_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_RECORDS} records can be created per request")
+    return records
+
+async def insert_bulk_batch(kind: str, batch: list, results: list):
+    collection, create_model, build = BULK_KINDS[kind]
+    number_field = DOCUMENT_KINDS[kind][2] if kind in DOCUMENT_KINDS else None
+    
+    valid = []
+    for index, record in batch:
+        if isinstance(record, ValueError):
+            results[index] = {"index": index, "status": "error", "detail": f"Invalid JSON: {record}"}
+            continue
+        try:
+            valid.append((index, create_model.model_validate(record).model_dump()))
+        except ValidationError as exc:
+            results[index] = {"index": index, "status": "error", "detail": json.loads(exc.json(include_url=False))}
+    
+    # Auto-numbered records that hit a number stored in the meantime are
+    # renumbered and inserted again; supplied numbers are never changed
+    auto_numbered = {index for index, document in valid if number_field and not document.get(number_field)}
+    created = 0
+    for attempt in range(NUMBER_ASSIGN_ATTEMPTS):
+        number_errors = await assign_document_numbers(kind, [document for _, document in valid]) if number_field else {}
+        prepared = []
+        for position, (index, document) in enumerate(valid):
+            if position in number_errors:
+                results[index] = {"index": index, "status": "error", "detail": number_errors[position]}
+            else:
+                prepared.append((index, document, build(dict(document))))
+        if not prepared:
+            break
         
-        # Validate image
+        write_errors = {}
         try:
-            img = Image.open(io.BytesIO(contents))
-            img.load()  # This will raise an exception if the image is invalid
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid image file")
+            await db[collection].insert_many([stored for _, _, stored in prepared], ordered=False)
+        except BulkWriteError as exc:
+            write_errors = {error['index']: error for error in exc.details.get('writeErrors', [])}
+        created += len(prepared) - len(write_errors)
+        valid = []
+        for position, (index, document, stored) in enumerate(prepared):
+            error = write_errors.get(position)
+            if error is None:
+                results[index] = {"index": index, "status": "created", "id": stored['id']}
+                if number_field:
+                    results[index][number_field] = stored[number_field]
+            elif error.get('code') != DUPLICATE_KEY_ERROR:
+                results[index] = {"index": index, "status": "error", "detail": error['errmsg']}
+            elif index in auto_numbered and attempt + 1 < NUMBER_ASSIGN_ATTEMPTS:
+                document[number_field] = ""
+                valid.append((index, document))
+            else:
+                results[index] = {"index": index, "status": "error", "detail": number_in_use(DOCUMENT_KINDS[kind][1], stored[number_field]).detail}
+        if not valid:
+            break
+    if created:
+        await record_change(collection)
+
+async def bulk_create(kind: str, request: Request) -> dict:
+    records = await read_bulk_records(request)
+    results = [None] * len(records)
+    for start in range(0, len(records), BULK_BATCH_SIZE):
+        batch = list(enumerate(records[start:start + BULK_BATCH_SIZE], start))
+        await insert_bulk_batch(kind, batch, results)
+    created = sum(1 for result in results if result['status'] == "created")
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+@api_router.post("/items/bulk")
+async def bulk_create_items(request: Request):
+    return await bulk_create("item", request)
+
+@api_router.post("/invoices/bulk")
+async def bulk_create_invoices(request: Request):
+    return await bulk_create("invoice", request)
+
+@api_router.post("/quotations/bulk")
+async def bulk_create_quotations(request: Request):
+    return await bulk_create("quotation", request)
+
+@api_router.post("/letters/bulk")
+async def bulk_create_letters(request: Request):
+    return await bulk_create("letter", request)
+
+# Bulk Updates
+# Each operation is one update_many/delete_many over the selection, so a
+# month-end run touches any number of documents in a single request. Finalized
+# documents are never modified or deleted; they stay with their archives.
+def bulk_selection_filter(selection: BulkSelection) -> dict:
+    query = created_range_filter(selection.created_from, selection.created_to)
+    if selection.ids is not None:
+        if len(selection.ids) > BULK_MAX_RECORDS:
+            raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_RECORDS} ids can be selected per request")
+        query["id"] = {"$in": selection.ids}
+    if selection.company_id:
+        query["company_id"] = selection.company_id
+    if selection.status:
+        query["status"] = selection.status
+    if not query:
+        raise HTTPException(status_code=400, detail="Select documents by ids or at least one filter")
+    return query
+
+async def bulk_delete(kind: str, body: BulkDelete) -> dict:
+    collection = BULK_KINDS[kind][0]
+    query = bulk_selection_filter(body.where)
+    skipped = []
+    if kind in DOCUMENT_KINDS:
+        skipped = await db[collection].distinct("id", {"$and": [query, {"finalized": True}]})
+        query = {"$and": [query, {"finalized": {"$ne": True}}]}
+    result = await db[collection].delete_many(query)
+    if result.deleted_count:
+        await record_change(collection)
+    return {"deleted": result.deleted_count, "skipped": skipped}
+
+async def bulk_set_status(kind: str, body: BulkStatusUpdate) -> dict:
+    collection = BULK_KINDS[kind][0]
+    query = {"$and": [bulk_selection_filter(body.where), {"finalized": {"$ne": True}}]}
+    result = await db[collection].update_many(query, {
+        "$set": {"status": body.status, "updated_at": datetime.now(timezone.utc)},
+        "$inc": {"version": 1},
+    })
+    if result.modified_count:
+        await record_change(collection)
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+async def bulk_reassign_company(kind: str, body: BulkCompanyReassign) -> dict:
+    """Move documents to another company, skipping those whose number the target already uses."""
+    collection, _, number_field = DOCUMENT_KINDS[kind]
+    if not await db.companies.find_one({"id": body.company_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    query = {"$and": [
+        bulk_selection_filter(body.where),
+        {"company_id": {"$ne": body.company_id}, "finalized": {"$ne": True}},
+    ]}
+    candidates = await db[collection].find(query, {"_id": 0, "id": 1, number_field: 1}).to_list(length=None)
+    numbers = list({doc[number_field] for doc in candidates if doc.get(number_field)})
+    used = set(await db[collection].distinct(number_field, {"company_id": body.company_id, number_field: {"$in": numbers}})) if numbers else set()
+    
+    movable, conflicts = [], []
+    for doc in candidates:
+        number = doc.get(number_field)
+        if number and number in used:
+            conflicts.append(doc['id'])
+            continue
+        movable.append(doc['id'])
+        if number:
+            used.add(number)
+    
+    modified = 0
+    if movable:
+        # One update per document so a number taken concurrently only fails
+        # that document against the unique number index
+        update = {
+            "$set": {"company_id": body.company_id, "updated_at": datetime.now(timezone.utc)},
+            "$inc": {"version": 1},
+        }
+        operations = [UpdateOne({"id": document_id, "finalized": {"$ne": True}}, update) for document_id in movable]
+        try:
+            result = await db[collection].bulk_write(operations, ordered=False)
+            modified = result.modified_count
+        except BulkWriteError as exc:
+            modified = exc.details.get('nModified', 0)
+            conflicts.extend(movable[error['index']] for error in exc.details.get('writeErrors', []))
+        if modified:
+            await record_change(collection)
+    return {"matched": len(candidates), "modified": modified, "conflicts": conflicts}
+
+@api_router.post("/items/bulk-delete")
+async def bulk_delete_items(body: BulkDelete):
+    return await bulk_delete("item", body)
+
+@api_router.post("/invoices/bulk-status")
+async def bulk_set_invoice_status(body: BulkStatusUpdate):
+    return await bulk_set_status("invoice", body)
+
+@api_router.post("/invoices/bulk-reassign")
+async def bulk_reassign_invoices(body: BulkCompanyReassign):
+    return await bulk_reassign_company("invoice", body)
+
+@api_router.post("/invoices/bulk-delete")
+async def bulk_delete_invoices(body: BulkDelete):
+    return await bulk_delete("invoice", body)
+
+@api_router.post("/quotations/bulk-status")
+async def bulk_set_quotation_status(body: BulkStatusUpdate):
+    return await bulk_set_status("quotation", body)
+
+@api_router.post("/quotations/bulk-reassign")
+async def bulk_reassign_quotations(body: BulkCompanyReassign):
+    return await bulk_reassign_company("quotation", body)
+
+@api_router.post("/quotations/bulk-delete")
+async def bulk_delete_quotations(body: BulkDelete):
+    return await bulk_delete("quotation", body)
+
+@api_router.post("/letters/bulk-reassign")
+async def bulk_reassign_letters(body: BulkCompanyReassign):
+    return await bulk_reassign_company("letter", body)
+
+@api_router.post("/letters/bulk-delete")
+async def bulk_delete_letters(body: BulkDelete):
+    return await bulk_delete("letter", body)
+
+# Batch Get
+# Fetches an id list with one $in query over the id index. Documents come back
+# in the order their ids were given (duplicates once) and ids that match
+# nothing are listed under "missing".
+BATCH_GET_MAX_IDS = int(os.environ.get('BATCH_GET_MAX_IDS', '1000'))
+
+async def batch_get(
+    request: Request,
+    collection: str,
+    ids: List[str],
+    adapter: TypeAdapter,
+    prepare: Optional[Callable[[List[dict]], Awaitable[List[dict]]]] = None,
+    projection: Optional[dict] = None,
+) -> Response:
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > BATCH_GET_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_GET_MAX_IDS} ids can be fetched per request")
+    
+    cursor = db[collection].find({"id": {"$in": ids}}, projection or {"_id": 0})
+    found = {document['id']: document async for document in cursor} if ids else {}
+    documents = [found[document_id] for document_id in ids if document_id in found]
+    if prepare:
+        documents = await prepare(documents)
+    missing = [document_id for document_id in ids if document_id not in found]
+    if preferred_format(request) == "msgpack":
+        content = msgpack.packb({"documents": adapter.dump_python(adapter.validate_python(documents), mode="json"), "missing": missing})
+        return Response(content=content, media_type=MSGPACK_MEDIA_TYPE)
+    content = b'{"documents":%s,"missing":%s}' % (adapter.dump_json(adapter.validate_python(documents)), orjson.dumps(missing))
+    return Response(content=content, media_type="application/json")
+
+async def batch_get_documents(kind: str, request: Request, ids: List[str], fields: Optional[str], expand: Optional[str]) -> Response:
+    field_names, expand_company = sparse_options(kind, fields, expand)
+    collection = DOCUMENT_KINDS[kind][0]
+    if field_names is None and not expand_company:
+        adapter = {"invoice": INVOICE_LIST, "quotation": QUOTATION_LIST, "letter": LETTER_LIST}[kind]
+        prepare = money_batch_from_storage if kind in TRADE_MODELS else None
+        return await batch_get(request, collection, ids, adapter, prepare)
+    prepare = lambda documents: shape_documents(kind, documents, field_names, expand_company)
+    return await batch_get(request, collection, ids, DOCUMENT_VIEWS[kind][1], prepare, sparse_projection(kind, field_names, expand_company))
+
+@api_router.post("/companies/batch-get")
+async def batch_get_companies(body: BatchGet, request: Request):
+    return await batch_get(request, "companies", body.ids, COMPANY_LIST)
+
+@api_router.post("/items/batch-get")
+async def batch_get_items(body: BatchGet, request: Request):
+    return await batch_get(request, "items", body.ids, ITEM_LIST)
+
+@api_router.post("/invoices/batch-get")
+async def batch_get_invoices(body: BatchGet, request: Request, fields: Optional[str] = None, expand: Optional[str] = None):
+    return await batch_get_documents("invoice", request, body.ids, fields, expand)
+
+@api_router.post("/quotations/batch-get")
+async def batch_get_quotations(body: BatchGet, request: Request, fields: Optional[str] = None, expand: Optional[str] = None):
+    return await batch_get_documents("quotation", request, body.ids, fields, expand)
+
+@api_router.post("/letters/batch-get")
+async def batch_get_letters(body: BatchGet, request: Request, fields: Optional[str] = None, expand: Optional[str] = None):
+    return await batch_get_documents("letter", request, body.ids, fields, expand)
+
+# Signature Upload Route
+# A request body that cannot fit SIGNATURE_MAX_BYTES plus multipart framing is
+# refused with 413 by RequestBodyLimitMiddleware before Starlette parses and
+# spools it. Uploads are read back from the multipart spool in chunks up to
+# SIGNATURE_MAX_BYTES. The image header is checked against SIGNATURE_MAX_PIXELS
+# before anything is decoded, and decoding and re-encoding to a bounded PNG run
+# in the threadpool. The PNG is stored once as binary in db.signatures, keyed
+# by its SHA-256, and letters reference it by URL instead of embedding a data
+# URI. Renderers inline referenced signatures when they draw the letter.
+SIGNATURE_MAX_BYTES = int(os.environ.get('SIGNATURE_MAX_BYTES', str(2 * 1024 * 1024)))
+SIGNATURE_MAX_PIXELS = int(os.environ.get('SIGNATURE_MAX_PIXELS', str(4096 * 4096)))
+SIGNATURE_READ_CHUNK = 64 * 1024
+# Boundaries and part headers around the file
+MULTIPART_OVERHEAD_BYTES = 16 * 1024
+SIGNATURE_FORMATS = {'PNG', 'JPEG', 'WEBP', 'GIF'}
+# Signatures are drawn at up to 160x80pt; keep 4x that for print
+SIGNATURE_MAX_SIZE = (640, 320)
+SIGNATURE_REFERENCE = re.compile(r"/signatures/([0-9a-f]{64})$")
+
+# path -> largest request body accepted
+REQUEST_BODY_LIMITS = {
+    "/api/upload-signature": SIGNATURE_MAX_BYTES + MULTIPART_OVERHEAD_BYTES,
+}
+
+class RequestBodyLimitMiddleware:
+    """Refuses oversized bodies on REQUEST_BODY_LIMITS paths with 413 before they are read.
+
+    A declared Content-Length over the limit is rejected outright; bodies
+    without one are counted as they are received.
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        limit = REQUEST_BODY_LIMITS.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body must be at most {limit // 1024} KB"
+        try:
+            declared = int(Headers(scope=scope).get('content-length', '0'))
+        except ValueError:
+            declared = 0
+        if declared > limit:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
         
-        # Convert to base64
-        base64_image = base64.b64encode(contents).decode('utf-8')
-        mime_type = file.content_type or 'image/png'
-        data_uri = f"data:{mime_type};base64,{base64_image}"
+        received = 0
         
-        return {"signature": data_uri}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        async def receive_limited():
+            nonlocal received
+            if received > limit:
+                # The rest of the body is refused; outer middlewares draining
+                # it after the 413 see the end of the request instead
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, receive_limited, send)
+
+async def read_upload(file: UploadFile, limit: int) -> bytes:
+    chunks, size = [], 0
+    while chunk := await file.read(SIGNATURE_READ_CHUNK):
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=f"File must be at most {limit // 1024} KB")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def prepare_signature(contents: bytes) -> Tuple[bytes, int, int]:
+    """Validate an uploaded image and re-encode it as a bounded PNG."""
+    try:
+        # Only the header is read here, nothing is decoded yet
+        img = Image.open(io.BytesIO(contents))
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    if img.format not in SIGNATURE_FORMATS:
+        raise HTTPException(status_code=400, detail="Signature must be a PNG, JPEG, WebP or GIF image")
+    if img.width * img.height > SIGNATURE_MAX_PIXELS:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+    try:
+        img.load()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA")
+    img.thumbnail(SIGNATURE_MAX_SIZE, Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, "PNG", optimize=True)
+    return output.getvalue(), img.width, img.height
+
+async def inline_signatures(letter: dict) -> dict:
+    """Copy of letter with stored signature references replaced by data URIs for rendering."""
+    references = {}
+    for sig in letter.get('signatories') or []:
+        match = SIGNATURE_REFERENCE.search(sig.get('signature_image') or '')
+        if match:
+            references[sig['signature_image']] = match.group(1)
+    if not references:
+        return letter
+    
+    cursor = db.signatures.find({"id": {"$in": list(set(references.values()))}}, {"_id": 0, "id": 1, "content_type": 1, "data": 1})
+    images = {
+        signature['id']: f"data:{signature['content_type']};base64,{base64.b64encode(signature['data']).decode('ascii')}"
+        async for signature in cursor
+    }
+    signatories = [
+        {**sig, "signature_image": images.get(references.get(sig.get('signature_image')), sig.get('signature_image'))}
+        for sig in letter['signatories']
+    ]
+    return {**letter, "signatories": signatories}
+
+@api_router.post("/upload-signature")
+async def upload_signature(request: Request, file: UploadFile = File(...)):
+    contents = await read_upload(file, SIGNATURE_MAX_BYTES)
+    png, width, height = await run_in_threadpool(prepare_signature, contents)
+    
+    signature_id = hashlib.sha256(png).hexdigest()
+    await db.signatures.update_one(
+        {"id": signature_id},
+        {"$setOnInsert": {
+            "id": signature_id,
+            "content_type": "image/png",
+            "data": png,
+            "size": len(png),
+            "width": width,
+            "height": height,
+            "created_at": datetime.now(timezone.utc),
+        }},
+        upsert=True,
+    )
+    # Stored in letters as is, so it must not pin the host the upload came in on
+    return {"id": signature_id, "signature": str(request.app.url_path_for("get_signature", signature_id=signature_id))}
+
+@api_router.get("/signatures/{signature_id}")
+async def get_signature(signature_id: str):
+    signature = await db.signatures.find_one({"id": signature_id}, {"_id": 0, "content_type": 1, "data": 1})
+    if not signature:
+        raise HTTPException(status_code=404, detail="Signature not found")
+    # Content-addressed, so the bytes behind a URL never change
+    return Response(content=bytes(signature['data']), media_type=signature['content_type'], headers={
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "ETag": '"%s"' % signature_id,
+    })
 
 # PDF Generation Routes
-def format_currency(amount: float, currency: str) -> str:
+def format_currency(amount: Decimal, currency: str) -> str:
     if currency == "IDR":
         return f"Rp {amount:,.0f}"
     elif currency == "USD":
@@ -508,21 +2135,270 @@ def format_currency(amount: float, currency: str) -> str:
     else:
         return f"{currency} {amount:,.2f}"
 
-@api_router.get("/invoices/{invoice_id}/pdf")
-async def generate_invoice_pdf(invoice_id: str):
-    invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
+# PDF Fonts
+# Base-14 fonts are referenced by name and never embedded, and only cover
+# WinAnsi, so documents whose text fits WinAnsi use them. A configured TrueType
+# family is subset-embedded only for text outside it (and always for archival
+# output), in every variant. Families are parsed and registered
+# once per worker at import; ReportLab then keeps per-document subset state on
+# each registered face, so requests never re-parse a font file. The Bitstream
+# Vera family bundled with ReportLab is the embedded fallback for archives.
+BASE14_FONTS = {'regular': 'Helvetica', 'bold': 'Helvetica-Bold', 'italic': 'Helvetica-Oblique', 'bold_italic': 'Helvetica-BoldOblique'}
+FONT_ROLES = {name: role for role, name in BASE14_FONTS.items()}
+# File name suffixes tried per role, covering DejaVu, Noto and Vera naming
+FONT_FILE_SUFFIXES = {
+    'regular': ('', '-Regular', '-Roman', '-Book'),
+    'bold': ('-Bold', 'Bd'),
+    'italic': ('-Oblique', '-Italic', 'It'),
+    'bold_italic': ('-BoldOblique', '-BoldItalic', 'BI'),
+}
+# Missing faces fall back to the closest registered one
+FONT_ROLE_FALLBACKS = {'bold': 'regular', 'italic': 'regular', 'bold_italic': 'bold'}
+
+PDF_FONT_FAMILIES = [f.strip() for f in os.environ.get('PDF_FONT_FAMILIES', 'DejaVuSans').split(',') if f.strip()]
+PDF_FONT_DIRS = [Path(d) for d in os.environ.get('PDF_FONT_DIRS', os.pathsep.join([str(ROOT_DIR / 'fonts'), '/usr/share/fonts'])).split(os.pathsep) if d]
+ARCHIVE_FALLBACK_FAMILY = 'Vera'
+
+registered_font_families: dict = {}
+
+def index_font_files() -> dict:
+    font_files = {}
+    for font_dir in PDF_FONT_DIRS + [Path(reportlab.__file__).parent / 'fonts']:
+        if font_dir.is_dir():
+            for path in font_dir.rglob('*.ttf'):
+                font_files.setdefault(path.stem, path)
+    return font_files
+
+def register_font_family(family: str, font_files: dict) -> Optional[dict]:
+    paths = {}
+    for role, suffixes in FONT_FILE_SUFFIXES.items():
+        for suffix in suffixes:
+            if family + suffix in font_files:
+                paths[role] = font_files[family + suffix]
+                break
+    if 'regular' not in paths:
+        return None
     
-    company = await db.companies.find_one({"id": invoice['company_id']}, {"_id": 0})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company not found")
+    fonts = {}
+    for role in ('regular', 'bold', 'italic', 'bold_italic'):
+        if role in paths:
+            fonts[role] = f"{family}-{role}"
+            pdfmetrics.registerFont(TTFont(fonts[role], str(paths[role])))
+        else:
+            fonts[role] = fonts[FONT_ROLE_FALLBACKS[role]]
+    # Lets <b>/<i> markup inside Paragraphs resolve to the right face
+    pdfmetrics.registerFontFamily(family, normal=fonts['regular'], bold=fonts['bold'], italic=fonts['italic'], boldItalic=fonts['bold_italic'])
+    return fonts
+
+def register_pdf_fonts():
+    font_files = index_font_files()
+    for family in PDF_FONT_FAMILIES + [ARCHIVE_FALLBACK_FAMILY]:
+        if family in registered_font_families:
+            continue
+        fonts = register_font_family(family, font_files)
+        if fonts:
+            registered_font_families[family] = fonts
+        else:
+            logging.getLogger(__name__).warning("PDF font family %s not found in %s", family, PDF_FONT_DIRS)
+
+register_pdf_fonts()
+
+def needs_embedded_font(*sources: dict) -> bool:
+    """Whether any text in ``sources`` falls outside WinAnsi."""
+    pending = list(sources)
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+        elif isinstance(value, str) and not value.isascii():
+            try:
+                value.encode('cp1252')
+            except UnicodeEncodeError:
+                return True
+    return False
+
+def pdf_fonts(variant: str, *sources: dict) -> dict:
+    """Fonts for rendering ``sources`` (the document and its company) as ``variant``."""
+    if variant != "archive" and not needs_embedded_font(*sources):
+        return BASE14_FONTS
+    for family in PDF_FONT_FAMILIES:
+        if family in registered_font_families:
+            return registered_font_families[family]
+    # Archival output must embed every font, so never fall back to base-14
+    if variant == "archive":
+        return registered_font_families[ARCHIVE_FALLBACK_FAMILY]
+    return BASE14_FONTS
+
+def pdf_stylesheet(fonts: dict):
+    styles = getSampleStyleSheet()
+    if fonts is BASE14_FONTS:
+        return styles
+    for style in styles.byName.values():
+        for attr in ('fontName', 'bulletFontName'):
+            role = FONT_ROLES.get(getattr(style, attr, None))
+            if role:
+                setattr(style, attr, fonts[role])
+    return styles
+
+# PDF Output Variants
+# Both variants embed images resampled to the size they are drawn at.
+# "standard" embeds them losslessly; "email" picks JPEG or flate per image,
+# whichever is smaller, and recompresses merged content streams. Both pick
+# fonts the same way (see pdf_fonts), so they render the same text.
+PDF_VARIANTS = ("standard", "email")
+EMAIL_JPEG_QUALITY = int(os.environ.get('EMAIL_JPEG_QUALITY', '80'))
+
+# ASCII85 only inflates already-deflated streams by a quarter
+rl_config.useA85 = 0
+
+def validate_pdf_variant(variant: str):
+    if variant not in PDF_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Unsupported PDF variant: {variant}")
+
+def pdf_image_buffer(img: Image.Image, variant: str) -> io.BytesIO:
+    buffer = io.BytesIO()
+    if variant == "email":
+        # JPEG has no alpha channel, so flatten onto the white page first
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            flattened = Image.new('RGB', img.size, 'white')
+            flattened.paste(img, mask=img.getchannel('A'))
+            img = flattened
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(buffer, format='JPEG', quality=EMAIL_JPEG_QUALITY, optimize=True)
+        # Flat-colour artwork deflates better than it JPEG-encodes; ReportLab
+        # embeds JPEGs as-is and deflates raw pixels for everything else
+        if buffer.tell() < len(zlib.compress(img.tobytes(), 9)):
+            buffer.seek(0)
+            return buffer
+        buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+# PDF Base Cache & Status Overlay
+# Invoices and quotations are laid out once without their status; the status
+# value and watermark stamp are drawn on a separate overlay page and merged in.
+PDF_BASE_CACHE_SIZE = int(os.environ.get('PDF_BASE_CACHE_SIZE', '256'))
+pdf_base_cache: "OrderedDict[Tuple[str, str, str, str], Tuple[bytes, dict]]" = OrderedDict()
+# Renders run on the event loop, in background tasks and in the threadpool
+render_cache_lock = threading.Lock()
+
+# Fields that only affect the overlay and must not invalidate the cached base
+OVERLAY_FIELDS = {'status'}
+BASE_EXCLUDED_FIELDS = OVERLAY_FIELDS | FINALIZE_EXCLUDED_FIELDS
+
+class StatusAnchor(Flowable):
+    """Zero-size marker placed in the status cell to record where the overlay draws the value."""
+    def __init__(self, anchor: dict, font_size: float = 10, leading: float = 12):
+        Flowable.__init__(self)
+        self.anchor = anchor
+        self.font_size = font_size
+        self.leading = leading
+        self.width = self.height = 0
+
+    def wrap(self, availWidth, availHeight):
+        return (0, 0)
+
+    def draw(self):
+        x, y = self.canv.absolutePosition(0, 0)
+        # Match the baseline ReportLab uses for bottom-aligned string cells
+        self.anchor.update(page=self.canv.getPageNumber() - 1, x=x, y=y + self.leading - self.font_size, font_size=self.font_size)
+
+def base_fingerprint(document: dict, company: dict) -> str:
+    payload = {
+        'document': {k: v for k, v in document.items() if k not in BASE_EXCLUDED_FIELDS},
+        'company': {k: v for k, v in company.items() if k not in BASE_EXCLUDED_FIELDS},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_base_pdf(kind: str, document: dict, company: dict, render: Callable[[dict, dict, str], Tuple[bytes, dict]], variant: str = "standard") -> Tuple[bytes, dict]:
+    key = (kind, document['id'], variant, base_fingerprint(document, company))
+    with render_cache_lock:
+        cached = pdf_base_cache.get(key)
+        if cached is not None:
+            pdf_base_cache.move_to_end(key)
+            return cached
     
+    rendered = render(document, company, variant)
+    with render_cache_lock:
+        # Drop stale layouts of the same document before caching the new one
+        for stale_key in [k for k in pdf_base_cache if k[:3] == key[:3]]:
+            del pdf_base_cache[stale_key]
+        pdf_base_cache[key] = rendered
+        while len(pdf_base_cache) > PDF_BASE_CACHE_SIZE:
+            pdf_base_cache.popitem(last=False)
+    return rendered
+
+def invoice_watermark(invoice: dict) -> Optional[str]:
+    status = invoice.get('status', 'draft')
+    if status == 'draft':
+        return "DRAFT"
+    if status == 'paid':
+        return "LUNAS / PAID"
+    return None
+
+def quotation_watermark(quotation: dict) -> Optional[str]:
+    status = quotation.get('status', 'draft')
+    if status == 'accepted':
+        return None
+    valid_until = valid_until_date(quotation)
+    if valid_until and valid_until < datetime.now(timezone.utc).date():
+        return "EXPIRED"
+    if status == 'draft':
+        return "DRAFT"
+    return None
+
+def apply_status_overlay(base_pdf: bytes, anchor: dict, status_text: str, watermark: Optional[str], compress: bool = False) -> bytes:
+    reader = PdfReader(io.BytesIO(base_pdf))
+    # Drawn in the family the base was laid out with
+    fonts = anchor.get('fonts', BASE14_FONTS)
+    
+    overlay_buffer = io.BytesIO()
+    overlay = canvas.Canvas(overlay_buffer, pagesize=A4, initialFontName=fonts['regular'])
+    page_width, page_height = A4
+    for page_index in range(len(reader.pages)):
+        if page_index == anchor.get('page'):
+            overlay.setFont(fonts['regular'], anchor.get('font_size', 10))
+            overlay.setFillColor(colors.black)
+            overlay.drawString(anchor['x'], anchor['y'], status_text)
+        if watermark:
+            overlay.saveState()
+            overlay.setFont(fonts['bold'], 72)
+            overlay.setFillColor(colors.HexColor('#dc2626'), alpha=0.12)
+            overlay.translate(page_width / 2, page_height / 2)
+            overlay.rotate(45)
+            overlay.drawCentredString(0, -24, watermark)
+            overlay.restoreState()
+        overlay.showPage()
+    overlay.save()
+    overlay_buffer.seek(0)
+    overlay_reader = PdfReader(overlay_buffer)
+    
+    writer = PdfWriter()
+    for page, overlay_page in zip(reader.pages, overlay_reader.pages):
+        page.merge_page(overlay_page)
+        writer.add_page(page)
+    if compress:
+        # Merging leaves the combined content stream uncompressed
+        for page in writer.pages:
+            page.compress_content_streams()
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+def render_invoice_base(invoice: dict, company: dict, variant: str = "standard") -> Tuple[bytes, dict]:
     buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
+    fonts = pdf_fonts(variant, invoice, company)
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50, initialFontName=fonts['regular'])
     
     story = []
-    styles = getSampleStyleSheet()
+    styles = pdf_stylesheet(fonts)
     
     # Header
     header_style = ParagraphStyle('header', parent=styles['Heading1'], fontSize=24, textColor=colors.HexColor('#1e40af'), alignment=TA_CENTER)
@@ -543,9 +2419,7 @@ async def generate_invoice_pdf(invoice_id: str):
             max_width, max_height = 100, 100
             logo_img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
             
-            logo_buffer = io.BytesIO()
-            logo_img.save(logo_buffer, format='PNG')
-            logo_buffer.seek(0)
+            logo_buffer = pdf_image_buffer(logo_img, variant)
             
             logo = RLImage(logo_buffer, width=logo_img.width, height=logo_img.height)
             
@@ -563,6 +2437,7 @@ async def generate_invoice_pdf(invoice_id: str):
             
             header_table = Table([[logo, company_info_para]], colWidths=[120, 350])
             header_table.setStyle(TableStyle([
+                ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
                 ('VALIGN', (0, 0), (-1, -1), 'TOP'),
                 ('ALIGN', (0, 0), (0, 0), 'LEFT'),
                 ('LEFTPADDING', (0, 0), (-1, -1), 0),
@@ -587,15 +2462,17 @@ async def generate_invoice_pdf(invoice_id: str):
     
     story.append(Spacer(1, 20))
     
-    # Invoice Info
+    # Invoice Info (status value is drawn by the overlay at the anchor)
+    status_anchor = {'fonts': fonts}
     info_data = [
         ["Invoice Number:", invoice['invoice_number'], "Date:", invoice['date']],
-        ["Status:", invoice.get('status', 'draft').title(), "Due Date:", invoice.get('due_date', '-')],
+        ["Status:", StatusAnchor(status_anchor), "Due Date:", invoice.get('due_date', '-')],
     ]
     info_table = Table(info_data, colWidths=[100, 200, 80, 120])
     info_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
+        ('FONTNAME', (0, 0), (0, -1), fonts['bold']),
+        ('FONTNAME', (2, 0), (2, -1), fonts['bold']),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
     ]))
@@ -604,7 +2481,7 @@ async def generate_invoice_pdf(invoice_id: str):
     
     # Client Information Section
     client_style = ParagraphStyle('client', parent=styles['Normal'], fontSize=10, leading=14)
-    client_title_style = ParagraphStyle('client_title', parent=styles['Normal'], fontSize=11, fontName='Helvetica-Bold', spaceAfter=8)
+    client_title_style = ParagraphStyle('client_title', parent=styles['Normal'], fontSize=11, fontName=fonts['bold'], spaceAfter=8)
     
     story.append(Paragraph("<b>Bill To:</b>", client_title_style))
     story.append(Paragraph(f"<b>{invoice['client_name']}</b>", client_style))
@@ -635,11 +2512,12 @@ async def generate_invoice_pdf(invoice_id: str):
     
     items_table = Table(items_data, colWidths=[120, 150, 60, 80, 90])
     items_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1e40af')),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
         ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
         ('ALIGN', (2, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 0), (-1, 0), fonts['bold']),
         ('FONTSIZE', (0, 0), (-1, 0), 10),
         ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
         ('GRID', (0, 0), (-1, -1), 1, colors.grey),
@@ -660,11 +2538,12 @@ async def generate_invoice_pdf(invoice_id: str):
     
     summary_table = Table(summary_data, colWidths=[350, 150])
     summary_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
         ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
         ('LINEABOVE', (0, -1), (-1, -1), 2, colors.HexColor('#1e40af')),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), fonts['bold']),
         ('FONTSIZE', (0, -1), (-1, -1), 12),
     ]))
     story.append(summary_table)
@@ -693,27 +2572,40 @@ async def generate_invoice_pdf(invoice_id: str):
             story.append(Paragraph(invoice['signature_position'], signature_style))
     
     doc.build(story)
-    buffer.seek(0)
-    
-    return StreamingResponse(buffer, media_type="application/pdf", headers={
-        "Content-Disposition": f"attachment; filename=invoice_{invoice['invoice_number']}.pdf"
-    })
+    return buffer.getvalue(), status_anchor
 
-@api_router.get("/quotations/{quotation_id}/pdf")
-async def generate_quotation_pdf(quotation_id: str):
-    quotation = await db.quotations.find_one({"id": quotation_id}, {"_id": 0})
-    if not quotation:
-        raise HTTPException(status_code=404, detail="Quotation not found")
+@api_router.get("/invoices/{invoice_id}/pdf")
+async def generate_invoice_pdf(invoice_id: str, request: Request, background_tasks: BackgroundTasks, variant: str = "standard"):
+    validate_pdf_variant(variant)
+    invoice = money_from_storage(await db.invoices.find_one({"id": invoice_id}, {"_id": 0}))
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
     
-    company = await db.companies.find_one({"id": quotation['company_id']}, {"_id": 0})
+    company = await db.companies.find_one({"id": invoice['company_id']}, {"_id": 0})
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
+    cached, headers = rendering_validators(request, invoice, company)
+    if cached:
+        return cached
+    
+    pdf_bytes = build_document_pdf("invoice", invoice, company, variant)
+    if variant == "standard":
+        queue_thumbnail(background_tasks, "invoice", invoice, company, pdf_bytes)
+    
+    response = StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers={
+        "Content-Disposition": f"attachment; filename=invoice_{invoice['invoice_number']}.pdf"
+    })
+    response.headers.update(headers)
+    return response
+
+def render_quotation_base(quotation: dict, company: dict, variant: str = "standard") -> Tuple[bytes, dict]:
     buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
+    fonts = pdf_fonts(variant, quotation, company)
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50, initialFontName=fonts['regular'])
     
     story = []
-    styles = getSampleStyleSheet()
+    styles = pdf_stylesheet(fonts)
     
     # Header
     header_style = ParagraphStyle('header', parent=styles['Heading1'], fontSize=24, textColor=colors.HexColor('#059669'), alignment=TA_CENTER)
@@ -734,9 +2626,7 @@ async def generate_quotation_pdf(quotation_id: str):
             max_width, max_height = 100, 100
             logo_img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
             
-            logo_buffer = io.BytesIO()
-            logo_img.save(logo_buffer, format='PNG')
-            logo_buffer.seek(0)
+            logo_buffer = pdf_image_buffer(logo_img, variant)
             
             logo = RLImage(logo_buffer, width=logo_img.width, height=logo_img.height)
             
@@ -754,6 +2644,7 @@ async def generate_quotation_pdf(quotation_id: str):
             
             header_table = Table([[logo, company_info_para]], colWidths=[120, 350])
             header_table.setStyle(TableStyle([
+                ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
                 ('VALIGN', (0, 0), (-1, -1), 'TOP'),
                 ('ALIGN', (0, 0), (0, 0), 'LEFT'),
                 ('LEFTPADDING', (0, 0), (-1, -1), 0),
@@ -778,15 +2669,17 @@ async def generate_quotation_pdf(quotation_id: str):
     
     story.append(Spacer(1, 20))
     
-    # Quotation Info
+    # Quotation Info (status value is drawn by the overlay at the anchor)
+    status_anchor = {'fonts': fonts}
     info_data = [
         ["Quotation Number:", quotation['quotation_number'], "Date:", quotation['date']],
-        ["Status:", quotation.get('status', 'draft').title(), "Valid Until:", quotation.get('valid_until', '-')],
+        ["Status:", StatusAnchor(status_anchor), "Valid Until:", quotation.get('valid_until', '-')],
     ]
     info_table = Table(info_data, colWidths=[120, 180, 80, 120])
     info_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
+        ('FONTNAME', (0, 0), (0, -1), fonts['bold']),
+        ('FONTNAME', (2, 0), (2, -1), fonts['bold']),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
     ]))
@@ -795,7 +2688,7 @@ async def generate_quotation_pdf(quotation_id: str):
     
     # Client Information Section
     client_style = ParagraphStyle('client', parent=styles['Normal'], fontSize=10, leading=14)
-    client_title_style = ParagraphStyle('client_title', parent=styles['Normal'], fontSize=11, fontName='Helvetica-Bold', spaceAfter=8)
+    client_title_style = ParagraphStyle('client_title', parent=styles['Normal'], fontSize=11, fontName=fonts['bold'], spaceAfter=8)
     
     story.append(Paragraph("<b>Bill To:</b>", client_title_style))
     story.append(Paragraph(f"<b>{quotation['client_name']}</b>", client_style))
@@ -826,11 +2719,12 @@ async def generate_quotation_pdf(quotation_id: str):
     
     items_table = Table(items_data, colWidths=[120, 150, 60, 80, 90])
     items_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#059669')),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
         ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
         ('ALIGN', (2, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 0), (-1, 0), fonts['bold']),
         ('FONTSIZE', (0, 0), (-1, 0), 10),
         ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
         ('GRID', (0, 0), (-1, -1), 1, colors.grey),
@@ -851,11 +2745,12 @@ async def generate_quotation_pdf(quotation_id: str):
     
     summary_table = Table(summary_data, colWidths=[350, 150])
     summary_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
         ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
         ('LINEABOVE', (0, -1), (-1, -1), 2, colors.HexColor('#059669')),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), fonts['bold']),
         ('FONTSIZE', (0, -1), (-1, -1), 12),
     ]))
     story.append(summary_table)
@@ -884,32 +2779,45 @@ async def generate_quotation_pdf(quotation_id: str):
             story.append(Paragraph(quotation['signature_position'], signature_style))
     
     doc.build(story)
-    buffer.seek(0)
-    
-    return StreamingResponse(buffer, media_type="application/pdf", headers={
-        "Content-Disposition": f"attachment; filename=quotation_{quotation['quotation_number']}.pdf"
-    })
+    return buffer.getvalue(), status_anchor
 
-# Letter PDF Generation
-@api_router.get("/letters/{letter_id}/pdf")
-async def generate_letter_pdf(letter_id: str):
-    letter = await db.letters.find_one({"id": letter_id})
-    if not letter:
-        raise HTTPException(status_code=404, detail="Letter not found")
+@api_router.get("/quotations/{quotation_id}/pdf")
+async def generate_quotation_pdf(quotation_id: str, request: Request, background_tasks: BackgroundTasks, variant: str = "standard"):
+    validate_pdf_variant(variant)
+    quotation = money_from_storage(await db.quotations.find_one({"id": quotation_id}, {"_id": 0}))
+    if not quotation:
+        raise HTTPException(status_code=404, detail="Quotation not found")
     
-    company = await db.companies.find_one({"id": letter['company_id']})
+    company = await db.companies.find_one({"id": quotation['company_id']}, {"_id": 0})
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
+    cached, headers = rendering_validators(request, quotation, company)
+    if cached:
+        return cached
+    
+    pdf_bytes = build_document_pdf("quotation", quotation, company, variant)
+    if variant == "standard":
+        queue_thumbnail(background_tasks, "quotation", quotation, company, pdf_bytes)
+    
+    response = StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers={
+        "Content-Disposition": f"attachment; filename=quotation_{quotation['quotation_number']}.pdf"
+    })
+    response.headers.update(headers)
+    return response
+
+# Letter PDF Generation
+def render_letter_base(letter: dict, company: dict, variant: str = "standard") -> Tuple[bytes, dict]:
     buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
+    fonts = pdf_fonts(variant, letter, company)
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch, initialFontName=fonts['regular'])
     story = []
-    styles = getSampleStyleSheet()
+    styles = pdf_stylesheet(fonts)
     
     # Company Header with Logo (Kop Surat) - Centered Layout
     company_style = ParagraphStyle('company', parent=styles['Normal'], fontSize=11, alignment=TA_CENTER)
     company_name_style = ParagraphStyle('company_name', parent=styles['Normal'], fontSize=14, alignment=TA_CENTER, spaceAfter=4)
-    company_motto_style = ParagraphStyle('company_motto', parent=styles['Normal'], fontSize=9, alignment=TA_CENTER, textColor=colors.HexColor('#666666'), fontName='Helvetica-Oblique')
+    company_motto_style = ParagraphStyle('company_motto', parent=styles['Normal'], fontSize=9, alignment=TA_CENTER, textColor=colors.HexColor('#666666'), fontName=fonts['italic'])
     
     # Add logo if available (centered) - Increased size for better visibility
     if company.get('logo'):
@@ -922,15 +2830,14 @@ async def generate_letter_pdf(letter_id: str):
             max_width, max_height = 100, 100
             logo_img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
             
-            logo_buffer = io.BytesIO()
-            logo_img.save(logo_buffer, format='PNG')
-            logo_buffer.seek(0)
+            logo_buffer = pdf_image_buffer(logo_img, variant)
             
             logo = RLImage(logo_buffer, width=logo_img.width, height=logo_img.height)
             
             # Center logo in table
             logo_table = Table([[logo]], colWidths=[500])
             logo_table.setStyle(TableStyle([
+                ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
                 ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
             ]))
             story.append(logo_table)
@@ -955,6 +2862,7 @@ async def generate_letter_pdf(letter_id: str):
     story.append(Spacer(1, 10))
     separator_table = Table([['']], colWidths=[500])
     separator_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
         ('LINEABOVE', (0, 0), (-1, 0), 2, colors.HexColor('#000000')),
         ('LINEBELOW', (0, 0), (-1, 0), 1, colors.HexColor('#000000')),
     ]))
@@ -1028,12 +2936,12 @@ async def generate_letter_pdf(letter_id: str):
             # Header styling
             ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#e5e7eb')),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTNAME', (0, 0), (-1, 0), fonts['bold']),
             ('FONTSIZE', (0, 0), (-1, 0), 9),
             ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
             
             # Body styling
-            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+            ('FONTNAME', (0, 1), (-1, -1), fonts['regular']),
             ('FONTSIZE', (0, 1), (-1, -1), 8),
             ('ALIGN', (0, 1), (0, -1), 'CENTER'),  # No. column centered
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
@@ -1087,9 +2995,7 @@ async def generate_letter_pdf(letter_id: str):
                     max_sig_width, max_sig_height = 160, 80
                     sig_img_pil.thumbnail((max_sig_width, max_sig_height), Image.Resampling.LANCZOS)
                     
-                    sig_img_buffer = io.BytesIO()
-                    sig_img_pil.save(sig_img_buffer, format='PNG')
-                    sig_img_buffer.seek(0)
+                    sig_img_buffer = pdf_image_buffer(sig_img_pil, variant)
                     
                     sig_image = RLImage(sig_img_buffer, width=sig_img_pil.width, height=sig_img_pil.height)
                     sig_content.append(sig_image)
@@ -1107,6 +3013,7 @@ async def generate_letter_pdf(letter_id: str):
         # Create signature table
         sig_table = Table([sig_data], colWidths=sig_widths)
         sig_table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), fonts['regular']),
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
             ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
         ]))
@@ -1122,15 +3029,1000 @@ async def generate_letter_pdf(letter_id: str):
                 story.append(Paragraph(f"- {cc.strip()}", styles['Normal']))
     
     doc.build(story)
-    buffer.seek(0)
+    # Letters carry no status, so there is nothing for an overlay to anchor to
+    return buffer.getvalue(), {}
+
+@api_router.get("/letters/{letter_id}/pdf")
+async def generate_letter_pdf(letter_id: str, request: Request, background_tasks: BackgroundTasks, variant: str = "standard"):
+    validate_pdf_variant(variant)
+    letter = await db.letters.find_one({"id": letter_id}, {"_id": 0})
+    if not letter:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    
+    company = await db.companies.find_one({"id": letter['company_id']}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
     
-    return StreamingResponse(buffer, media_type="application/pdf", headers={
+    cached, headers = rendering_validators(request, letter, company)
+    if cached:
+        return cached
+    
+    pdf_bytes = build_document_pdf("letter", await inline_signatures(letter), company, variant)
+    if variant == "standard":
+        queue_thumbnail(background_tasks, "letter", letter, company, pdf_bytes)
+    
+    response = StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers={
         "Content-Disposition": f"attachment; filename=letter_{letter['letter_number'].replace('/', '_')}.pdf"
     })
+    response.headers.update(headers)
+    return response
+
+# Document Rendering Pipeline
+PDF_RENDERERS = {
+    "invoice": render_invoice_base,
+    "quotation": render_quotation_base,
+    "letter": render_letter_base,
+}
+
+def pdf_overlay_state(kind: str, document: dict) -> Optional[Tuple[str, Optional[str]]]:
+    if kind == "invoice":
+        return document.get('status', 'draft').title(), invoice_watermark(document)
+    if kind == "quotation":
+        return document.get('status', 'draft').title(), quotation_watermark(document)
+    return None
+
+def build_document_pdf(kind: str, document: dict, company: dict, variant: str = "standard") -> bytes:
+    base_pdf, status_anchor = get_base_pdf(kind, document, company, PDF_RENDERERS[kind], variant)
+    overlay = pdf_overlay_state(kind, document)
+    if overlay is None:
+        return base_pdf
+    return apply_status_overlay(base_pdf, status_anchor, *overlay, compress=variant == "email")
+
+# Archival (PDF/A)
+# Finalized documents are rendered once as PDF/A-2b (embedded fonts, sRGB
+# output intent, XMP metadata) and the stored artifact is served as-is.
+PDFA_PRODUCER = "BillMaster Garuda"
+SRGB_ICC_PROFILE = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+def pdfa_xmp(title: str, stamp: str) -> bytes:
+    return f"""<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about=""
+ xmlns:pdfaid="http://www.aiim.org/pdfa/ns/id/"
+ xmlns:dc="http://purl.org/dc/elements/1.1/"
+ xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+ xmlns:pdf="http://ns.adobe.com/pdf/1.3/">
+<pdfaid:part>2</pdfaid:part>
+<pdfaid:conformance>B</pdfaid:conformance>
+<dc:format>application/pdf</dc:format>
+<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{escape(title)}</rdf:li></rdf:Alt></dc:title>
+<xmp:CreateDate>{stamp}</xmp:CreateDate>
+<xmp:ModifyDate>{stamp}</xmp:ModifyDate>
+<xmp:CreatorTool>{PDFA_PRODUCER}</xmp:CreatorTool>
+<pdf:Producer>{PDFA_PRODUCER}</pdf:Producer>
+</rdf:Description>
+</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>""".encode('utf-8')
+
+def convert_to_pdfa(pdf_bytes: bytes, title: str) -> bytes:
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(pdf_bytes)))
+    now = datetime.now(timezone.utc)
+    pdf_date = now.strftime("D:%Y%m%d%H%M%S+00'00'")
+    
+    # The Info dictionary must agree with the XMP packet entry for entry
+    writer.metadata = {
+        "/Title": title,
+        "/Creator": PDFA_PRODUCER,
+        "/Producer": PDFA_PRODUCER,
+        "/CreationDate": pdf_date,
+        "/ModDate": pdf_date,
+    }
+    
+    metadata = StreamObject()
+    metadata.set_data(pdfa_xmp(title, now.strftime("%Y-%m-%dT%H:%M:%S+00:00")))
+    metadata.update({NameObject("/Type"): NameObject("/Metadata"), NameObject("/Subtype"): NameObject("/XML")})
+    
+    icc_profile = StreamObject()
+    icc_profile.set_data(SRGB_ICC_PROFILE)
+    icc_profile.update({NameObject("/N"): NumberObject(3)})
+    output_intent = DictionaryObject({
+        NameObject("/Type"): NameObject("/OutputIntent"),
+        NameObject("/S"): NameObject("/GTS_PDFA1"),
+        NameObject("/OutputConditionIdentifier"): TextStringObject("sRGB IEC61966-2.1"),
+        NameObject("/Info"): TextStringObject("sRGB IEC61966-2.1"),
+        NameObject("/DestOutputProfile"): writer._add_object(icc_profile),
+    })
+    
+    catalog = writer._root_object
+    catalog[NameObject("/Metadata")] = writer._add_object(metadata)
+    catalog[NameObject("/OutputIntents")] = ArrayObject([writer._add_object(output_intent)])
+    
+    # PDF/A requires a file identifier in the trailer
+    writer.generate_file_identifiers()
+    
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+def render_archive_pdf(kind: str, document: dict, company: dict, title: str) -> bytes:
+    # Rendered straight through, archives are produced once and never cached
+    pdf_bytes, status_anchor = PDF_RENDERERS[kind](document, company, "archive")
+    overlay = pdf_overlay_state(kind, document)
+    if overlay is not None:
+        pdf_bytes = apply_status_overlay(pdf_bytes, status_anchor, *overlay, compress=True)
+    return convert_to_pdfa(pdf_bytes, title)
+
+async def archive_document(kind: str, document: dict) -> Optional[dict]:
+    _, label, number_field = DOCUMENT_KINDS[kind]
+    company = await db.companies.find_one({"id": document['company_id']}, {"_id": 0})
+    if not company:
+        logger.warning("Cannot archive %s %s: company %s not found", kind, document['id'], document['company_id'])
+        return None
+    
+    number = document[number_field]
+    rendered = await inline_signatures(document) if kind == "letter" else document
+    pdf_bytes = await run_in_threadpool(render_archive_pdf, kind, rendered, company, f"{label} {number}")
+    archive = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "document_id": document['id'],
+        "content_hash": document['content_hash'],
+        "filename": f"{kind}_{number.replace('/', '_')}_archive.pdf",
+        "pdf": pdf_bytes,
+        "size": len(pdf_bytes),
+        "created_at": datetime.now(timezone.utc),
+    }
+    # First writer wins, so a concurrent retry never replaces the stored artifact
+    await db.archives.update_one(
+        {"kind": kind, "document_id": document['id']},
+        {"$setOnInsert": archive},
+        upsert=True
+    )
+    return await db.archives.find_one({"kind": kind, "document_id": document['id']}, {"_id": 0})
+
+async def archive_response(kind: str, document_id: str) -> Response:
+    collection, label, _ = DOCUMENT_KINDS[kind]
+    archive = await db.archives.find_one({"kind": kind, "document_id": document_id}, {"_id": 0})
+    if not archive:
+        document = money_from_storage(await db[collection].find_one({"id": document_id}, {"_id": 0}))
+        if not document:
+            raise HTTPException(status_code=404, detail=f"{label} not found")
+        if not document.get('finalized'):
+            raise HTTPException(status_code=409, detail=f"{label} must be finalized before it is archived")
+        # Finalized before archiving existed, or the archive step failed
+        archive = await archive_document(kind, document)
+        if not archive:
+            raise HTTPException(status_code=404, detail="Company not found")
+    
+    return Response(content=bytes(archive['pdf']), media_type="application/pdf", headers={
+        "Content-Disposition": f"attachment; filename={archive['filename']}",
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "ETag": '"%s"' % archive['content_hash'],
+    })
+
+@api_router.get("/invoices/{invoice_id}/archive")
+async def get_invoice_archive(invoice_id: str):
+    return await archive_response("invoice", invoice_id)
+
+@api_router.get("/quotations/{quotation_id}/archive")
+async def get_quotation_archive(quotation_id: str):
+    return await archive_response("quotation", quotation_id)
+
+@api_router.get("/letters/{letter_id}/archive")
+async def get_letter_archive(letter_id: str):
+    return await archive_response("letter", letter_id)
+
+# Thumbnails
+# Page 1 previews for list views, cached next to the base PDF layouts and keyed
+# by the same fingerprint plus the overlay state so status changes show up.
+# List views pin thumbnail URLs with v=render_version, which changes whenever
+# the document or its company does, so only pinned URLs are cached long-term.
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', '240'))
+THUMBNAIL_CACHE_SIZE = int(os.environ.get('THUMBNAIL_CACHE_SIZE', '1024'))
+THUMBNAIL_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+thumbnail_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+
+def thumbnail_key(kind: str, document: dict, company: dict, image_format: str) -> tuple:
+    return (kind, document['id'], base_fingerprint(document, company), pdf_overlay_state(kind, document), image_format)
+
+def render_thumbnail(pdf_bytes: bytes, image_format: str) -> bytes:
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page = pdf[0]
+        image = page.render(scale=THUMBNAIL_WIDTH / page.get_width()).to_pil().convert('RGB')
+    finally:
+        pdf.close()
+    
+    pil_format, _ = THUMBNAIL_FORMATS[image_format]
+    buffer = io.BytesIO()
+    if pil_format == "WEBP":
+        image.save(buffer, format=pil_format, quality=80, method=4)
+    else:
+        image.save(buffer, format=pil_format, optimize=True)
+    return buffer.getvalue()
+
+def cache_thumbnail(key: tuple, pdf_bytes: bytes) -> bytes:
+    with render_cache_lock:
+        thumbnail = thumbnail_cache.get(key)
+        if thumbnail is not None:
+            thumbnail_cache.move_to_end(key)
+            return thumbnail
+    
+    thumbnail = render_thumbnail(pdf_bytes, key[-1])
+    with render_cache_lock:
+        # Keep only the latest revision of each document's thumbnail per format
+        for stale_key in [k for k in thumbnail_cache if k[0] == key[0] and k[1] == key[1] and k[-1] == key[-1]]:
+            del thumbnail_cache[stale_key]
+        thumbnail_cache[key] = thumbnail
+        while len(thumbnail_cache) > THUMBNAIL_CACHE_SIZE:
+            thumbnail_cache.popitem(last=False)
+    return thumbnail
+
+def build_thumbnail(kind: str, document: dict, company: dict, key: tuple) -> bytes:
+    return cache_thumbnail(key, build_document_pdf(kind, document, company))
+
+def queue_thumbnail(background_tasks: BackgroundTasks, kind: str, document: dict, company: dict, pdf_bytes: bytes):
+    key = thumbnail_key(kind, document, company, "png")
+    if key not in thumbnail_cache:
+        background_tasks.add_task(cache_thumbnail, key, pdf_bytes)
+
+def render_version(document: dict, company: dict) -> str:
+    """What a rendering depends on that can change: the document and its company."""
+    return f"{document.get('version', 1)}.{company.get('version', 1)}"
+
+async def thumbnail_response(kind: str, document: dict, image_format: str, v: Optional[str]) -> Response:
+    if image_format not in THUMBNAIL_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported thumbnail format: {image_format}")
+    
+    company = await db.companies.find_one({"id": document['company_id']}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    key = thumbnail_key(kind, document, company, image_format)
+    thumbnail = thumbnail_cache.get(key)
+    if thumbnail is None:
+        rendered = await inline_signatures(document) if kind == "letter" else document
+        thumbnail = await run_in_threadpool(build_thumbnail, kind, rendered, company, key)
+    
+    # URLs pinned to the render version never change content, so they can be
+    # cached for a year (or until a quotation's EXPIRED stamp appears)
+    if v is not None and v == render_version(document, company):
+        cache_control = rendered_cache_control(document)
+    else:
+        cache_control = "public, max-age=60, stale-while-revalidate=86400"
+    return Response(content=thumbnail, media_type=THUMBNAIL_FORMATS[image_format][1], headers={
+        "Cache-Control": cache_control,
+        "ETag": '"%s"' % hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32],
+    })
+
+@api_router.get("/invoices/{invoice_id}/thumbnail")
+async def get_invoice_thumbnail(invoice_id: str, format: str = "png", v: Optional[str] = None):
+    invoice = money_from_storage(await db.invoices.find_one({"id": invoice_id}, {"_id": 0}))
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    return await thumbnail_response("invoice", invoice, format, v)
+
+@api_router.get("/quotations/{quotation_id}/thumbnail")
+async def get_quotation_thumbnail(quotation_id: str, format: str = "png", v: Optional[str] = None):
+    quotation = money_from_storage(await db.quotations.find_one({"id": quotation_id}, {"_id": 0}))
+    if not quotation:
+        raise HTTPException(status_code=404, detail="Quotation not found")
+    return await thumbnail_response("quotation", quotation, format, v)
+
+@api_router.get("/letters/{letter_id}/thumbnail")
+async def get_letter_thumbnail(letter_id: str, format: str = "png", v: Optional[str] = None):
+    letter = await db.letters.find_one({"id": letter_id}, {"_id": 0})
+    if not letter:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    return await thumbnail_response("letter", letter, format, v)
+
+# HTML Preview Rendering
+# Same layout as the PDFs for in-app previews and email bodies. Templates are
+# compiled once per worker and company headers are rendered once per company
+# revision, so a preview only renders the document-specific part.
+HTML_TEMPLATES = {
+    "layout.html": """<!DOCTYPE html>
+<html lang="id">
+<head>
+<meta charset="utf-8">
+<title>{% block title %}{% endblock %}</title>
+<style>
+body { font-family: Helvetica, Arial, sans-serif; font-size: 13px; color: #1e293b; margin: 0; background: #fff; }
+.page { position: relative; max-width: 760px; margin: 0 auto; padding: 48px; }
+.watermark { position: absolute; top: 40%; left: 0; right: 0; text-align: center; font-size: 96px; font-weight: bold; color: rgba(220, 38, 38, 0.12); transform: rotate(-45deg); pointer-events: none; }
+h1 { text-align: center; font-size: 32px; margin: 0 0 24px; }
+table { border-collapse: collapse; width: 100%; }
+.header td { vertical-align: top; padding: 0; }
+.info td { padding: 4px 0 8px; }
+.info th { text-align: left; padding: 4px 0 8px; }
+.items th, .items td { border: 1px solid #9ca3af; padding: 6px 8px; text-align: left; }
+.items th { color: #f5f5f5; }
+.items .num { text-align: right; }
+.items tbody tr:nth-child(odd) { background: #f5f5f5; }
+.summary { width: 320px; margin-left: auto; }
+.summary td { padding: 4px 0; text-align: right; }
+.summary tr.total td { font-weight: bold; font-size: 16px; }
+.muted { color: #475569; }
+.right { text-align: right; }
+.center { text-align: center; }
+.block { margin-top: 24px; }
+</style>
+</head>
+<body>
+<div class="page">
+{% if watermark %}<div class="watermark">{{ watermark }}</div>{% endif %}
+{% block body %}{% endblock %}
+</div>
+</body>
+</html>
+""",
+    "header_trade.html": """<table class="header"><tr>
+{% if company.logo %}<td style="width: 120px"><img src="{{ company.logo }}" alt="Logo" style="max-width: 100px; max-height: 100px"></td>{% endif %}
+<td>
+<b>{{ company.name }}</b><br>
+{{ company.address }}<br>
+Phone: {{ company.phone }} | Email: {{ company.email }}
+{% if company.npwp %}<br>NPWP: {{ company.npwp }}{% endif %}
+</td>
+</tr></table>
+""",
+    "header_letter.html": """<div class="center">
+{% if company.logo %}<img src="{{ company.logo }}" alt="Logo" style="max-width: 100px; max-height: 100px"><br>{% endif %}
+<div style="font-size: 18px; font-weight: bold">{{ company.name }}</div>
+{% if company.motto %}<div class="muted" style="font-size: 11px; font-style: italic">{{ company.motto }}</div>{% endif %}
+<div>{{ company.address }}</div>
+<div>Tel: {{ company.phone }} | Email: {{ company.email }}</div>
+{% if company.website %}<div>Website: {{ company.website }}</div>{% endif %}
+</div>
+<div style="border-top: 2px solid #000; border-bottom: 1px solid #000; height: 3px; margin: 10px 0 20px"></div>
+""",
+    "trade/template1.html": """{% extends "layout.html" %}
+{% block title %}{{ heading }} {{ number }}{% endblock %}
+{% block body %}
+<h1 style="color: {{ accent }}">{{ heading | upper }}</h1>
+{{ company_header }}
+<table class="info block">
+<tr><th>{{ heading }} Number:</th><td>{{ number }}</td><th>Date:</th><td>{{ document.date }}</td></tr>
+<tr><th>Status:</th><td>{{ document.status | default('draft') | title }}</td><th>{{ deadline_label }}:</th><td>{{ deadline or '-' }}</td></tr>
+</table>
+<div class="block">
+<b>Bill To:</b><br>
+<b>{{ document.client_name }}</b>
+{% if document.client_address %}<br>{{ document.client_address | nl2br }}{% endif %}
+{% if document.client_phone %}<br>Phone: {{ document.client_phone }}{% endif %}
+{% if document.client_email %}<br>Email: {{ document.client_email }}{% endif %}
+</div>
+<table class="items block">
+<thead><tr style="background: {{ accent }}"><th>Item</th><th>Description</th><th class="num">Qty</th><th class="num">Unit Price</th><th class="num">Total</th></tr></thead>
+<tbody>
+{% for item in document['items'] %}
+<tr><td>{{ item.name }}</td><td>{{ item.description }}</td><td class="num">{{ item.quantity }} {{ item.unit }}</td><td class="num">{{ item.unit_price | currency(document.currency) }}</td><td class="num">{{ item.total | currency(document.currency) }}</td></tr>
+{% endfor %}
+</tbody>
+</table>
+<table class="summary block">
+<tr><td>Subtotal:</td><td>{{ document.subtotal | currency(document.currency) }}</td></tr>
+{% if document.discount_amount %}<tr><td>Discount ({{ document.discount_rate }}%):</td><td>{{ document.discount_amount | currency(document.currency) }}</td></tr>{% endif %}
+{% if document.tax_amount %}<tr><td>Tax ({{ document.tax_rate }}%):</td><td>{{ document.tax_amount | currency(document.currency) }}</td></tr>{% endif %}
+<tr class="total" style="border-top: 2px solid {{ accent }}"><td>Total:</td><td>{{ document.total | currency(document.currency) }}</td></tr>
+</table>
+{% if document.notes %}<div class="block"><b>Notes:</b><br>{{ document.notes | nl2br }}</div>{% endif %}
+{% if company.bank_name %}
+<div class="block"><b>Payment Details:</b><br>Bank: {{ company.bank_name }}<br>Account: {{ company.bank_account }}<br>Account Name: {{ company.bank_account_name }}</div>
+{% endif %}
+{% if document.signature_name or document.signature_position %}
+<div class="block right">
+<b>Authorized Signature:</b>
+<div style="height: 40px"></div>
+{% if document.signature_name %}<b>{{ document.signature_name }}</b><br>{% endif %}
+{{ document.signature_position }}
+</div>
+{% endif %}
+{% endblock %}
+""",
+    "letter.html": """{% extends "layout.html" %}
+{% block title %}Surat {{ document.letter_number }}{% endblock %}
+{% block body %}
+{{ company_header }}
+<div>Nomor: {{ document.letter_number }}</div>
+<div>Tanggal: {{ document.date }}</div>
+{% if document.attachments_count %}<div>Lampiran: {{ document.attachments_count }} berkas</div>{% endif %}
+<div>Perihal: <b>{{ document.subject }}</b></div>
+<div class="block">
+Kepada Yth,<br>
+<b>{{ document.recipient_name }}</b>
+{% if document.recipient_position %}<br>{{ document.recipient_position }}{% endif %}
+{% if document.recipient_address %}<br>{{ document.recipient_address }}{% endif %}
+</div>
+<p class="block">Dengan hormat,</p>
+{% for paragraph in document.content.split('\n') if paragraph.strip() %}
+<p style="text-align: justify; line-height: 1.5">{{ paragraph.strip() }}</p>
+{% endfor %}
+{% if document.activities %}
+<p><b>Rincian Kegiatan:</b></p>
+<table class="items">
+<thead><tr style="background: #e5e7eb"><th style="color: #000">No.</th><th style="color: #000">Kegiatan</th><th style="color: #000">Jumlah</th><th style="color: #000">Satuan</th><th style="color: #000">Hasil</th><th style="color: #000">Keterangan</th></tr></thead>
+<tbody>
+{% for activity in document.activities %}
+<tr><td class="center">{{ activity.no }}</td><td>{{ activity.kegiatan }}</td><td>{{ activity.jumlah }}</td><td>{{ activity.satuan }}</td><td>{{ activity.hasil }}</td><td>{{ activity.keterangan }}</td></tr>
+{% endfor %}
+</tbody>
+</table>
+{% endif %}
+<p class="block">{{ closing }}</p>
+{% if document.signatories %}
+<table class="block"><tr>
+{% for sig in document.signatories %}
+<td class="center" style="vertical-align: top">
+{{ sig.position }}<br>
+{% if sig.signature_image %}<img src="{{ sig.signature_image }}" alt="" style="max-width: 160px; max-height: 80px">{% else %}<div style="height: 80px"></div>{% endif %}<br>
+<b>{{ sig.name }}</b>
+</td>
+{% endfor %}
+</tr></table>
+{% endif %}
+{% if document.cc_list %}
+<div class="block"><b>Tembusan:</b>
+{% for cc in document.cc_list.split('\n') if cc.strip() %}<br>- {{ cc.strip() }}{% endfor %}
+</div>
+{% endif %}
+{% endblock %}
+""",
+}
+
+LETTER_CLOSINGS = {
+    'general': "Demikian surat ini kami sampaikan. Atas perhatian dan kerjasamanya, kami ucapkan terima kasih.",
+    'cooperation': "Demikian surat penawaran kerjasama ini kami sampaikan. Besar harapan kami dapat menjalin kerjasama yang baik dengan perusahaan Bapak/Ibu.",
+    'request': "Demikian permohonan ini kami sampaikan, atas perhatian dan perkenannya kami ucapkan terima kasih.",
+}
+
+def nl2br(value: str) -> Markup:
+    return Markup('<br>').join(escape(line) for line in str(value).split('\n'))
+
+html_env = Environment(loader=DictLoader(HTML_TEMPLATES), autoescape=True, auto_reload=False, cache_size=-1)
+html_env.filters['currency'] = lambda amount, currency: format_currency(amount or 0, currency)
+html_env.filters['nl2br'] = nl2br
+# Compile every template at import so no request pays the compile cost
+for template_name in HTML_TEMPLATES:
+    html_env.get_template(template_name)
+
+HTML_HEADER_CACHE_SIZE = int(os.environ.get('HTML_HEADER_CACHE_SIZE', '256'))
+html_header_cache: "OrderedDict[Tuple[str, str, str], Markup]" = OrderedDict()
+
+def render_company_header(layout: str, company: dict) -> Markup:
+    fingerprint = hashlib.sha256(json.dumps(
+        {k: v for k, v in company.items() if k not in FINALIZE_EXCLUDED_FIELDS}, sort_keys=True, default=str
+    ).encode('utf-8')).hexdigest()
+    key = (layout, company['id'], fingerprint)
+    with render_cache_lock:
+        header = html_header_cache.get(key)
+        if header is not None:
+            html_header_cache.move_to_end(key)
+            return header
+    
+    header = Markup(html_env.get_template(f"header_{layout}.html").render(company=company))
+    with render_cache_lock:
+        html_header_cache[key] = header
+        while len(html_header_cache) > HTML_HEADER_CACHE_SIZE:
+            html_header_cache.popitem(last=False)
+    return header
+
+def render_trade_html(kind: str, document: dict, company: dict) -> str:
+    template = html_env.select_template([f"trade/{document.get('template_id', 'template1')}.html", "trade/template1.html"])
+    if kind == "invoice":
+        context = dict(heading="Invoice", accent="#1e40af", number=document['invoice_number'],
+                       deadline_label="Due Date", deadline=document.get('due_date'), watermark=invoice_watermark(document))
+    else:
+        context = dict(heading="Quotation", accent="#059669", number=document['quotation_number'],
+                       deadline_label="Valid Until", deadline=document.get('valid_until'), watermark=quotation_watermark(document))
+    return template.render(document=document, company=company, company_header=render_company_header("trade", company), **context)
+
+def render_letter_html(letter: dict, company: dict) -> str:
+    return html_env.get_template("letter.html").render(
+        document=letter,
+        company=company,
+        company_header=render_company_header("letter", company),
+        closing=LETTER_CLOSINGS.get(letter.get('letter_type'), ""),
+        watermark=None,
+    )
+
+@api_router.get("/invoices/{invoice_id}/html", response_class=HTMLResponse)
+async def get_invoice_html(invoice_id: str, request: Request):
+    invoice = money_from_storage(await db.invoices.find_one({"id": invoice_id}, {"_id": 0}))
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    company = await db.companies.find_one({"id": invoice['company_id']}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    cached, headers = rendering_validators(request, invoice, company)
+    if cached:
+        return cached
+    
+    response = HTMLResponse(render_trade_html("invoice", invoice, company))
+    response.headers.update(headers)
+    return response
+
+@api_router.get("/quotations/{quotation_id}/html", response_class=HTMLResponse)
+async def get_quotation_html(quotation_id: str, request: Request):
+    quotation = money_from_storage(await db.quotations.find_one({"id": quotation_id}, {"_id": 0}))
+    if not quotation:
+        raise HTTPException(status_code=404, detail="Quotation not found")
+    
+    company = await db.companies.find_one({"id": quotation['company_id']}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    cached, headers = rendering_validators(request, quotation, company)
+    if cached:
+        return cached
+    
+    response = HTMLResponse(render_trade_html("quotation", quotation, company))
+    response.headers.update(headers)
+    return response
+
+@api_router.get("/letters/{letter_id}/html", response_class=HTMLResponse)
+async def get_letter_html(letter_id: str, request: Request):
+    letter = await db.letters.find_one({"id": letter_id}, {"_id": 0})
+    if not letter:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    
+    company = await db.companies.find_one({"id": letter['company_id']}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    cached, headers = rendering_validators(request, letter, company)
+    if cached:
+        return cached
+    
+    response = HTMLResponse(render_letter_html(await inline_signatures(letter), company))
+    response.headers.update(headers)
+    return response
+
+# Totals Verification
+# Recomputes stored totals for whole collections. Documents are streamed in
+# chunks and each chunk is checked with vectorized NumPy arithmetic; only
+# values sitting on a rounding tie fall back to the exact Decimal path, so the
+# results always agree with money_to_storage.
+TOTALS_BATCH_SIZE = int(os.environ.get('TOTALS_BATCH_SIZE', '5000'))
+TOTALS_PROJECTION = {
+    "_id": 1, "id": 1, "invoice_number": 1, "quotation_number": 1, "version": 1, "finalized": 1,
+    "currency": 1, "discount_rate": 1, "tax_rate": 1,
+    "items.quantity": 1, "items.unit_price": 1, "items.total": 1,
+    "subtotal": 1, "discount_amount": 1, "tax_amount": 1, "total": 1,
+}
+TRADE_DOCUMENTS = {
+    # kind: (collection, number field)
+    "invoice": ("invoices", "invoice_number"),
+    "quotation": ("quotations", "quotation_number"),
+}
+
+def round_half_up(values: np.ndarray, exact: Callable[[int], int]) -> np.ndarray:
+    """Vectorized ROUND_HALF_UP to integers.
+
+    Float products cannot tell 2.5 from 2.4999999999999996, so anything within
+    float noise of a tie is re-rounded by ``exact(index)``.
+    """
+    magnitude = np.abs(values)
+    rounded = np.sign(values) * np.floor(magnitude + 0.5)
+    ties = np.flatnonzero(np.abs(magnitude % 1 - 0.5) <= 1e-9 * np.maximum(magnitude, 1))
+    for index in ties:
+        rounded[index] = exact(int(index))
+    return rounded.astype(np.int64)
+
+def stored_minor_units(values: list, exponents: np.ndarray) -> np.ndarray:
+    # Floats are legacy major-unit amounts that have not been migrated yet
+    legacy = np.fromiter((type(value) is float for value in values), dtype=bool, count=len(values))
+    raw = np.asarray(values, dtype=np.float64)
+    if not legacy.any():
+        return raw.astype(np.int64)
+    scaled = np.where(legacy, raw * 10.0 ** exponents, raw)
+    return round_half_up(scaled, lambda i: to_minor_units(values[i], int(exponents[i])) if legacy[i] else int(values[i]))
+
+def recompute_totals_batch(documents: List[dict]) -> List[dict]:
+    """Return the documents of a batch whose stored totals are wrong.
+
+    Each entry carries the expected line totals and document totals in minor
+    units next to the stored ones.
+    """
+    count = len(documents)
+    quantities, unit_prices, line_totals = [], [], []
+    item_counts = np.zeros(count, dtype=np.int64)
+    for position, document in enumerate(documents):
+        items = document.get('items') or []
+        item_counts[position] = len(items)
+        for item in items:
+            quantities.append(item.get('quantity') or 0)
+            unit_prices.append(item.get('unit_price') or 0)
+            line_totals.append(item.get('total') or 0)
+    
+    exponents = np.fromiter((currency_exponent(d.get('currency')) for d in documents), dtype=np.int64, count=count)
+    discount_rates = [d.get('discount_rate') or 0 for d in documents]
+    tax_rates = [d.get('tax_rate') or 0 for d in documents]
+    owner = np.repeat(np.arange(count), item_counts)
+    item_exponents = exponents[owner]
+    
+    unit_price = stored_minor_units(unit_prices, item_exponents)
+    stored_line = stored_minor_units(line_totals, item_exponents)
+    expected_line = round_half_up(
+        np.asarray(quantities, dtype=np.float64) * unit_price,
+        lambda i: line_total_minor(quantities[i], int(unit_price[i])),
+    )
+    
+    subtotal = np.bincount(owner, weights=expected_line, minlength=count).astype(np.int64)
+    discount = round_half_up(
+        subtotal * np.asarray(discount_rates, dtype=np.float64) / 100,
+        lambda i: document_totals_minor(int(subtotal[i]), discount_rates[i], tax_rates[i])[0],
+    )
+    tax = round_half_up(
+        (subtotal - discount) * np.asarray(tax_rates, dtype=np.float64) / 100,
+        lambda i: document_totals_minor(int(subtotal[i]), discount_rates[i], tax_rates[i])[1],
+    )
+    expected = {
+        'subtotal': subtotal,
+        'discount_amount': discount,
+        'tax_amount': tax,
+        'total': subtotal - discount + tax,
+    }
+    stored = {field: stored_minor_units([d.get(field) or 0 for d in documents], exponents) for field in MONEY_FIELDS}
+    
+    line_mismatch = expected_line != stored_line
+    field_mismatch = {field: expected[field] != stored[field] for field in MONEY_FIELDS}
+    mismatched = np.zeros(count, dtype=bool)
+    mismatched[owner[line_mismatch]] = True
+    for mask in field_mismatch.values():
+        mismatched |= mask
+    
+    offsets = np.concatenate(([0], np.cumsum(item_counts)))
+    results = []
+    for position in np.flatnonzero(mismatched):
+        start, end = offsets[position], offsets[position + 1]
+        lines = np.flatnonzero(line_mismatch[start:end])
+        results.append({
+            "document": documents[position],
+            "exponent": int(exponents[position]),
+            "lines": {int(i): (int(stored_line[start + i]), int(expected_line[start + i])) for i in lines},
+            "fields": {
+                field: (int(stored[field][position]), int(expected[field][position]))
+                for field in MONEY_FIELDS if field_mismatch[field][position]
+            },
+        })
+    return results
+
+def totals_repair(mismatch: dict, now: datetime) -> Optional[UpdateOne]:
+    document = mismatch['document']
+    # Finalized documents are frozen under their content hash
+    if document.get('finalized'):
+        return None
+    updates = {f"items.{index}.total": Int64(expected) for index, (_, expected) in mismatch['lines'].items()}
+    updates.update({field: Int64(expected) for field, (_, expected) in mismatch['fields'].items()})
+    updates['updated_at'] = now
+    version = document.get('version')
+    version_filter = {"version": version} if version is not None else {"version": {"$exists": False}}
+    return UpdateOne(
+        {"_id": document['_id'], "finalized": {"$ne": True}, **version_filter},
+        {"$set": updates, "$inc": {"version": 1}}
+    )
+
+def totals_report_entry(mismatch: dict, number_field: str) -> dict:
+    document = mismatch['document']
+    exponent = mismatch['exponent']
+    def amounts(stored, expected):
+        return {"stored": from_minor_units(stored, exponent), "expected": from_minor_units(expected, exponent)}
+    return {
+        "id": document.get('id'),
+        "number": document.get(number_field),
+        "finalized": bool(document.get('finalized')),
+        "lines": [dict(index=index, **amounts(*values)) for index, values in mismatch['lines'].items()],
+        "fields": {field: amounts(*values) for field, values in mismatch['fields'].items()},
+    }
+
+async def verify_totals(kind: str, repair: bool, limit: int) -> dict:
+    collection_name, number_field = TRADE_DOCUMENTS[kind]
+    collection = db[collection_name]
+    report = {"scanned": 0, "line_items": 0, "mismatched": 0, "repaired": 0, "skipped_finalized": 0, "mismatches": []}
+    cursor = collection.find({}, TOTALS_PROJECTION).batch_size(TOTALS_BATCH_SIZE)
+    while True:
+        batch = await cursor.to_list(TOTALS_BATCH_SIZE)
+        if not batch:
+            break
+        report["scanned"] += len(batch)
+        report["line_items"] += sum(len(d.get('items') or []) for d in batch)
+        mismatches = await run_in_threadpool(recompute_totals_batch, batch)
+        report["mismatched"] += len(mismatches)
+        
+        room = limit - len(report["mismatches"])
+        report["mismatches"].extend(totals_report_entry(m, number_field) for m in mismatches[:max(room, 0)])
+        
+        if repair and mismatches:
+            now = datetime.now(timezone.utc)
+            operations = [op for op in (totals_repair(m, now) for m in mismatches) if op]
+            report["skipped_finalized"] += len(mismatches) - len(operations)
+            if operations:
+                result = await collection.bulk_write(operations, ordered=False)
+                report["repaired"] += result.modified_count
+                if result.modified_count:
+                    await record_change(collection.name)
+    return report
+
+@api_router.post("/invoices/verify-totals")
+async def verify_invoice_totals(repair: bool = False, limit: int = 100):
+    return await verify_totals("invoice", repair, limit)
+
+@api_router.post("/quotations/verify-totals")
+async def verify_quotation_totals(repair: bool = False, limit: int = 100):
+    return await verify_totals("quotation", repair, limit)
+
+# Idempotency
+# A POST carrying an Idempotency-Key claims that key in db.idempotency_keys
+# before it runs. A retry with the same key and payload gets the stored
+# response replayed instead of creating the document again; records expire
+# through a TTL index after IDEMPOTENCY_TTL_SECONDS. Server errors are not
+# recorded, so those requests can be retried for real. A claim is a lease of
+# IDEMPOTENCY_LEASE_SECONDS: a retry may take over a key still marked as
+# processing once that has run out, as its worker died without finishing.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '300'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_REPLAYED_HEADERS = ('content-type', 'etag', 'cache-control', 'content-disposition', 'location', 'vary')
+
+class RequestHasher:
+    """Hash a request's path, query, media type and body as the body streams in."""
+    def __init__(self, scope):
+        content_type, _, params = Headers(scope=scope).get('content-type', '').partition(';')
+        # Clients pick a fresh multipart boundary on every retry
+        self.boundary = params.strip().partition('boundary=')[2].strip('"').encode('latin-1')
+        self.digest = hashlib.sha256()
+        for part in (scope['path'], scope.get('query_string', b'').decode('latin-1'), content_type.strip()):
+            self.digest.update(part.encode('utf-8') + b'\0')
+        self.tail = b""
+        self.complete = False
+    
+    def update(self, message: dict):
+        data = self.tail + message.get("body", b"")
+        self.complete = not message.get("more_body", False)
+        if self.boundary:
+            data = data.replace(self.boundary, b'')
+            # Hold back what could be the start of a boundary split across chunks
+            keep = 0 if self.complete else min(len(data), len(self.boundary) - 1)
+            data, self.tail = data[:len(data) - keep], data[len(data) - keep:]
+        self.digest.update(data)
+    
+    async def drain(self, receive):
+        """Hash the rest of the body without handing it to the app."""
+        while not self.complete:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            self.update(message)
+    
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+async def claim_idempotency_key(record_id: str) -> Optional[str]:
+    """Claim a key for this request and return the lease id, or None when
+    another request holds a live lease on it or has completed it."""
+    now = datetime.now(timezone.utc)
+    lease = {"lease_id": str(uuid.uuid4()), "lease_expires_at": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+    try:
+        await db.idempotency_keys.insert_one({"_id": record_id, "state": "processing", "created_at": now, **lease})
+        return lease["lease_id"]
+    except DuplicateKeyError:
+        pass
+    taken_over = await db.idempotency_keys.find_one_and_update(
+        {"_id": record_id, "state": "processing", "lease_expires_at": {"$lt": now}},
+        {"$set": {"created_at": now, **lease}},
+        projection={"_id": 1},
+    )
+    return lease["lease_id"] if taken_over else None
+
+async def replay_idempotent_response(record_id: str, request_hash: str) -> Response:
+    record = await db.idempotency_keys.find_one({"_id": record_id})
+    if not record:
+        # Expired between the insert attempt and this lookup
+        return JSONResponse({"detail": "Idempotency-Key expired, please retry"}, status_code=409)
+    if record['state'] != "done":
+        return JSONResponse({"detail": "A request with this Idempotency-Key is still being processed"}, status_code=409)
+    if record['request_hash'] != request_hash:
+        return JSONResponse({"detail": "Idempotency-Key was already used for a different request"}, status_code=422)
+    response = Response(content=bytes(record['body']), status_code=record['status_code'])
+    # Stored as [name, value] pairs so repeated headers survive; records
+    # written before that hold a dict
+    headers = record['headers'].items() if isinstance(record['headers'], dict) else record['headers']
+    response.raw_headers.extend((name.encode('latin-1'), value.encode('latin-1')) for name, value in headers)
+    response.raw_headers.append((b"idempotent-replayed", b"true"))
+    return response
+
+class IdempotencyMiddleware:
+    """Claims the Idempotency-Key of a POST before the app runs and records its response.
+
+    The request body is hashed as it streams through to the app, and a retry's
+    body is hashed and discarded, so uploads keep their constant memory use.
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        key = Headers(scope=scope).get('idempotency-key') if scope["type"] == "http" and scope["method"] == "POST" else None
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            response = JSONResponse({"detail": f"Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters"}, status_code=400)
+            await response(scope, receive, send)
+            return
+        
+        hasher = RequestHasher(scope)
+        record_id = f"{scope['path']}:{key}"
+        lease_id = await claim_idempotency_key(record_id)
+        if lease_id is None:
+            await hasher.drain(receive)
+            response = await replay_idempotent_response(record_id, hasher.hexdigest())
+            await response(scope, receive, send)
+            return
+        
+        async def receive_hashed():
+            message = await receive()
+            if message["type"] == "http.request" and not hasher.complete:
+                hasher.update(message)
+            return message
+        
+        start_message = None
+        body = []
+        
+        async def send_recorded(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                # Body the app left unread can no longer be received once
+                # the response is complete
+                await hasher.drain(receive)
+                start_message = message
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+            await send(message)
+        
+        # Once the lease has been taken over, the record is no longer ours
+        # to complete or release
+        claim = {"_id": record_id, "lease_id": lease_id}
+        try:
+            await self.app(scope, receive_hashed, send_recorded)
+        except Exception:
+            await db.idempotency_keys.delete_one(claim)
+            raise
+        
+        # A body cut short (refused as too large, client gone) has no
+        # fingerprint a retry could be matched against
+        if start_message is None or start_message["status"] >= 500 or not hasher.complete:
+            await db.idempotency_keys.delete_one(claim)
+            return
+        headers = [
+            [name.decode('latin-1'), value.decode('latin-1')]
+            for name, value in start_message.get("headers", [])
+            if name.decode('latin-1').lower() in IDEMPOTENCY_REPLAYED_HEADERS
+        ]
+        await db.idempotency_keys.update_one(claim, {"$set": {
+            "state": "done",
+            "request_hash": hasher.hexdigest(),
+            "status_code": start_message["status"],
+            "headers": headers,
+            "body": b"".join(body),
+        }})
+
+# Response Compression
+# The encoding is negotiated per request from Accept-Encoding: brotli, zstd or
+# gzip, whichever the client ranks highest, with ties going in that order.
+# Bodies under COMPRESSION_MINIMUM_SIZE, PDFs and already-compressed images are
+# sent as is. Streamed bodies (NDJSON lists, exports) are compressed chunk by
+# chunk and flushed after each, so clients still get every batch as it is sent.
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get('COMPRESSION_MINIMUM_SIZE', '1024'))
+INCOMPRESSIBLE_MEDIA_TYPES = {'application/pdf', 'image/png', 'image/jpeg', 'image/webp', 'image/gif', 'image/avif'}
+COMPRESSION_ENCODINGS = [encoding for encoding, codec in (("br", brotli), ("zstd", zstandard), ("gzip", zlib)) if codec]
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    
+    best, best_quality = None, 0.0
+    for encoding in COMPRESSION_ENCODINGS:
+        quality = weights.get(encoding, weights.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def stream_compressor(encoding: str) -> Callable[[bytes, bool], bytes]:
+    """Return compress(data, final) for one response body in the given encoding."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=4)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def compress(data: bytes, final: bool) -> bytes:
+        return process(data) + (finish() if final else flush())
+    
+    return compress
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        start_message = None
+        compress = None
+        
+        async def send_compressed(message):
+            nonlocal start_message, compress
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether to compress
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                media_type = headers.get('content-type', '').split(';')[0].strip().lower()
+                compressible = media_type not in INCOMPRESSIBLE_MEDIA_TYPES and 'content-encoding' not in headers
+                if compressible:
+                    headers.add_vary_header('Accept-Encoding')
+                # A body sent in several chunks can still declare its
+                # Content-Length up front
+                length = headers.get('content-length')
+                size = int(length) if length else (None if more_body else len(body))
+                if compressible and encoding and (size is None or size >= COMPRESSION_MINIMUM_SIZE):
+                    compress = stream_compressor(encoding)
+                    body = compress(body, not more_body)
+                    headers['Content-Encoding'] = encoding
+                    del headers['Content-Length']
+                    if not more_body:
+                        headers['Content-Length'] = str(len(body))
+                    # The compressed bytes differ from the identity representation
+                    etag = headers.get('etag')
+                    if etag and not etag.startswith('W/'):
+                        headers['ETag'] = f"W/{etag}"
+                await send(start_message)
+                start_message = None
+            elif compress:
+                body = compress(body, not more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Added innermost first: size limits apply before an idempotency key is claimed
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(RequestBodyLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1139,6 +4031,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -1146,6 +4040,153 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Storage Migrations
+DATETIME_FIELDS = ('created_at', 'updated_at', 'finalized_at')
+DOCUMENT_COLLECTIONS = ('companies', 'items', 'invoices', 'quotations', 'letters')
+MONEY_COLLECTIONS = ('invoices', 'quotations')
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '500'))
+migration_tasks = set()
+
+def parse_stored_datetime(value):
+    """Parse a legacy ISO-8601 string into an aware UTC datetime."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def datetime_migration_update(document: dict) -> dict:
+    updates = {}
+    for field in DATETIME_FIELDS:
+        value = document.get(field)
+        if isinstance(value, str):
+            try:
+                updates[field] = parse_stored_datetime(value)
+            except ValueError:
+                logger.warning("Unparseable %s on document %s: %r", field, document.get('id'), value)
+    if not document.get('updated_at') and document.get('created_at'):
+        updates['updated_at'] = updates.get('created_at', document['created_at'])
+    return updates
+
+def snapshot_filter(document: dict, projection: dict) -> dict:
+    """Match a document only while the projected fields still hold the values read."""
+    guard = {}
+    for field in projection:
+        if field == '_id':
+            continue
+        guard[field] = document[field] if field in document else {"$exists": False}
+    return guard
+
+async def migrate_in_batches(collection, pending: dict, projection: dict, build_update: Callable[[dict], dict]) -> int:
+    """Apply build_update to every pending document, one batch at a time.
+
+    Only documents matching ``pending`` are visited, so a migration is safe
+    to re-run. Each batch is a single unordered bulk_write whose updates only
+    match while the document is still pending and unchanged since it was
+    read, so a concurrent PUT or PATCH is never overwritten; a document
+    skipped that way is migrated on the next start.
+    """
+    migrated = 0
+    last_id = None
+    while True:
+        query = {**pending, "_id": {"$gt": last_id}} if last_id is not None else pending
+        batch = await collection.find(query, projection).sort("_id", 1).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+        operations = []
+        for document in batch:
+            updates = build_update(document)
+            if updates:
+                guard = {"_id": document['_id'], **pending, **snapshot_filter(document, projection)}
+                operations.append(UpdateOne(guard, {"$set": updates}))
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            migrated += result.modified_count
+        # Yield between batches so request handlers keep being served
+        await asyncio.sleep(0)
+    if migrated:
+        await record_change(collection.name)
+    return migrated
+
+async def migrate_datetime_fields(collection) -> int:
+    """Convert string timestamps to native BSON dates."""
+    pending = {"$or": [{field: {"$type": "string"}} for field in DATETIME_FIELDS] + [{"updated_at": {"$exists": False}}]}
+    projection = {field: 1 for field in DATETIME_FIELDS}
+    projection['id'] = 1
+    return await migrate_in_batches(collection, pending, projection, datetime_migration_update)
+
+async def migrate_version_field(collection) -> int:
+    """Start unversioned documents at version 1."""
+    pending = {"version": {"$exists": False}}
+    return await migrate_in_batches(collection, pending, {"_id": 1}, lambda document: {"version": 1})
+
+def money_migration_update(document: dict) -> dict:
+    # Stored amounts are kept as-is; mismatched totals are left for the
+    # totals verification to report
+    exponent = currency_exponent(document.get('currency'))
+    updates = {}
+    for field in MONEY_FIELDS:
+        if isinstance(document.get(field), float):
+            updates[field] = Int64(to_minor_units(document[field], exponent))
+    items = [dict(item) for item in document.get('items') or []]
+    if any(isinstance(item.get(field), float) for item in items for field in LINE_MONEY_FIELDS):
+        # Copies, so the snapshot the write is guarded by stays as read
+        for item in items:
+            for field in LINE_MONEY_FIELDS:
+                if isinstance(item.get(field), float):
+                    item[field] = Int64(to_minor_units(item[field], exponent))
+        updates['items'] = items
+    return updates
+
+async def migrate_money_fields(collection) -> int:
+    """Convert legacy float amounts to int64 minor units."""
+    money_paths = list(MONEY_FIELDS) + [f"items.{field}" for field in LINE_MONEY_FIELDS]
+    pending = {"$or": [{path: {"$type": "double"}} for path in money_paths]}
+    projection = {field: 1 for field in MONEY_FIELDS}
+    projection.update({'currency': 1, 'items': 1})
+    return await migrate_in_batches(collection, pending, projection, money_migration_update)
+
+async def migrate_storage():
+    migrations = [(name, migrate_datetime_fields, "native datetimes") for name in DOCUMENT_COLLECTIONS]
+    migrations += [(name, migrate_version_field, "versioned documents") for name in DOCUMENT_COLLECTIONS]
+    migrations += [(name, migrate_money_fields, "minor-unit amounts") for name in MONEY_COLLECTIONS]
+    for name, migrate, description in migrations:
+        try:
+            migrated = await migrate(db[name])
+        except Exception:
+            logger.exception("Migration to %s failed for %s", description, name)
+            continue
+        if migrated:
+            logger.info("Migrated %d %s documents to %s", migrated, name, description)
+
+async def ensure_number_index(collection, number_field: str):
+    """Make document numbers unique per company; unnumbered documents are exempt."""
+    keys = [("company_id", 1), (number_field, 1)]
+    name = f"company_id_1_{number_field}_1"
+    existing = (await collection.index_information()).get(name)
+    if existing and not existing.get('unique'):
+        # Replaces the plain lookup index of earlier releases
+        await collection.drop_index(name)
+    try:
+        await collection.create_index(keys, name=name, unique=True, partialFilterExpression={number_field: {"$gt": ""}})
+    except OperationFailure:
+        logger.exception("Stored %s values are not unique per company; resolve the duplicates and restart to enforce it", number_field)
+        await collection.create_index(keys, name=name)
+
+@app.on_event("startup")
+async def prepare_storage():
+    for name in DOCUMENT_COLLECTIONS:
+        await db[name].create_index("id")
+        await db[name].create_index("created_at")
+        await db[name].create_index("updated_at")
+    await db.signatures.create_index("id", unique=True)
+    for collection, _, number_field in DOCUMENT_KINDS.values():
+        await ensure_number_index(db[collection], number_field)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    task = asyncio.create_task(migrate_storage())
+    migration_tasks.add(task)
+    task.add_done_callback(migration_tasks.discard)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
\ No newline at end of file
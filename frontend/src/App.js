@@ -19,6 +19,8 @@ import { Toaster } from "@/components/ui/sonner";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 export const API = `${BACKEND_URL}/api`;
+// Uploaded files are referenced by server paths; data URIs pass through
+export const backendUrl = (path) => (path && path.startsWith("/") ? `${BACKEND_URL}${path}` : path);
 
 const Sidebar = ({ isOpen, setIsOpen }) => {
   const location = useLocation();
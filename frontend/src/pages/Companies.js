@@ -25,6 +25,7 @@ const Companies = () => {
     website: "",
     motto: "",
     npwp: "",
+    code: "",
     bank_name: "",
     bank_account: "",
     bank_account_name: "",
@@ -96,7 +97,9 @@ const Companies = () => {
 
     try {
       if (editingCompany) {
-        await axios.put(`${API}/companies/${editingCompany.id}`, formData);
+        await axios.put(`${API}/companies/${editingCompany.id}`, formData, {
+          headers: { "If-Match": `"${editingCompany.version}"` },
+        });
         toast.success("Company updated successfully");
       } else {
         await axios.post(`${API}/companies`, formData);
@@ -109,7 +112,11 @@ const Companies = () => {
       fetchCompanies();
     } catch (error) {
       console.error("Error saving company:", error);
-      toast.error("Failed to save company");
+      if (error.response && error.response.status === 409) {
+        toast.error(error.response.data.detail);
+      } else {
+        toast.error("Failed to save company");
+      }
     }
   };
 
@@ -123,6 +130,7 @@ const Companies = () => {
       website: company.website || "",
       motto: company.motto || "",
       npwp: company.npwp || "",
+      code: company.code || "",
       bank_name: company.bank_name || "",
       bank_account: company.bank_account || "",
       bank_account_name: company.bank_account_name || "",
@@ -156,6 +164,7 @@ const Companies = () => {
       website: "",
       motto: "",
       npwp: "",
+      code: "",
       bank_name: "",
       bank_account: "",
       bank_account_name: "",
@@ -338,6 +347,17 @@ const Companies = () => {
                   />
                 </div>
               </div>
+              <div>
+                <Label htmlFor="code">Company Code</Label>
+                <Input
+                  id="code"
+                  name="code"
+                  data-testid="company-code-input"
+                  value={formData.code}
+                  onChange={handleInputChange}
+                  placeholder="ABC"
+                />
+              </div>
               <div>
                 <Label htmlFor="motto">Motto/Tagline</Label>
                 <Input
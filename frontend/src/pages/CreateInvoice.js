@@ -150,7 +150,7 @@ const CreateInvoice = () => {
   const handleSubmit = async (e) => {
     e.preventDefault();
     
-    if (!formData.invoice_number || !formData.company_id || !formData.client_name) {
+    if (!formData.company_id || !formData.client_name) {
       toast.error("Please fill in all required fields");
       return;
     }
@@ -215,15 +215,14 @@ const CreateInvoice = () => {
               <CardContent className="space-y-4">
                 <div className="grid grid-cols-2 gap-4">
                   <div>
-                    <Label htmlFor="invoice_number">Invoice Number *</Label>
+                    <Label htmlFor="invoice_number">Invoice Number</Label>
                     <Input
                       id="invoice_number"
                       name="invoice_number"
                       data-testid="invoice-number-input"
                       value={formData.invoice_number}
                       onChange={handleInputChange}
-                      placeholder="INV-001"
-                      required
+                      placeholder="Auto: INV/2026/10/0001"
                     />
                   </div>
                   <div>
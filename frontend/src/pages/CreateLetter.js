@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from "react";
 import axios from "axios";
-import { API } from "../App";
+import { API, backendUrl } from "../App";
 import { useNavigate } from "react-router-dom";
 import { Plus, Trash2, ArrowLeft, Upload, X } from "lucide-react";
 import { Button } from "@/components/ui/button";
@@ -156,7 +156,7 @@ const CreateLetter = () => {
   const handleSubmit = async (e) => {
     e.preventDefault();
     
-    if (!formData.letter_number || !formData.company_id || !formData.subject || !formData.recipient_name || !formData.content) {
+    if (!formData.company_id || !formData.subject || !formData.recipient_name || !formData.content) {
       toast.error("Please fill in all required fields");
       return;
     }
@@ -212,15 +212,14 @@ const CreateLetter = () => {
               <CardContent className="space-y-4">
                 <div className="grid grid-cols-2 gap-4">
                   <div>
-                    <Label htmlFor="letter_number">Nomor Surat *</Label>
+                    <Label htmlFor="letter_number">Nomor Surat</Label>
                     <Input
                       id="letter_number"
                       name="letter_number"
                       data-testid="letter-number-input"
                       value={formData.letter_number}
                       onChange={handleInputChange}
-                      placeholder="001/DIR/XII/2025"
-                      required
+                      placeholder="Otomatis: 001/DIR/XII/2025"
                     />
                   </div>
                   <div>
@@ -552,7 +551,7 @@ const CreateLetter = () => {
                       {signatory.signature_image ? (
                         <div className="relative border rounded p-2">
                           <img 
-                            src={signatory.signature_image} 
+                            src={backendUrl(signatory.signature_image)} 
                             alt="Signature" 
                             className="h-20 w-full object-contain"
                           />
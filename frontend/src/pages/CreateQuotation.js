@@ -144,7 +144,7 @@ const CreateQuotation = () => {
   const handleSubmit = async (e) => {
     e.preventDefault();
     
-    if (!formData.quotation_number || !formData.company_id || !formData.client_name) {
+    if (!formData.company_id || !formData.client_name) {
       toast.error("Please fill in all required fields");
       return;
     }
@@ -209,15 +209,14 @@ const CreateQuotation = () => {
               <CardContent className="space-y-4">
                 <div className="grid grid-cols-2 gap-4">
                   <div>
-                    <Label htmlFor="quotation_number">Quotation Number *</Label>
+                    <Label htmlFor="quotation_number">Quotation Number</Label>
                     <Input
                       id="quotation_number"
                       name="quotation_number"
                       data-testid="quotation-number-input"
                       value={formData.quotation_number}
                       onChange={handleInputChange}
-                      placeholder="INV-001"
-                      required
+                      placeholder="Auto: QUO/2026/10/0001"
                     />
                   </div>
                   <div>
@@ -16,6 +16,7 @@ const EditInvoice = () => {
   const { id } = useParams();
   const [companies, setCompanies] = useState([]);
   const [items, setItems] = useState([]);
+  const [version, setVersion] = useState(null);
   const [formData, setFormData] = useState({
     invoice_number: "",
     company_id: "",
@@ -75,6 +76,7 @@ const EditInvoice = () => {
         signature_position: invoice.signature_position || "",
       });
       setInvoiceItems(invoice.items);
+      setVersion(invoice.version);
     } catch (error) {
       console.error("Error fetching invoice:", error);
       toast.error("Failed to fetch invoice");
@@ -199,12 +201,18 @@ const EditInvoice = () => {
     };
 
     try {
-      await axios.put(`${API}/invoices/${id}`, submitData);
+      await axios.put(`${API}/invoices/${id}`, submitData, {
+        headers: { "If-Match": `"${version}"` },
+      });
       toast.success("Invoice updated successfully");
       navigate('/invoices');
     } catch (error) {
       console.error("Error updating invoice:", error);
-      toast.error("Failed to update invoice");
+      if (error.response && error.response.status === 409) {
+        toast.error(error.response.data.detail);
+      } else {
+        toast.error("Failed to update invoice");
+      }
     }
   };
 
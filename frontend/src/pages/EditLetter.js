@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from "react";
 import axios from "axios";
-import { API } from "../App";
+import { API, backendUrl } from "../App";
 import { useNavigate, useParams } from "react-router-dom";
 import { Plus, Trash2, ArrowLeft, X } from "lucide-react";
 import { Button } from "@/components/ui/button";
@@ -14,6 +14,7 @@ const EditLetter = () => {
   const navigate = useNavigate();
   const { id } = useParams();
   const [companies, setCompanies] = useState([]);
+  const [version, setVersion] = useState(null);
   const [formData, setFormData] = useState({
     letter_number: "",
     company_id: "",
@@ -63,6 +64,7 @@ const EditLetter = () => {
     try {
       const response = await axios.get(`${API}/letters/${id}`);
       const letter = response.data;
+      setVersion(letter.version);
       
       setFormData({
         letter_number: letter.letter_number,
@@ -213,12 +215,18 @@ const EditLetter = () => {
     };
 
     try {
-      await axios.put(`${API}/letters/${id}`, submitData);
+      await axios.put(`${API}/letters/${id}`, submitData, {
+        headers: { "If-Match": `"${version}"` },
+      });
       toast.success("Letter updated successfully");
       navigate('/letters');
     } catch (error) {
       console.error("Error updating letter:", error);
-      toast.error("Failed to update letter");
+      if (error.response && error.response.status === 409) {
+        toast.error(error.response.data.detail);
+      } else {
+        toast.error("Failed to update letter");
+      }
     }
   };
 
@@ -589,7 +597,7 @@ const EditLetter = () => {
                       {signatory.signature_image ? (
                         <div className="relative border rounded p-2">
                           <img 
-                            src={signatory.signature_image} 
+                            src={backendUrl(signatory.signature_image)} 
                             alt="Signature" 
                             className="h-20 w-full object-contain"
                           />
@@ -16,6 +16,7 @@ const EditQuotation = () => {
   const { id } = useParams();
   const [companies, setCompanies] = useState([]);
   const [items, setItems] = useState([]);
+  const [version, setVersion] = useState(null);
   const [formData, setFormData] = useState({
     quotation_number: "",
     company_id: "",
@@ -75,6 +76,7 @@ const EditQuotation = () => {
         signature_position: quotation.signature_position || "",
       });
       setInvoiceItems(quotation.items);
+      setVersion(quotation.version);
     } catch (error) {
       console.error("Error fetching quotation:", error);
       toast.error("Failed to fetch quotation");
@@ -199,12 +201,18 @@ const EditQuotation = () => {
     };
 
     try {
-      await axios.put(`${API}/quotations/${id}`, submitData);
+      await axios.put(`${API}/quotations/${id}`, submitData, {
+        headers: { "If-Match": `"${version}"` },
+      });
       toast.success("Quotation updated successfully");
       navigate('/quotations');
     } catch (error) {
       console.error("Error updating quotation:", error);
-      toast.error("Failed to update quotation");
+      if (error.response && error.response.status === 409) {
+        toast.error(error.response.data.detail);
+      } else {
+        toast.error("Failed to update quotation");
+      }
     }
   };
 
@@ -12,6 +12,7 @@ import { toast } from "sonner";
 
 const Invoices = () => {
   const [invoices, setInvoices] = useState([]);
+  const [companyVersions, setCompanyVersions] = useState({});
   const [loading, setLoading] = useState(true);
   const [previewInvoice, setPreviewInvoice] = useState(null);
   const [previewDialogOpen, setPreviewDialogOpen] = useState(false);
@@ -22,8 +23,16 @@ const Invoices = () => {
 
   const fetchInvoices = async () => {
     try {
-      const response = await axios.get(`${API}/invoices`);
+      // Only the columns the table shows; thumbnail URLs are pinned to the
+      // document and company versions
+      const [response, companies] = await Promise.all([
+        axios.get(`${API}/invoices`, {
+          params: { fields: "invoice_number,client_name,date,total,currency,status,company_id,version" }
+        }),
+        axios.get(`${API}/companies`),
+      ]);
       setInvoices(response.data);
+      setCompanyVersions(Object.fromEntries(companies.data.map((company) => [company.id, company.version])));
     } catch (error) {
       console.error("Error fetching invoices:", error);
       toast.error("Failed to fetch invoices");
@@ -49,23 +58,17 @@ const Invoices = () => {
 
   const handlePreview = async (invoice) => {
     try {
-      const response = await axios.get(`${API}/invoices/${invoice.id}`);
+      const response = await axios.get(`${API}/invoices/${invoice.id}`, {
+        params: { expand: "company" }
+      });
       
-      // Try to get company, but handle if company doesn't exist
-      let companyData = null;
-      try {
-        const companyResponse = await axios.get(`${API}/companies/${invoice.company_id}`);
-        companyData = companyResponse.data;
-      } catch (companyError) {
-        console.warn("Company not found, using invoice data only");
-        // Create a minimal company object from invoice data if company not found
-        companyData = {
-          name: "Company Information Not Available",
-          address: "",
-          phone: "",
-          email: ""
-        };
-      }
+      // The company comes embedded, or null if it no longer exists
+      const companyData = response.data.company || {
+        name: "Company Information Not Available",
+        address: "",
+        phone: "",
+        email: ""
+      };
       
       setPreviewInvoice({ ...response.data, company: companyData });
       setPreviewDialogOpen(true);
@@ -153,6 +156,7 @@ const Invoices = () => {
             <Table>
               <TableHeader>
                 <TableRow>
+                  <TableHead className="w-16">Preview</TableHead>
                   <TableHead>Invoice Number</TableHead>
                   <TableHead>Client</TableHead>
                   <TableHead>Date</TableHead>
@@ -164,6 +168,15 @@ const Invoices = () => {
               <TableBody>
                 {invoices.map((invoice) => (
                   <TableRow key={invoice.id} data-testid={`invoice-row-${invoice.id}`}>
+                    <TableCell>
+                      <img
+                        src={`${API}/invoices/${invoice.id}/thumbnail?format=webp&v=${invoice.version}.${companyVersions[invoice.company_id] || 1}`}
+                        alt={`Invoice ${invoice.invoice_number}`}
+                        loading="lazy"
+                        className="w-12 h-16 object-cover object-top border rounded"
+                        data-testid={`thumbnail-invoice-${invoice.id}`}
+                      />
+                    </TableCell>
                     <TableCell className="font-medium">{invoice.invoice_number}</TableCell>
                     <TableCell>{invoice.client_name}</TableCell>
                     <TableCell>{invoice.date}</TableCell>
@@ -59,7 +59,9 @@ const Items = () => {
 
     try {
       if (editingItem) {
-        await axios.put(`${API}/items/${editingItem.id}`, submitData);
+        await axios.put(`${API}/items/${editingItem.id}`, submitData, {
+          headers: { "If-Match": `"${editingItem.version}"` },
+        });
         toast.success("Item updated successfully");
       } else {
         await axios.post(`${API}/items`, submitData);
@@ -72,7 +74,11 @@ const Items = () => {
       fetchItems();
     } catch (error) {
       console.error("Error saving item:", error);
-      toast.error("Failed to save item");
+      if (error.response && error.response.status === 409) {
+        toast.error(error.response.data.detail);
+      } else {
+        toast.error("Failed to save item");
+      }
     }
   };
 
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from "react";
 import axios from "axios";
-import { API } from "../App";
+import { API, backendUrl } from "../App";
 import { useNavigate } from "react-router-dom";
 import { Plus, Edit2, Trash2, Download, Eye, Mail } from "lucide-react";
 import { Button } from "@/components/ui/button";
@@ -11,6 +11,7 @@ import { toast } from "sonner";
 const Letters = () => {
   const navigate = useNavigate();
   const [letters, setLetters] = useState([]);
+  const [companyVersions, setCompanyVersions] = useState({});
   const [loading, setLoading] = useState(true);
   const [previewLetter, setPreviewLetter] = useState(null);
   const [previewDialogOpen, setPreviewDialogOpen] = useState(false);
@@ -21,8 +22,13 @@ const Letters = () => {
 
   const fetchLetters = async () => {
     try {
-      const response = await axios.get(`${API}/letters`);
+      // Thumbnail URLs are pinned to the document and company versions
+      const [response, companies] = await Promise.all([
+        axios.get(`${API}/letters`),
+        axios.get(`${API}/companies`),
+      ]);
       setLetters(response.data);
+      setCompanyVersions(Object.fromEntries(companies.data.map((company) => [company.id, company.version])));
     } catch (error) {
       console.error("Error fetching letters:", error);
       toast.error("Failed to fetch letters");
@@ -67,23 +73,18 @@ const Letters = () => {
 
   const handlePreview = async (letter) => {
     try {
-      const response = await axios.get(`${API}/letters/${letter.id}`);
+      const response = await axios.get(`${API}/letters/${letter.id}`, {
+        params: { expand: "company" }
+      });
       
-      // Get company data
-      let companyData = null;
-      try {
-        const companyResponse = await axios.get(`${API}/companies/${letter.company_id}`);
-        companyData = companyResponse.data;
-      } catch (companyError) {
-        console.warn("Company not found, using letter data only");
-        companyData = {
-          name: "Company Information Not Available",
-          address: "",
-          phone: "",
-          email: "",
-          motto: ""
-        };
-      }
+      // The company comes embedded, or null if it no longer exists
+      const companyData = response.data.company || {
+        name: "Company Information Not Available",
+        address: "",
+        phone: "",
+        email: "",
+        motto: ""
+      };
       
       setPreviewLetter({ ...response.data, company: companyData });
       setPreviewDialogOpen(true);
@@ -148,6 +149,13 @@ const Letters = () => {
             <Card key={letter.id} className="hover:shadow-lg transition-shadow">
               <CardHeader className="border-b">
                 <div className="flex justify-between items-start">
+                  <img
+                    src={`${API}/letters/${letter.id}/thumbnail?format=webp&v=${letter.version}.${companyVersions[letter.company_id] || 1}`}
+                    alt={`Surat ${letter.letter_number}`}
+                    loading="lazy"
+                    className="w-12 h-16 object-cover object-top border rounded mr-4"
+                    data-testid={`thumbnail-letter-${letter.id}`}
+                  />
                   <div className="flex-1">
                     <CardTitle className="text-xl mb-2">{letter.subject}</CardTitle>
                     <div className="flex flex-wrap gap-4 text-sm text-slate-600">
@@ -358,7 +366,7 @@ const Letters = () => {
                         <p className="mb-2">{sig.position}</p>
                         {sig.signature_image ? (
                           <img
-                            src={sig.signature_image}
+                            src={backendUrl(sig.signature_image)}
                             alt={`Signature ${idx + 1}`}
                             className="h-16 mx-auto object-contain my-4"
                           />
@@ -12,6 +12,7 @@ import { toast } from "sonner";
 
 const Quotations = () => {
   const [quotations, setQuotations] = useState([]);
+  const [companyVersions, setCompanyVersions] = useState({});
   const [loading, setLoading] = useState(true);
   const [previewQuotation, setPreviewQuotation] = useState(null);
   const [previewDialogOpen, setPreviewDialogOpen] = useState(false);
@@ -22,8 +23,16 @@ const Quotations = () => {
 
   const fetchQuotations = async () => {
     try {
-      const response = await axios.get(`${API}/quotations`);
+      // Only the columns the table shows; thumbnail URLs are pinned to the
+      // document and company versions
+      const [response, companies] = await Promise.all([
+        axios.get(`${API}/quotations`, {
+          params: { fields: "quotation_number,client_name,date,total,currency,status,company_id,version" }
+        }),
+        axios.get(`${API}/companies`),
+      ]);
       setQuotations(response.data);
+      setCompanyVersions(Object.fromEntries(companies.data.map((company) => [company.id, company.version])));
     } catch (error) {
       console.error("Error fetching quotations:", error);
       toast.error("Failed to fetch quotations");
@@ -49,23 +58,17 @@ const Quotations = () => {
 
   const handlePreview = async (quotation) => {
     try {
-      const response = await axios.get(`${API}/quotations/${quotation.id}`);
+      const response = await axios.get(`${API}/quotations/${quotation.id}`, {
+        params: { expand: "company" }
+      });
       
-      // Try to get company, but handle if company doesn't exist
-      let companyData = null;
-      try {
-        const companyResponse = await axios.get(`${API}/companies/${quotation.company_id}`);
-        companyData = companyResponse.data;
-      } catch (companyError) {
-        console.warn("Company not found, using quotation data only");
-        // Create a minimal company object from quotation data if company not found
-        companyData = {
-          name: "Company Information Not Available",
-          address: "",
-          phone: "",
-          email: ""
-        };
-      }
+      // The company comes embedded, or null if it no longer exists
+      const companyData = response.data.company || {
+        name: "Company Information Not Available",
+        address: "",
+        phone: "",
+        email: ""
+      };
       
       setPreviewQuotation({ ...response.data, company: companyData });
       setPreviewDialogOpen(true);
@@ -153,6 +156,7 @@ const Quotations = () => {
             <Table>
               <TableHeader>
                 <TableRow>
+                  <TableHead className="w-16">Preview</TableHead>
                   <TableHead>Quotation Number</TableHead>
                   <TableHead>Client</TableHead>
                   <TableHead>Date</TableHead>
@@ -164,6 +168,15 @@ const Quotations = () => {
               <TableBody>
                 {quotations.map((quotation) => (
                   <TableRow key={quotation.id} data-testid={`quotation-row-${quotation.id}`}>
+                    <TableCell>
+                      <img
+                        src={`${API}/quotations/${quotation.id}/thumbnail?format=webp&v=${quotation.version}.${companyVersions[quotation.company_id] || 1}`}
+                        alt={`Quotation ${quotation.quotation_number}`}
+                        loading="lazy"
+                        className="w-12 h-16 object-cover object-top border rounded"
+                        data-testid={`thumbnail-quotation-${quotation.id}`}
+                      />
+                    </TableCell>
                     <TableCell className="font-medium">{quotation.quotation_number}</TableCell>
                     <TableCell>{quotation.client_name}</TableCell>
                     <TableCell>{quotation.date}</TableCell>
@@ -0,0 +1,118 @@
+import copy
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+import mongomock.collection  # noqa: E402
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+_find_and_modify = mongomock.collection.Collection._find_and_modify
+
+
+def evaluate(expression, document):
+    """The aggregation operators PATCH pipelines use, which mongomock does not
+    evaluate inside array literals."""
+    if isinstance(expression, str) and expression.startswith('$'):
+        return copy.deepcopy(document.get(expression[1:]))
+    if isinstance(expression, list):
+        return [evaluate(part, document) for part in expression]
+    if isinstance(expression, dict) and len(expression) == 1:
+        (operator, operand), = expression.items()
+        if operator == '$literal':
+            return copy.deepcopy(operand)
+        if operator == '$concatArrays':
+            return [element for part in operand for element in evaluate(part, document)]
+        if operator == '$slice':
+            return evaluate(operand[0], document)[:operand[1]]
+        if operator == '$arrayElemAt':
+            return evaluate(operand[0], document)[operand[1]]
+        if operator == '$mergeObjects':
+            merged = {}
+            for part in operand:
+                merged.update(evaluate(part, document))
+            return merged
+    if isinstance(expression, dict) and not any(key.startswith('$') for key in expression):
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    raise NotImplementedError(f'Unsupported pipeline expression {expression!r}')
+
+
+def find_and_modify(self, query, projection=None, update=None, *args, **kwargs):
+    if isinstance(update, list):
+        # Run the $set stages of an update pipeline against the matched
+        # document and write the result as a plain $set
+        document = self.find_one(query)
+        if document is None:
+            return None
+        values = {}
+        for stage in update:
+            (operator, fields), = stage.items()
+            assert operator == '$set', operator
+            computed = {key: evaluate(value, document) for key, value in fields.items()}
+            document.update(computed)
+            values.update(computed)
+        update = {'$set': values}
+    # mongomock looks the document up again by the original filter when _id
+    # is projected out, which misses documents the update moved out of it
+    drop_id = isinstance(projection, dict) and projection.get('_id') == 0
+    if drop_id:
+        projection = {key: value for key, value in projection.items() if key != '_id'} or None
+    document = _find_and_modify(self, query, projection, update, *args, **kwargs)
+    if drop_id and document:
+        document.pop('_id', None)
+    return document
+
+
+mongomock.collection.Collection._find_and_modify = find_and_modify
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """API client backed by an in-memory database, with startup (indexes) run."""
+    monkeypatch.setattr(server, 'db', mongomock_motor.AsyncMongoMockClient()['test_database'])
+    monkeypatch.setattr(server, 'sequence_blocks', {})
+    monkeypatch.setattr(server, 'sequence_locks', {})
+    with TestClient(server.app, headers={'Accept-Encoding': 'identity'}) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def company(client):
+    response = client.post('/api/companies', json={'name': 'PT Garuda Nusantara', 'address': 'Jl. Merdeka 1'})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def trade_document_payload(number_field):
+    def payload(company_id, number='', **fields):
+        return {
+            number_field: number,
+            'company_id': company_id,
+            'client_name': 'Budi',
+            'date': '2026-10-05',
+            'items': [{'name': 'Consulting', 'quantity': 1, 'unit_price': 1000, 'total': 1000}],
+            'subtotal': 1000,
+            'total': 1000,
+            **fields,
+        }
+    return payload
+
+
+@pytest.fixture
+def invoice():
+    """Create payload for an invoice: invoice(company_id, number='', **fields)."""
+    return trade_document_payload('invoice_number')
+
+
+@pytest.fixture
+def quotation():
+    """Create payload for a quotation: quotation(company_id, number='', **fields)."""
+    return trade_document_payload('quotation_number')
@@ -0,0 +1,12 @@
+def test_bulk_delete_skips_finalized_documents(client, company, invoice):
+    draft = client.post('/api/invoices', json=invoice(company['id'])).json()
+    final = client.post('/api/invoices', json=invoice(company['id'])).json()
+    assert client.post(f"/api/invoices/{final['id']}/finalize").status_code == 200
+
+    response = client.post('/api/invoices/bulk-delete', json={'where': {'company_id': company['id']}})
+    assert response.status_code == 200, response.text
+    assert response.json() == {'deleted': 1, 'skipped': [final['id']]}
+
+    assert client.get(f"/api/invoices/{draft['id']}").status_code == 404
+    assert client.get(f"/api/invoices/{final['id']}").status_code == 200
+    assert client.get(f"/api/invoices/{final['id']}/archive").status_code == 200
@@ -0,0 +1,54 @@
+from datetime import date, timedelta
+
+
+def finalized_quotation(client, payload):
+    created = client.post('/api/quotations', json={**payload, 'status': 'sent'})
+    assert created.status_code == 201, created.text
+    finalized = client.post(f"/api/quotations/{created.json()['id']}/finalize")
+    assert finalized.status_code == 200, finalized.text
+    return finalized.json()
+
+
+def test_unexpired_quotation_thumbnail_is_cached_until_expiry(client, company, quotation):
+    document = finalized_quotation(client, quotation(company['id'], valid_until=(date.today() + timedelta(days=3)).isoformat()))
+    response = client.get(f"/api/quotations/{document['id']}/thumbnail?v={document['version']}.1")
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers['cache-control']
+    max_age = int(response.headers['cache-control'].split('max-age=')[1])
+    assert 2 * 86400 < max_age <= 4 * 86400
+
+
+def test_finalized_renderings_revalidate_with_the_expiry_state(client, company, quotation):
+    document = finalized_quotation(client, quotation(company['id'], valid_until='2020-01-01'))
+    for path in ('pdf', 'html'):
+        response = client.get(f"/api/quotations/{document['id']}/{path}")
+        assert response.headers['cache-control'] == 'public, no-cache'
+        assert response.headers['etag'] == '"%s-c1-expired"' % document['content_hash']
+        cached = client.get(f"/api/quotations/{document['id']}/{path}", headers={'If-None-Match': response.headers['etag']})
+        assert cached.status_code == 304
+
+
+def test_finalized_renderings_change_with_the_company(client, company, quotation):
+    document = finalized_quotation(client, quotation(company['id'], valid_until='2020-01-01'))
+    before = client.get(f"/api/quotations/{document['id']}/pdf")
+    updated = client.put(f"/api/companies/{company['id']}", json={'name': 'PT Garuda Baru', 'address': 'Jl. Sudirman 5'})
+    assert updated.status_code == 200
+
+    after = client.get(f"/api/quotations/{document['id']}/pdf", headers={'If-None-Match': before.headers['etag']})
+    assert after.status_code == 200
+    assert after.headers['etag'] != before.headers['etag']
+    assert after.content != before.content
+
+
+def test_thumbnail_urls_are_pinned_to_the_company_version(client, company, quotation):
+    document = finalized_quotation(client, quotation(company['id'], valid_until='2020-01-01'))
+    pinned = f"/api/quotations/{document['id']}/thumbnail?v={document['version']}.1"
+    before = client.get(pinned)
+    assert 'immutable' in before.headers['cache-control']
+
+    client.put(f"/api/companies/{company['id']}", json={'name': 'PT Garuda Baru', 'address': 'Jl. Sudirman 5'})
+    stale = client.get(pinned)
+    assert 'immutable' not in stale.headers['cache-control']
+    assert stale.headers['etag'] != before.headers['etag']
+    repinned = client.get(f"/api/quotations/{document['id']}/thumbnail?v={document['version']}.2")
+    assert 'immutable' in repinned.headers['cache-control']
@@ -0,0 +1,55 @@
+def test_auto_number_skips_supplied_number(client, company, invoice):
+    supplied = client.post('/api/invoices', json=invoice(company['id'], 'INV/2026/10/0001'))
+    assert supplied.status_code == 201, supplied.text
+
+    generated = client.post('/api/invoices', json=invoice(company['id']))
+    assert generated.status_code == 201, generated.text
+    assert generated.json()['invoice_number'] == 'INV/2026/10/0002'
+
+
+def test_supplied_number_in_use_is_rejected(client, company, invoice):
+    assert client.post('/api/invoices', json=invoice(company['id'])).status_code == 201
+
+    duplicate = client.post('/api/invoices', json=invoice(company['id'], 'INV/2026/10/0001'))
+    assert duplicate.status_code == 409
+
+
+def test_update_to_a_number_in_use_is_rejected_by_the_index(client, company, invoice):
+    assert client.post('/api/invoices', json=invoice(company['id'])).status_code == 201
+    second = client.post('/api/invoices', json=invoice(company['id'])).json()
+
+    duplicate = client.put(f"/api/invoices/{second['id']}", json=invoice(company['id'], 'INV/2026/10/0001'))
+    assert duplicate.status_code == 409
+    assert duplicate.json()['detail'] == 'Invoice number INV/2026/10/0001 is already in use'
+
+    unchanged = client.put(f"/api/invoices/{second['id']}", json=invoice(company['id'], second['invoice_number'], client_name='Sari'))
+    assert unchanged.status_code == 200, unchanged.text
+
+
+def test_bulk_create_mixing_supplied_and_auto_numbers(client, company, invoice):
+    records = [
+        invoice(company['id']),
+        invoice(company['id'], 'INV/2026/10/0002'),
+        invoice(company['id']),
+        invoice(company['id']),
+    ]
+    response = client.post('/api/invoices/bulk', json=records)
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body['created'] == 4
+    numbers = [result['invoice_number'] for result in body['results']]
+    assert len(set(numbers)) == 4
+    assert numbers[1] == 'INV/2026/10/0002'
+
+
+def test_bulk_create_renumbers_past_stored_numbers(client, company, invoice):
+    for number in ('INV/2026/10/0001', 'INV/2026/10/0002'):
+        assert client.post('/api/invoices', json=invoice(company['id'], number)).status_code == 201
+
+    response = client.post('/api/invoices/bulk', json=[invoice(company['id']), invoice(company['id'])])
+    body = response.json()
+    assert body['created'] == 2
+    assert [result['invoice_number'] for result in body['results']] == ['INV/2026/10/0003', 'INV/2026/10/0004']
+
+    stored = [doc['invoice_number'] for doc in client.get('/api/invoices').json()]
+    assert len(stored) == len(set(stored)) == 4
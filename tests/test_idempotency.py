@@ -0,0 +1,76 @@
+import io
+from datetime import datetime, timedelta, timezone
+
+import server
+from PIL import Image
+
+
+def test_retry_replays_the_stored_response(client, company, invoice):
+    headers = {'Idempotency-Key': 'create-1'}
+    first = client.post('/api/invoices', json=invoice(company['id']), headers=headers)
+    retry = client.post('/api/invoices', json=invoice(company['id']), headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+    assert retry.headers['idempotent-replayed'] == 'true'
+    assert retry.headers['content-type'] == first.headers['content-type']
+    assert len(client.get('/api/invoices').json()) == 1
+
+    other = client.post('/api/invoices', json=invoice(company['id'], client_name='Ani'), headers=headers)
+    assert other.status_code == 422
+
+
+def test_retry_takes_over_a_key_whose_lease_ran_out(client, company, invoice):
+    now = datetime.now(timezone.utc)
+    for key, lease_expires_at in (('crashed', now - timedelta(seconds=1)), ('running', now + timedelta(minutes=5))):
+        client.portal.call(server.db.idempotency_keys.insert_one, {
+            '_id': f'/api/invoices:{key}',
+            'state': 'processing',
+            'created_at': now - timedelta(minutes=10),
+            'lease_id': 'worker-1',
+            'lease_expires_at': lease_expires_at,
+        })
+
+    running = client.post('/api/invoices', json=invoice(company['id']), headers={'Idempotency-Key': 'running'})
+    assert running.status_code == 409
+
+    taken_over = client.post('/api/invoices', json=invoice(company['id']), headers={'Idempotency-Key': 'crashed'})
+    assert taken_over.status_code == 201, taken_over.text
+    retry = client.post('/api/invoices', json=invoice(company['id']), headers={'Idempotency-Key': 'crashed'})
+    assert retry.headers['idempotent-replayed'] == 'true'
+    assert retry.json() == taken_over.json()
+
+
+def test_multipart_retry_with_a_new_boundary_is_replayed(client):
+    buffer = io.BytesIO()
+    Image.new('RGB', (40, 20), 'white').save(buffer, 'PNG')
+    upload = {'file': ('signature.png', buffer.getvalue(), 'image/png')}
+    headers = {'Idempotency-Key': 'upload-1'}
+    first = client.post('/api/upload-signature', files=upload, headers=headers)
+    retry = client.post('/api/upload-signature', files=upload, headers=headers)
+    assert first.status_code == 200, first.text
+    assert retry.headers['idempotent-replayed'] == 'true'
+    assert retry.json() == first.json()
+
+
+def test_request_hash_ignores_how_the_body_is_chunked():
+    scope = {
+        'type': 'http',
+        'path': '/api/upload-signature',
+        'query_string': b'',
+        'headers': [(b'content-type', b'multipart/form-data; boundary=abcdef')],
+    }
+    body = b'--abcdef\r\npart one\r\n--abcdef\r\npart two\r\n--abcdef--\r\n'
+
+    whole = server.RequestHasher(scope)
+    whole.update({'body': body, 'more_body': False})
+
+    for size in (1, 3, 7):
+        chunked = server.RequestHasher(scope)
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        for index, chunk in enumerate(chunks):
+            chunked.update({'body': chunk, 'more_body': index < len(chunks) - 1})
+        assert chunked.hexdigest() == whole.hexdigest()
+
+    other = server.RequestHasher({**scope, 'headers': [(b'content-type', b'multipart/form-data; boundary=zzz')]})
+    other.update({'body': body.replace(b'abcdef', b'zzz'), 'more_body': False})
+    assert other.hexdigest() == whole.hexdigest()
@@ -0,0 +1,27 @@
+import msgpack
+
+MSGPACK = {'Accept': 'application/msgpack'}
+
+
+def test_writes_answer_in_msgpack_when_asked(client, company, invoice):
+    created = client.post('/api/invoices', json=invoice(company['id']), headers=MSGPACK)
+    assert created.status_code == 201
+    assert created.headers['content-type'] == 'application/msgpack'
+    document = msgpack.unpackb(created.content)
+    assert document['total'] == 1000
+
+    updated = client.put(f"/api/invoices/{document['id']}", json=invoice(company['id'], client_name='Ani'), headers=MSGPACK)
+    assert updated.status_code == 200
+    assert msgpack.unpackb(updated.content)['client_name'] == 'Ani'
+    assert updated.headers['etag'] == '"2"'
+
+    patched = client.patch(f"/api/invoices/{document['id']}", json={'notes': 'Net 30'}, headers=MSGPACK)
+    assert patched.status_code == 200
+    assert patched.headers['etag'] == '"3"'
+    assert msgpack.unpackb(patched.content) == msgpack.unpackb(client.get(f"/api/invoices/{document['id']}", headers=MSGPACK).content)
+
+
+def test_company_create_answers_in_msgpack(client):
+    created = client.post('/api/companies', json={'name': 'PT Garuda Nusantara', 'address': 'Jl. Merdeka 1'}, headers=MSGPACK)
+    assert created.status_code == 201
+    assert msgpack.unpackb(created.content)['name'] == 'PT Garuda Nusantara'
@@ -0,0 +1,70 @@
+import server
+
+
+LINES = [
+    {'item_id': 'consulting', 'name': 'Consulting', 'quantity': 2, 'unit_price': 1000, 'total': 2000},
+    {'item_id': 'travel', 'name': 'Travel', 'quantity': 1, 'unit_price': 500, 'total': 500},
+]
+
+
+def test_list_pipeline_references_untouched_lines():
+    stored = [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]
+    entries = server.replay_list_operations(
+        stored,
+        [server.ActivityOperation(op='remove', index=1), server.ActivityOperation(op='insert', row=server.ActivityRow(no=4, kegiatan='d'))],
+        lambda operation: operation.row.model_dump(),
+        lambda operation: {},
+    )
+    expression = server.list_pipeline_expression('activities', entries)
+    assert expression['$concatArrays'][0] == {'$slice': ['$activities', 1]}
+    assert expression['$concatArrays'][1][0] == {'$arrayElemAt': ['$activities', 2]}
+    assert expression['$concatArrays'][1][1]['$literal']['kegiatan'] == 'd'
+
+
+def test_line_update_recomputes_totals(client, company, invoice):
+    created = client.post('/api/invoices', json=invoice(company['id'], items=LINES, subtotal=2500, total=2500, tax_rate=10)).json()
+
+    response = client.patch(f"/api/invoices/{created['id']}", json={'items': [{'op': 'update', 'item_id': 'travel', 'changes': {'quantity': 3}}]})
+    assert response.status_code == 200, response.text
+    patched = response.json()
+    assert [line['total'] for line in patched['items']] == [2000, 1500]
+    assert (patched['subtotal'], patched['tax_amount'], patched['total']) == (3500, 350, 3850)
+    assert patched['version'] == created['version'] + 1
+
+
+def test_insert_and_remove_rebuild_the_lines(client, company, invoice):
+    created = client.post('/api/invoices', json=invoice(company['id'], items=LINES, subtotal=2500, total=2500)).json()
+
+    response = client.patch(f"/api/invoices/{created['id']}", json={'items': [
+        {'op': 'remove', 'index': 0, 'item_id': 'consulting'},
+        {'op': 'insert', 'item': {'item_id': 'training', 'name': 'Training', 'quantity': 4, 'unit_price': 250, 'total': 0}},
+    ]})
+    assert response.status_code == 200, response.text
+    patched = response.json()
+    assert [(line['item_id'], line['total']) for line in patched['items']] == [('travel', 500), ('training', 1000)]
+    assert patched['total'] == 1500
+
+    stored = client.get(f"/api/invoices/{created['id']}").json()
+    assert [line['name'] for line in stored['items']] == ['Travel', 'Training']
+
+
+def test_stale_if_match_is_rejected(client, company, invoice):
+    created = client.post('/api/invoices', json=invoice(company['id'])).json()
+    etag = '"%d"' % created['version']
+    assert client.patch(f"/api/invoices/{created['id']}", json={'notes': 'first'}, headers={'If-Match': etag}).status_code == 200
+
+    stale = client.patch(f"/api/invoices/{created['id']}", json={'notes': 'second'}, headers={'If-Match': etag})
+    assert stale.status_code == 409
+    assert client.get(f"/api/invoices/{created['id']}").json()['notes'] == 'first'
+
+
+def test_ambiguous_item_id_needs_an_index(client, company, invoice):
+    items = LINES + [{'item_id': 'travel', 'name': 'Travel back', 'quantity': 1, 'unit_price': 700, 'total': 700}]
+    created = client.post('/api/invoices', json=invoice(company['id'], items=items)).json()
+
+    ambiguous = client.patch(f"/api/invoices/{created['id']}", json={'items': [{'op': 'remove', 'item_id': 'travel'}]})
+    assert ambiguous.status_code == 409
+
+    response = client.patch(f"/api/invoices/{created['id']}", json={'items': [{'op': 'remove', 'index': 2, 'item_id': 'travel'}]})
+    assert response.status_code == 200, response.text
+    assert [line['name'] for line in response.json()['items']] == ['Consulting', 'Travel']
@@ -0,0 +1,60 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+from pypdf import PdfReader
+
+
+def png_data_uri(size, color):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def invoice_pdf(client, invoice):
+    company = client.post('/api/companies', json={
+        'name': 'PT Garuda Nusantara',
+        'address': 'Jl. Merdeka 1',
+        'logo': png_data_uri((600, 400), 'navy'),
+    }).json()
+
+    def fetch(variant='standard', client_name='Budi'):
+        created = client.post('/api/invoices', json=invoice(company['id'], client_name=client_name)).json()
+        response = client.get(f"/api/invoices/{created['id']}/pdf", params={'variant': variant})
+        assert response.status_code == 200
+        return response.content
+
+    return fetch
+
+
+def test_winansi_text_uses_base14_fonts(invoice_pdf):
+    pdf = invoice_pdf(client_name='José Müller')
+    assert b'/FontFile2' not in pdf
+    assert b'/BaseFont /Helvetica' in pdf
+
+
+def test_text_outside_winansi_embeds_the_fallback_family(invoice_pdf):
+    pdf = invoice_pdf(client_name='Nguyễn Đức')
+    if b'/FontFile2' not in pdf:
+        pytest.skip('no TrueType fallback family installed')
+    assert b'/BaseFont /Helvetica' not in pdf
+
+
+def test_email_variant_is_smaller_than_standard(invoice_pdf):
+    standard, email = invoice_pdf('standard'), invoice_pdf('email')
+    assert b'/FontFile2' not in email
+    assert len(email) < len(standard)
+    assert len(email) < 6 * 1024
+
+
+def test_email_variant_keeps_glyphs_outside_winansi(invoice_pdf):
+    name = 'Nguyễn Đức Ścisło'
+    standard, email = invoice_pdf('standard', client_name=name), invoice_pdf('email', client_name=name)
+    if b'/FontFile2' not in standard:
+        pytest.skip('no TrueType fallback family installed')
+    assert b'/FontFile2' in email
+    assert len(email) < len(standard)
+    text = PdfReader(io.BytesIO(email)).pages[0].extract_text()
+    assert name in text
@@ -0,0 +1,53 @@
+import io
+
+import server
+from PIL import Image
+
+
+def png(size):
+    buffer = io.BytesIO()
+    Image.new('L', size, 255).save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def test_upload_stores_a_bounded_png(client):
+    response = client.post('/api/upload-signature', files={'file': ('signature.png', png((1200, 400)), 'image/png')})
+    assert response.status_code == 200, response.text
+    assert response.json()['signature'] == f"/api/signatures/{response.json()['id']}"
+    stored = client.get(response.json()['signature'])
+    assert stored.headers['content-type'] == 'image/png'
+    assert Image.open(io.BytesIO(stored.content)).size == (640, 213)
+
+
+def test_oversized_body_is_refused_by_content_length(client, monkeypatch):
+    monkeypatch.setitem(server.REQUEST_BODY_LIMITS, '/api/upload-signature', 1024)
+    response = client.post('/api/upload-signature', files={'file': ('signature.png', b'\0' * 4096, 'image/png')})
+    assert response.status_code == 413
+
+
+def chunked_upload(size):
+    yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="s.png"\r\n\r\n'
+    for _ in range(size // 512):
+        yield b'\0' * 512
+    yield b'\r\n--b--\r\n'
+
+
+def test_oversized_body_without_content_length_is_refused(client, monkeypatch):
+    monkeypatch.setitem(server.REQUEST_BODY_LIMITS, '/api/upload-signature', 1024)
+    response = client.post('/api/upload-signature', content=chunked_upload(4096), headers={'Content-Type': 'multipart/form-data; boundary=b'})
+    assert response.status_code == 413
+
+
+def test_oversized_idempotent_upload_is_refused_and_not_recorded(client, monkeypatch):
+    monkeypatch.setitem(server.REQUEST_BODY_LIMITS, '/api/upload-signature', 1024)
+    headers = {'Content-Type': 'multipart/form-data; boundary=b', 'Idempotency-Key': 'oversized-upload'}
+    for _ in range(2):
+        response = client.post('/api/upload-signature', content=chunked_upload(4096), headers=headers)
+        assert response.status_code == 413
+        assert 'idempotent-replayed' not in response.headers
+
+
+def test_decompression_bomb_is_refused_as_too_large(client, monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    response = client.post('/api/upload-signature', files={'file': ('signature.png', png((100, 100)), 'image/png')})
+    assert response.status_code == 413